@@ -0,0 +1,346 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from dotenv import load_dotenv
+import email.utils
+import os
+import random
+import sys
+import threading
+import time
+
+# Statuses worth trying again: the API is busy or briefly unavailable.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Statuses that mean the API did not act on the request, so even a POST can
+# safely be sent again.
+NOT_PROCESSED_STATUSES = (429, 503)
+
+
+class ApiError(Exception):
+    """
+    An API call that failed, or kept failing after every retry.
+    """
+
+    def __init__(self, method, url, message, status=None):
+        super().__init__(f"{method} {url}: {message}")
+        self.status = status
+
+
+def never_sent(error):
+    """
+    Tells whether a connection error happened before the request reached the
+    API, because no connection could be made. Anything else, like a read
+    timeout, may have come after the API already acted on it.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(
+        reason, NewConnectionError
+    )
+
+
+def get_api_settings():
+    """
+    Reads the API request settings from the environment:
+    API_RATE         requests per second at most (default 10)
+    API_BURST        requests allowed at once after a quiet spell (default API_RATE)
+    API_RETRIES      attempts after the first one before giving up (default 5)
+    API_BACKOFF      first retry delay in seconds, doubled per retry (default 0.5)
+    API_MAX_BACKOFF  longest retry delay in seconds (default 30)
+    API_MAX_LATENCY  response time in seconds that counts as slow (default 2)
+    API_TIMEOUT      seconds to wait for a response (default 30)
+    """
+    load_dotenv()
+    rate = float(os.getenv("API_RATE") or 10)
+    return {
+        "rate": rate,
+        "burst": float(os.getenv("API_BURST") or rate),
+        "retries": int(os.getenv("API_RETRIES") or 5),
+        "backoff": float(os.getenv("API_BACKOFF") or 0.5),
+        "max_backoff": float(os.getenv("API_MAX_BACKOFF") or 30),
+        "max_latency": float(os.getenv("API_MAX_LATENCY") or 2),
+        "timeout": float(os.getenv("API_TIMEOUT") or 30),
+    }
+
+
+class TokenBucket:
+    """
+    Lets through at most rate requests per second on average, and up to burst
+    of them back to back. take() blocks until a token is free and returns how
+    long it waited.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class ConcurrencyLimit:
+    """
+    Caps the requests in flight and adjusts the cap AIMD-style: it grows by
+    one for every cap's worth of fast responses and is halved on a 429 or a
+    slow response, but never below one or above the number of workers.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = float(self.maximum)
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def resize(self, maximum):
+        with self.condition:
+            self.maximum = max(1, maximum)
+            self.limit = min(self.limit, self.maximum)
+            self.condition.notify_all()
+
+    def acquire(self):
+        """
+        Waits for a free slot and returns how long that took.
+        """
+        started = time.monotonic()
+        with self.condition:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+        return time.monotonic() - started
+
+    def release(self, overloaded):
+        with self.condition:
+            self.active -= 1
+            if overloaded:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class ApiStats:
+    """
+    Counts what the request layer did: requests sent, retries, 429s, failures
+    and the time spent waiting on the rate limit, the concurrency limit and
+    retry backoff.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+        self.waited = 0.0
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            now = time.monotonic()
+            if self.first is None:
+                self.first = now
+            self.last = now
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    @property
+    def elapsed(self):
+        if self.first is None:
+            return 0.0
+        return self.last - self.first
+
+    @property
+    def throughput(self):
+        """
+        Requests per second between the first and last request.
+        """
+        return self.requests / self.elapsed if self.elapsed else float(self.requests)
+
+    def record(self):
+        return {
+            "api_requests": self.requests,
+            "api_retries": self.retries,
+            "api_throttled": self.throttled,
+            "api_failures": self.failures,
+            "api_requests_per_second": round(self.throughput, 2),
+            "api_wait_seconds": round(self.waited, 3),
+        }
+
+    def report(self):
+        print(
+            f"[api] {self.requests} requests in {self.elapsed:.2f}s"
+            f" ({self.throughput:.1f}/s), {self.retries} retries,"
+            f" {self.throttled} throttled, {self.failures} failed,"
+            f" {self.waited:.2f}s waiting"
+        )
+
+
+def retry_after(response):
+    """
+    Returns the delay the API asked for in a Retry-After header, in seconds,
+    or None.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(
+            0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+class ApiClient:
+    """
+    The one way cleanup talks to the NetSapiens API. Every call goes through
+    the token bucket and the concurrency limit, and is retried with jittered
+    exponential backoff on connection errors and busy statuses. Failed calls
+    raise ApiError instead of being silently ignored.
+    """
+
+    def __init__(self, apikey, workers, settings=None):
+        self.settings = settings or get_api_settings()
+        self.headers = {
+            "accept": "application/json",
+            "authorization": f"Bearer {apikey}",
+        }
+        # One session for every API call, so connections to the API are kept
+        # alive and reused instead of doing a new TLS handshake per request.
+        self.session = requests.Session()
+        self.bucket = TokenBucket(self.settings["rate"], self.settings["burst"])
+        self.limit = ConcurrencyLimit(workers)
+        self.stats = ApiStats()
+        self.resize(workers)
+
+    def resize(self, workers):
+        """
+        Sizes the connection pool and the concurrency cap for the given number
+        of workers.
+        """
+        self.session.mount(
+            "https://", HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+        )
+        self.limit.resize(workers)
+
+    def backoff(self, attempt, response=None):
+        """
+        Returns how long to wait before retry number attempt: full jitter over
+        an exponentially growing window, or what the API asked for if longer.
+        """
+        window = min(
+            self.settings["max_backoff"], self.settings["backoff"] * 2**attempt
+        )
+        delay = random.uniform(0, window)
+        if response is not None:
+            delay = max(delay, retry_after(response) or 0)
+        return delay
+
+    def send(self, method, url, **kwargs):
+        """
+        Sends one attempt of a request, waiting for the rate and concurrency
+        limits first. Returns (response, sent): the response, or None on a
+        connection error, and whether the request may have reached the API.
+        """
+        waited = self.limit.acquire()
+        overloaded = True
+        try:
+            waited += self.bucket.take()
+            started = time.monotonic()
+            response = self.session.request(
+                method,
+                url,
+                headers=self.headers,
+                timeout=self.settings["timeout"],
+                **kwargs,
+            )
+            latency = time.monotonic() - started
+            overloaded = (
+                response.status_code in RETRY_STATUSES
+                or latency > self.settings["max_latency"]
+            )
+            return response, True
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print(f"  {method} {url}: {e}", file=sys.stderr)
+            return None, not never_sent(e)
+        finally:
+            self.limit.release(overloaded)
+            self.stats.add(requests=1, waited=waited)
+
+    def request(self, method, url, **kwargs):
+        """
+        Makes an API call and returns the response once it succeeds. POSTs are
+        only retried when the API said it didn't act on them or never got
+        them, and deleting something that isn't there counts as done.
+        """
+        retryable = RETRY_STATUSES if method != "POST" else NOT_PROCESSED_STATUSES
+        for attempt in range(self.settings["retries"] + 1):
+            response, sent = self.send(method, url, **kwargs)
+            if response is None and sent and method == "POST":
+                # The API may have built it already; sending it again could
+                # build it twice.
+                break
+            if response is not None and response.status_code == 429:
+                self.stats.add(throttled=1)
+            if response is not None and response.status_code < 400:
+                return response
+            if response is not None and (method, response.status_code) == (
+                "DELETE",
+                404,
+            ):
+                # Already gone, e.g. deleted by a run that died before
+                # journaling it.
+                return response
+            if response is not None and response.status_code not in retryable:
+                break
+            if attempt == self.settings["retries"]:
+                break
+            delay = self.backoff(attempt, response)
+            reason = "no response" if response is None else response.status_code
+            print(
+                f"  retrying {method} {url} in {delay:.1f}s ({reason})", file=sys.stderr
+            )
+            self.stats.add(retries=1, waited=delay)
+            time.sleep(delay)
+
+        self.stats.add(failures=1)
+        if response is None:
+            raise ApiError(method, url, "no response" if sent else "could not connect")
+        raise ApiError(
+            method,
+            url,
+            f"HTTP {response.status_code} {response.text[:200]}",
+            response.status_code,
+        )
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
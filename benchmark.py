@@ -0,0 +1,330 @@
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import checks
+from checks import CHECKS, CHECKS_BY_NAME, run_check
+from chunked import run_chunked
+from cleanup import domain_steps, group_agents_by_queue, unique_by_keys
+from merge import run_merge
+from offline import export_snapshot, run_offline
+from output import set_output
+from snapshot import run_snapshot
+from synthetic import Dataset, SqliteConnection, generate_sqlite
+
+# Default scales, in total rows, of the check suite benchmark.
+CHECK_SCALES = [10000, 1000000, 10000000]
+
+# A result this many times slower than the last recorded one is a regression.
+REGRESSION_RATIO = 1.2
+
+# Differences below this many seconds are noise, whatever the ratio.
+REGRESSION_MIN_SECONDS = 0.05
+
+
+def make_orphaned_agents(count, agents_per_queue=5, seed=1):
+    """
+    Builds a list of orphaned agent rows like check_huntgroup_agents_have_huntgroup
+    returns, with about agents_per_queue agents per queue spread over domains.
+    """
+    rng = random.Random(seed)
+    queues = max(1, count // agents_per_queue)
+    domains = max(1, queues // 10)
+    agents = []
+    for index in range(count):
+        queue = rng.randrange(queues)
+        agents.append(
+            {
+                "device_aor": f"sip:{index}@agent.example",
+                "huntgroup_name": f"queue{queue}",
+                "huntgroup_domain": f"domain{queue % domains}.example",
+            }
+        )
+    return agents
+
+
+def group_per_queue_scan(orphaned_agents):
+    """
+    The grouping cleanup_callqueue_agents used to do: unique_by_keys, then a
+    scan of the full list for every queue. Kept for comparison.
+    """
+    queues = {}
+    for queue in unique_by_keys(
+        orphaned_agents, ["huntgroup_name", "huntgroup_domain"]
+    ):
+        queues[(queue["huntgroup_name"], queue["huntgroup_domain"])] = [
+            d["device_aor"]
+            for d in orphaned_agents
+            if d["huntgroup_name"] == queue["huntgroup_name"]
+            and d["huntgroup_domain"] == queue["huntgroup_domain"]
+        ]
+    return queues
+
+
+def timed(func, *args):
+    """
+    Returns how long func(*args) took, in seconds.
+    """
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def bench_grouping(sizes, compare_up_to=20000):
+    """
+    Times group_agents_by_queue at each size and prints the time per row, which
+    stays flat when the grouping scales linearly. The old per-queue scan is
+    timed too for sizes up to compare_up_to, since it grows quadratically.
+    """
+    print(f"{'agents':>10} {'grouping':>10} {'us/agent':>9} {'old scan':>10}")
+    for size in sizes:
+        agents = make_orphaned_agents(size)
+        new = timed(group_agents_by_queue, agents)
+        line = f"{size:>10} {new:>9.3f}s {new / size * 1e6:>9.2f}"
+        if size <= compare_up_to:
+            assert group_per_queue_scan(agents) == group_agents_by_queue(agents)
+            line += f" {timed(group_per_queue_scan, agents):>9.3f}s"
+        print(line)
+
+
+class CountingOutput:
+    """
+    Output that only counts orphans, so the benchmark times the checks and not
+    the terminal. Keeps the rows of one check for the planner benchmark.
+    """
+
+    def __init__(self, keep=None):
+        self.keep = keep
+        self.kept = []
+        self.counts = {}
+
+    def write_orphans(self, spec, rows):
+        count = 0
+        for row in rows:
+            if spec.name == self.keep:
+                self.kept.append(row)
+            count += 1
+        self.counts[spec.name] = count
+        return count
+
+    def write_summary(self, spec, stats):
+        pass
+
+    def write_api_summary(self, api_record):
+        pass
+
+    def close(self):
+        pass
+
+
+def plan_offline(orphaned_agents):
+    """
+    The cleanup planner without the API: groups the agents and works out the
+    steps as if no domain or queue user existed (the most steps possible).
+    """
+    steps = 0
+    domains = {}
+    for (queue, domain), agent_ids in group_agents_by_queue(orphaned_agents).items():
+        domains.setdefault(domain, []).append(
+            {"queue": queue, "user_existed": False, "agents": agent_ids}
+        )
+    for domain, queues in domains.items():
+        entry = {"domain": domain, "domain_existed": False, "queues": queues}
+        steps += len(domain_steps(entry))
+    return steps
+
+
+def bench_checks(connection, modes, specs):
+    """
+    Times every check in each mode, and the cleanup planner on the orphaned
+    agents found. Returns {name: seconds} and the orphan count per check.
+    """
+    timings = {}
+    counts = None
+    for mode in modes:
+        output = CountingOutput(keep="check_huntgroup_agents_have_huntgroup")
+        set_output(output)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if mode == "snapshot":
+                timings["snapshot:all"] = timed(run_snapshot, connection, specs)
+            elif mode == "offline":
+                with tempfile.TemporaryDirectory() as directory:
+                    timings["offline:export"] = timed(
+                        export_snapshot, connection, specs, directory
+                    )
+                    timings["offline:all"] = timed(run_offline, directory, specs)
+            elif mode == "merge":
+                # The parent side gets its own connection to the same file.
+                runner = functools.partial(
+                    run_merge,
+                    connect=lambda table, check: SqliteConnection(check.path),
+                )
+                for spec in specs:
+                    timings[f"merge:{spec.name}"] = timed(runner, connection, spec)
+            else:
+                runner = run_chunked if mode == "chunked" else run_check
+                for spec in specs:
+                    timings[f"{mode}:{spec.name}"] = timed(runner, connection, spec)
+        if counts is None:
+            counts = output.counts
+            if output.kept:
+                timings["planner"] = timed(plan_offline, output.kept)
+    return timings, counts
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    """
+    Returns the last recorded seconds of every (scale, name) in the results file.
+    """
+    last = {}
+    if not os.path.exists(path):
+        return last
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            last[(record["scale"], record["name"])] = record["seconds"]
+    return last
+
+
+def is_regression(seconds, before):
+    return (
+        before is not None
+        and seconds > before * REGRESSION_RATIO
+        and seconds - before > REGRESSION_MIN_SECONDS
+    )
+
+
+def bench_suite(scales, orphan_rate, skew, modes, specs, results_path):
+    """
+    Generates (or reuses) a SQLite stand-in database at each scale, times the
+    checks and the planner on it, and appends the timings to the results file.
+    Each timing is compared with the last one recorded for the same scale;
+    returns the number of regressions.
+    """
+    previous = load_results(results_path)
+    revision = git_revision()
+    regressions = 0
+    with open(results_path, "a") as results:
+        for scale in scales:
+            path = generate_sqlite(Dataset(scale, orphan_rate, skew))
+            connection = SqliteConnection(path)
+            try:
+                timings, counts = bench_checks(connection, modes, specs)
+            finally:
+                connection.close()
+
+            print(f"\nscale {scale} ({path}):")
+            print(f"{'':<50} {'seconds':>9} {'before':>9}")
+            for name, seconds in timings.items():
+                before = previous.get((scale, name))
+                line = f"{name:<50} {seconds:>9.3f}"
+                line += f" {before:>9.3f}" if before is not None else f" {'-':>9}"
+                if is_regression(seconds, before):
+                    regressions += 1
+                    line += "  REGRESSION"
+                print(line)
+                record = {
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "revision": revision,
+                    "scale": scale,
+                    "orphan_rate": orphan_rate,
+                    "skew": skew,
+                    "name": name,
+                    "seconds": round(seconds, 4),
+                }
+                check = name.split(":", 1)[-1]
+                if check in counts:
+                    record["orphans"] = counts[check]
+                results.write(json.dumps(record) + "\n")
+    print(f"\nResults appended to {results_path}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for nsanity.")
+    commands = parser.add_subparsers(dest="command")
+    grouping = commands.add_parser(
+        "grouping", help="time the cleanup grouping of orphaned agents (default)"
+    )
+    grouping.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[1000, 5000, 20000, 50000, 200000, 1000000],
+        help="orphaned agent counts to time the cleanup grouping at",
+    )
+    suite = commands.add_parser(
+        "checks", help="time every check and the planner on synthetic data"
+    )
+    suite.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=CHECK_SCALES,
+        help="total rows of the synthetic databases",
+    )
+    suite.add_argument("--orphan-rate", type=float, default=0.01)
+    suite.add_argument("--skew", type=float, default=1.0, help="Zipf exponent")
+    suite.add_argument(
+        "--mode",
+        action="append",
+        dest="modes",
+        choices=("join", "snapshot", "chunked", "offline", "merge"),
+        help="check modes to time (default: join)",
+    )
+    suite.add_argument(
+        "--check",
+        action="append",
+        dest="checks",
+        choices=[spec.name for spec in CHECKS],
+        metavar="NAME",
+        help="only time this check",
+    )
+    suite.add_argument(
+        "--results",
+        default="benchmark-results.jsonl",
+        help="file the timings are appended to and compared with",
+    )
+    args = parser.parse_args()
+
+    if args.command == "checks":
+        checks.cleanup_enabled = False
+        specs = CHECKS
+        if args.checks:
+            specs = [CHECKS_BY_NAME[name] for name in dict.fromkeys(args.checks)]
+        regressions = bench_suite(
+            args.scales,
+            args.orphan_rate,
+            args.skew,
+            args.modes or ["join"],
+            specs,
+            args.results,
+        )
+        if regressions:
+            print(f"{regressions} regressions.")
+            sys.exit(1)
+    else:
+        bench_grouping(getattr(args, "sizes", None) or grouping.get_default("sizes"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+from dataclasses import replace
+from mysql.connector import Error
+import output
+from instrument import QueryStats
+from checks import iter_rows, quote
+from snapshot import build_filters, is_excluded, make_key, plan_scans, report_stopped
+
+# Rows shown per root cause in the report.
+SAMPLE_ROWS = 3
+
+# Root causes printed; the output file gets them all.
+REPORT_ROOTS = 50
+
+# Key columns made of other columns of the same row. A subscriber_login is
+# aor_user@aor_host, so a missing login still says which domain it was in.
+COMPOSITE_KEYS = {
+    ("subscriber_config", "subscriber_login"): ("@", ("aor_user", "aor_host")),
+}
+
+
+def as_tuple(key):
+    return key if isinstance(key, tuple) else (key,)
+
+
+def expand(table, values):
+    """
+    Adds the columns composite keys in values are made of.
+    """
+    values = dict(values)
+    for column, value in list(values.items()):
+        separator, parts = COMPOSITE_KEYS.get((table, column), (None, ()))
+        if parts and isinstance(value, str) and separator in value:
+            user, host = value.rsplit(separator, 1)
+            values.update(zip(parts, (user, host)))
+    return values
+
+
+class CascadeGraph:
+    """
+    The parent/child relations behind the checks, as one graph over tables:
+    each check is an edge from its child table up to its parent table.
+    Tracks which parent keys exist and, for rows that are broken, which root
+    cause they trace back to.
+    """
+
+    def __init__(self, specs):
+        self.edges = {spec.child_table: spec for spec in specs}
+        # (table, key columns) -> set of keys present in the table.
+        self.keys = {}
+        # (table, key columns) -> {key: root} for rows that are broken.
+        self.broken = {}
+        # (table, columns, values) -> root, for missing rows already traced.
+        self.traced = {}
+
+    def trace_missing(self, table, values):
+        """
+        Returns the root cause of a row that doesn't exist, known only by the
+        column values its child pointed at. Walks up from table for as long as
+        those values say which ancestor it would belong to: the highest
+        ancestor that is missing too is the root, or, if the first ancestor
+        found exists but is broken itself, that ancestor's root.
+        """
+        key = (table, tuple(values), tuple(values.values()))
+        if key in self.traced:
+            return self.traced[key]
+
+        root = key
+        values = expand(table, values)
+        spec = self.edges.get(table)
+        if spec and all(child in values for child, _ in spec.keys):
+            # Exclusions on columns the values don't cover can't be applied.
+            positions = {c: i for i, c in enumerate(values)}
+            exclusions = [e for e in spec.exclusions if e[0] in positions]
+            filters = build_filters(replace(spec, exclusions=exclusions), positions)
+            row = list(values.values())
+            if not (filters and is_excluded(filters, row)):
+                parent_columns = tuple(parent for _, parent in spec.keys)
+                parent_key = tuple(values[child] for child, _ in spec.keys)
+                parent_key = parent_key[0] if len(parent_key) == 1 else parent_key
+                present = self.keys.get((spec.parent_table, parent_columns), set())
+                if parent_key is None or parent_key not in present:
+                    mapped = {p: values[c] for c, p in spec.keys}
+                    root = self.trace_missing(spec.parent_table, mapped)
+                else:
+                    broken = self.broken.get((spec.parent_table, parent_columns), {})
+                    root = broken.get(parent_key, root)
+        self.traced[key] = root
+        return root
+
+    def root_of(self, spec, row, positions, filters):
+        """
+        Returns (root, direct) for a row of the child table of spec: the root
+        cause it traces back to and whether the check itself reports it
+        (its parent is missing), or (None, False) for a healthy row.
+        """
+        if filters and is_excluded(filters, row):
+            return None, False
+        parent_columns = tuple(parent for _, parent in spec.keys)
+        key = make_key(row, [positions[child] for child, _ in spec.keys])
+        present = self.keys.get((spec.parent_table, parent_columns), set())
+        if key is None:
+            values = tuple(row[positions[child]] for child, _ in spec.keys)
+            return (spec.parent_table, parent_columns, values), True
+        if key not in present:
+            values = dict(zip(parent_columns, as_tuple(key)))
+            return self.trace_missing(spec.parent_table, values), True
+        broken = self.broken.get((spec.parent_table, parent_columns), {})
+        return broken.get(key), False
+
+
+def scan_cascade(
+    connection, graph, table, columns, parent_keys, spec, report, stats=None
+):
+    """
+    Reads a table once: records its keys for the tables below it and traces
+    every broken row to its root cause, adding it to report.
+    """
+    select = "*" if "*" in columns else ", ".join(quote(c) for c in columns)
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(f"SELECT {select} FROM {quote(table)}")
+        names = list(cursor.column_names)
+        positions = {name: index for index, name in enumerate(names)}
+        building = []
+        for key_columns in parent_keys:
+            present = graph.keys.setdefault((table, key_columns), set())
+            broken = graph.broken.setdefault((table, key_columns), {})
+            building.append(
+                (present, broken, [positions[column] for column in key_columns])
+            )
+        filters = build_filters(spec, positions) if spec else []
+
+        rows = iter_rows(cursor)
+        if stats:
+            rows = stats.count_rows(rows)
+        for row in rows:
+            root = None
+            if spec:
+                root, direct = graph.root_of(spec, row, positions, filters)
+            for present, broken, indexes in building:
+                key = make_key(row, indexes)
+                if key is None:
+                    continue
+                present.add(key)
+                if root is not None:
+                    broken[key] = root
+            if root is not None:
+                report.add(root, table, spec, direct, dict(zip(names, row)))
+    finally:
+        cursor.close()
+
+
+class CascadeReport:
+    """
+    Broken rows grouped by root cause, counted per table and split into rows
+    a check reports directly and rows that only inherit a broken ancestor.
+    """
+
+    def __init__(self):
+        self.roots = {}
+
+    def add(self, root, table, spec, direct, row):
+        entry = self.roots.setdefault(root, {"rows": 0, "tables": {}, "samples": []})
+        entry["rows"] += 1
+        counts = entry["tables"].setdefault(
+            table, {"check": spec.name, "orphans": 0, "inherited": 0}
+        )
+        counts["orphans" if direct else "inherited"] += 1
+        if len(entry["samples"]) < SAMPLE_ROWS:
+            entry["samples"].append((table, row))
+
+    def ordered(self):
+        return sorted(
+            self.roots.items(), key=lambda item: (-item[1]["rows"], describe(item[0]))
+        )
+
+    def records(self):
+        records = []
+        for root, entry in self.ordered():
+            for table, counts in entry["tables"].items():
+                records.append({"root": describe(root), "table": table, **counts})
+        return records
+
+    def print(self):
+        orphans = sum(
+            counts["orphans"]
+            for entry in self.roots.values()
+            for counts in entry["tables"].values()
+        )
+        total = sum(entry["rows"] for entry in self.roots.values())
+        print(
+            f"\n{orphans} orphans and {total - orphans} rows under them trace back"
+            f" to {len(self.roots)} root causes:"
+        )
+        ordered = self.ordered()
+        for root, entry in ordered[:REPORT_ROOTS]:
+            print(f"\n{describe(root)}: {entry['rows']} rows")
+            for table, counts in entry["tables"].items():
+                print(
+                    f"  {table}: {counts['orphans']} orphans ({counts['check']}),"
+                    f" {counts['inherited']} inherited"
+                )
+            for table, row in entry["samples"]:
+                print(f"    {table} {row}")
+        if len(ordered) > REPORT_ROOTS:
+            print(f"\n... and {len(ordered) - REPORT_ROOTS} more root causes.")
+
+
+def describe(root):
+    table, columns, values = root
+    keys = ", ".join(f"{c}={v!r}" for c, v in zip(columns, values))
+    return f"missing {table} {keys}"
+
+
+def run_cascade(connection, specs, record=None):
+    """
+    Reads every table behind the checks once, parents first, and groups all
+    broken rows by the missing ancestor they trace back to, so cleanup can
+    work on the few roots instead of the many orphans below them. If reading
+    a table fails or is stopped, the checks of the tables not read are
+    reported with report_stopped and the report covers the tables read so
+    far.
+    Returns the CascadeReport.
+    """
+    graph = CascadeGraph(specs)
+    report = CascadeReport()
+    read = set()
+    for table, columns, parent_keys, child_specs in plan_scans(specs):
+        print(f"\nReading {table}...")
+        stats = QueryStats(table)
+        stats.start(connection)
+        try:
+            scan_cascade(
+                connection,
+                graph,
+                table,
+                columns,
+                parent_keys,
+                child_specs[0] if child_specs else None,
+                report,
+                stats,
+            )
+        except Error as e:
+            for spec in specs:
+                if spec.child_table not in read:
+                    print(f"\n{spec.name} wasn't traced:")
+                    report_stopped(spec, e, stats.started, record)
+            break
+        stats.stop(connection)
+        stats.report()
+        read.add(table)
+
+    report.print()
+    path = output.write_report("cascade", report.records())
+    if path:
+        print(f"\nRoot causes written to {path}")
+    return report
@@ -0,0 +1,388 @@
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from mysql.connector import Error
+import os
+import time
+from cleanup import cleanup_callqueue_agents
+from instrument import QUERY_TIMEOUT_ERRORS, QueryStats
+import output
+
+# Number of rows pulled from the server at a time while streaming results.
+STREAM_BATCH_SIZE = 1000
+
+# Set to False to never run cleanups, e.g. for unattended runs.
+cleanup_enabled = True
+
+# Built-in dialplans that are allowed to exist without a domain.
+IGNORED_DIALPLANS = [
+    "To Connection",
+    "Default",
+    "Inbound DID",
+    "DID Table",
+    "AA-Basic",
+    "Restricted",
+    "Starcodes",
+    "From Load Balanced Peer",
+    "Asserted_Defaults",
+    "Lower_Case_Defaults",
+    "To Connection - Forward",
+    "fwd-check",
+    "Default STIR SHAKEN",
+    "Cloud PBX Features",
+    "Forward Blocking",
+    "Default_New",
+]
+
+
+@dataclass(frozen=True)
+class CheckSpec:
+    """
+    Describes one orphan check: every row in child_table should have a row in
+    parent_table where each (child column, parent column) pair in keys matches.
+    columns are the child columns reported for each orphan ("*" for all of them).
+    exclusions are (child column, operator, value) filters; rows matching the
+    filter are skipped. Supported operators are "<>" and "NOT IN".
+    chunk_key is the child column order used to walk the table in chunks
+    (defaults to the child key columns).
+    domain_key is the (child column, parent column) pair from keys that holds
+    the domain, if the check joins on one. A child row's result then only
+    depends on rows of the same domain in both tables.
+    cleanup, if set, is called with the orphan rows when APIKEY is set.
+    """
+
+    name: str
+    description: str
+    child_table: str
+    parent_table: str
+    keys: tuple
+    columns: tuple
+    found_message: str
+    clean_message: str
+    exclusions: tuple = ()
+    chunk_key: tuple = ()
+    domain_key: tuple = ()
+    cleanup: object = field(default=None, compare=False)
+
+
+CHECKS = [
+    CheckSpec(
+        name="check_dial_rules_have_dialplan",
+        description="every DT rule has a DT table",
+        child_table="dialplan_config",
+        parent_table="dialplans",
+        keys=(("dialplan", "dialplan"),),
+        columns=("dialplan", "matchrule", "responder", "domain", "plan_description"),
+        found_message="Orphan entries found in dialplan_config (no matching dialplan in dialplans):",
+        clean_message="All entries in dialplan_config have corresponding dialplan entries in dialplans.",
+    ),
+    CheckSpec(
+        name="check_dialplans_have_domain",
+        description="every DT table has a domain",
+        child_table="dialplans",
+        parent_table="domains_config",
+        keys=(("domain", "domain"),),
+        columns=("*",),
+        exclusions=(("dialplan", "NOT IN", tuple(IGNORED_DIALPLANS)),),
+        domain_key=("domain", "domain"),
+        found_message="Orphan entries in dialplans (no matching domain in domains_config):",
+        clean_message="All entries in dialplans have corresponding domain entries in domains_config.",
+    ),
+    CheckSpec(
+        name="check_domains_have_reseller",
+        description="every domain has a reseller/territory",
+        child_table="domains_config",
+        parent_table="territories",
+        keys=(("territory", "territory"),),
+        columns=("domain", "territory", "description"),
+        found_message="Orphan entries in domains_config (no matching territory in territories):",
+        clean_message="All entries in domains_config have a corresponding territory in territories.",
+    ),
+    CheckSpec(
+        name="check_huntgroup_agents_have_huntgroup",
+        description="every call queue agent has a hunt group",
+        child_table="huntgroup_entry_config",
+        parent_table="huntgroup_config",
+        keys=(
+            ("huntgroup_name", "huntgroup_name"),
+            ("huntgroup_domain", "huntgroup_domain"),
+        ),
+        columns=("device_aor", "huntgroup_name", "huntgroup_domain"),
+        chunk_key=("huntgroup_domain", "huntgroup_name"),
+        domain_key=("huntgroup_domain", "huntgroup_domain"),
+        found_message="Orphan entries in huntgroup_entry_config (no matching huntgroup in huntgroup_config):",
+        clean_message="All entries in huntgroup_entry_config have a corresponding huntgroup in huntgroup_config.",
+        cleanup=cleanup_callqueue_agents,
+    ),
+    CheckSpec(
+        name="check_huntgroups_have_callqueues",
+        description="every hunt group has a call queue",
+        child_table="huntgroup_config",
+        parent_table="callqueue_config",
+        keys=(("huntgroup_name", "queue_name"), ("huntgroup_domain", "domain")),
+        columns=("huntgroup_name", "huntgroup_domain"),
+        chunk_key=("huntgroup_domain", "huntgroup_name"),
+        domain_key=("huntgroup_domain", "domain"),
+        found_message="Orphan entries in huntgroup_config (no matching callqueue in callqueue_config):",
+        clean_message="All entries in huntgroup_config have corresponding callqueue entries in callqueue_config.",
+    ),
+    CheckSpec(
+        name="check_callqueues_have_users",
+        description="every call queue has a user",
+        child_table="callqueue_config",
+        parent_table="subscriber_config",
+        keys=(("queue_name", "aor_user"), ("domain", "aor_host")),
+        columns=("queue_name", "domain"),
+        chunk_key=("domain", "queue_name"),
+        domain_key=("domain", "aor_host"),
+        found_message="Orphan entries in callqueue_config (no matching subscriber in subscriber_config):",
+        clean_message="All entries in callqueue_config have corresponding subscribers in subscriber_config.",
+    ),
+    CheckSpec(
+        name="check_users_have_domain",
+        description="every user has a domain",
+        child_table="subscriber_config",
+        parent_table="domains_config",
+        keys=(("aor_host", "domain"),),
+        columns=("subscriber_login", "aor_user", "aor_host"),
+        chunk_key=("aor_host", "aor_user"),
+        domain_key=("aor_host", "domain"),
+        found_message="Orphan entries in subscriber_config (no matching domain in domains_config):",
+        clean_message="All entries in subscriber_config have corresponding domains in domains_config.",
+    ),
+    CheckSpec(
+        name="check_devices_have_users",
+        description="every device has a user",
+        child_table="registrar_config",
+        parent_table="subscriber_config",
+        keys=(("subscriber_name", "aor_user"), ("subscriber_domain", "aor_host")),
+        columns=("aor", "subscriber_name", "subscriber_domain"),
+        exclusions=(("subscriber_domain", "<>", "*"),),
+        chunk_key=("subscriber_domain", "subscriber_name"),
+        domain_key=("subscriber_domain", "aor_host"),
+        found_message="Orphan entries in registrar_config (no matching subscriber in subscriber_config):",
+        clean_message="All entries in registrar_config (with aor_host not '*') have corresponding subscribers in subscriber_config.",
+    ),
+    CheckSpec(
+        name="check_timeframes_have_users",
+        description="every timeframe has a user",
+        child_table="time_frame_selections",
+        parent_table="subscriber_config",
+        keys=(("user", "aor_user"), ("domain", "aor_host")),
+        columns=("user", "domain", "time_frame_name", "error_info"),
+        chunk_key=("domain", "user"),
+        domain_key=("domain", "aor_host"),
+        found_message="Orphan entries in time_frame_selections (no matching subscriber in subscriber_config):",
+        clean_message="All entries in time_frame_selections have corresponding subscribers in subscriber_config.",
+    ),
+    CheckSpec(
+        name="check_answeringrules_have_users",
+        description="every answering rule has a user",
+        child_table="feature_config",
+        parent_table="subscriber_config",
+        keys=(("callee_match", "subscriber_login"),),
+        columns=("name", "callee_match", "parameters"),
+        found_message="Orphan entries in feature_config (no matching subscriber in subscriber_config):",
+        clean_message="All entries in feature_config have corresponding subscribers in subscriber_config.",
+    ),
+]
+
+CHECKS_BY_NAME = {spec.name: spec for spec in CHECKS}
+
+
+def quote(identifier):
+    """
+    Quotes a table or column name for use in a query.
+    """
+    return f"`{identifier}`"
+
+
+def build_exclusions(spec, alias="c"):
+    """
+    Returns the WHERE conditions and parameters for a check's exclusion filters.
+    """
+    conditions = []
+    params = []
+    for column, operator, value in spec.exclusions:
+        if operator == "NOT IN":
+            placeholders = ", ".join(["%s"] * len(value))
+            conditions.append(f"{alias}.{quote(column)} NOT IN ({placeholders})")
+            params.extend(value)
+        elif operator == "<>":
+            conditions.append(f"{alias}.{quote(column)} <> %s")
+            params.append(value)
+        else:
+            raise ValueError(f"Unsupported exclusion operator: {operator}")
+    return conditions, params
+
+
+def build_check_query(spec, extra_conditions=(), extra_params=()):
+    """
+    Builds the LEFT JOIN ... IS NULL query that finds the orphans of a check.
+    extra_conditions are further WHERE conditions on the child table (alias c),
+    used to restrict the query to part of the table.
+    Returns the SQL and the parameters to execute it with.
+    """
+    if spec.columns == ("*",):
+        select = "c.*"
+    else:
+        select = ", ".join(f"c.{quote(column)}" for column in spec.columns)
+    join = " AND ".join(
+        f"c.{quote(child)} = p.{quote(parent)}" for child, parent in spec.keys
+    )
+    conditions, params = build_exclusions(spec)
+    conditions.extend(extra_conditions)
+    params.extend(extra_params)
+    conditions.append(f"p.{quote(spec.keys[0][1])} IS NULL")
+
+    query = (
+        f"SELECT {select} "
+        f"FROM {quote(spec.child_table)} c "
+        f"LEFT JOIN {quote(spec.parent_table)} p ON {join} "
+        f"WHERE {' AND '.join(conditions)}"
+    )
+    return query, params
+
+
+def iter_rows(cursor):
+    """
+    Yields rows from an executed (unbuffered) cursor as they arrive from the
+    server, STREAM_BATCH_SIZE at a time, instead of loading the whole result
+    with fetchall() first.
+    """
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+class Row(Mapping):
+    """
+    One orphan, read-only and dict-like. The column positions are shared by
+    every row of a query, so a row only holds its tuple of values: a fraction
+    of the memory of a dict per row, for orphans kept for cleanup or between
+    watch cycles.
+    """
+
+    __slots__ = ("positions", "row")
+
+    def __init__(self, positions, row):
+        self.positions = positions
+        self.row = row
+
+    def __getitem__(self, column):
+        return self.row[self.positions[column]]
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def as_tuple(self):
+        """
+        Returns the row's values in column order, without copying them.
+        """
+        return self.row
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+def compact_rows(cursor):
+    """
+    Yields the rows of an executed tuple cursor as Row objects, streaming
+    them like iter_rows.
+    """
+    positions = {name: index for index, name in enumerate(cursor.column_names)}
+    for row in iter_rows(cursor):
+        yield Row(positions, tuple(row))
+
+
+def keep_rows(rows, kept):
+    """
+    Passes rows through, appending each one to kept on the way.
+    """
+    for row in rows:
+        kept.append(row)
+        yield row
+
+
+def print_orphans(spec, rows, keep=False):
+    """
+    Sends a check's orphan rows to the current output (the terminal unless
+    another format was chosen) as they come out of rows, so memory stays flat
+    however many orphans there are.
+    Returns the list of orphan rows if keep is True, otherwise None.
+    """
+    kept = [] if keep else None
+    if keep:
+        rows = keep_rows(rows, kept)
+    output.get_output().write_orphans(spec, rows)
+    return kept
+
+
+def finish_check(spec, missing_entries, run_cleanup=True, stats=None):
+    """
+    Reports a finished check's stats and passes its kept orphans to its
+    cleanup, unless run_cleanup is False.
+    Returns the orphans so callers can run the cleanup later.
+    """
+    if stats:
+        stats.report()
+        output.get_output().write_summary(spec, stats)
+    if missing_entries and run_cleanup and cleanup_enabled:
+        spec.cleanup(missing_entries)
+    return missing_entries
+
+
+def wants_cleanup(spec):
+    """
+    Cleanup only runs for checks that have one, and only if cleanups haven't
+    been turned off and, for cleanups through the API, the APIKEY env is set.
+    """
+    if spec.cleanup is None or not cleanup_enabled:
+        return False
+    return not getattr(spec.cleanup, "needs_apikey", True) or bool(os.getenv("APIKEY"))
+
+
+def report_query_error(spec, error, stats):
+    """
+    Prints why a check's query failed. A query stopped for running past its
+    time budget (see scheduler.py) is reported as timed out instead, with
+    what it had found so far, and its summary is still written.
+    """
+    if getattr(error, "errno", None) not in QUERY_TIMEOUT_ERRORS:
+        print(f"Error executing query: {error}")
+        return
+    stats.status = "timed out"
+    stats.elapsed = time.monotonic() - stats.started
+    stats.report()
+    output.get_output().write_summary(spec, stats)
+
+
+def run_check(connection, spec, run_cleanup=True, stats=None):
+    """
+    Runs a check on the given connection and prints its orphans, followed by
+    its timing and server counters (see QueryStats; pass one in to keep them).
+    If the check has a cleanup and APIKEY is set, the orphan rows are kept and
+    returned; they are also passed to the cleanup unless run_cleanup is False.
+    """
+    keep = wants_cleanup(spec)
+    stats = stats or QueryStats(spec.name)
+    query, params = build_check_query(spec)
+    stats.start(connection)
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+        missing_entries = print_orphans(
+            spec, stats.count_rows(compact_rows(cursor)), keep=keep
+        )
+    except Error as e:
+        report_query_error(spec, e, stats)
+        return None
+    finally:
+        cursor.close()
+
+    stats.stop(connection)
+    return finish_check(spec, missing_entries, run_cleanup, stats)
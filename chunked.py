@@ -0,0 +1,244 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import os
+import sys
+import time
+from instrument import QueryStats
+from explain import table_indexes
+from checks import (
+    build_check_query,
+    compact_rows,
+    finish_check,
+    print_orphans,
+    quote,
+    report_query_error,
+    run_check,
+    wants_cleanup,
+)
+
+
+def get_chunk_settings():
+    """
+    Reads the chunked mode settings from the environment:
+    CHUNK_SIZE        rows of the child table per chunk (default 10000)
+    CHUNK_SLEEP       seconds to pause between chunks (default 0.1)
+    CHUNK_MAX_SLEEP   longest pause the backoff will grow to (default 30)
+    CHUNK_MAX_LATENCY chunk query time in seconds that triggers backoff (default 2)
+    CHUNK_MAX_LAG     replication lag in seconds that triggers backoff (default 10)
+    """
+    load_dotenv()
+    return {
+        "size": int(os.getenv("CHUNK_SIZE") or 10000),
+        "sleep": float(os.getenv("CHUNK_SLEEP") or 0.1),
+        "max_sleep": float(os.getenv("CHUNK_MAX_SLEEP") or 30),
+        "max_latency": float(os.getenv("CHUNK_MAX_LATENCY") or 2),
+        "max_lag": float(os.getenv("CHUNK_MAX_LAG") or 10),
+    }
+
+
+def get_replication_lag(connection):
+    """
+    Returns Seconds_Behind_Master for the server the connection is on, or None
+    if it is not a replica (or we are not allowed to ask).
+    """
+    cursor = connection.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute("SHOW SLAVE STATUS")
+        status = cursor.fetchone()
+    except Error:
+        return None
+    finally:
+        cursor.close()
+    if not status:
+        return None
+    return status.get("Seconds_Behind_Master")
+
+
+class Throttle:
+    """
+    Decides how long to pause between chunks. The pause doubles while chunk
+    queries are slow or replication lag is high, and drops back to the base
+    pause once things recover. The lag watched is that of the REPLICAS
+    furthest behind (see ReplicaLags), since chunks usually run on the
+    primary; without REPLICAS it is the lag of the server the chunks run on,
+    if that is a replica. A lag that can't be read is unknown for that chunk
+    only and is asked again after the next one.
+    """
+
+    def __init__(self, settings, lags=None):
+        self.settings = settings
+        self.delay = settings["sleep"]
+        self.lags = lags
+
+    def lag(self, connection):
+        if self.lags and self.lags.replicas:
+            return self.lags.max_lag()
+        return get_replication_lag(connection)
+
+    def wait(self, connection, elapsed):
+        lag = self.lag(connection)
+        slow = elapsed > self.settings["max_latency"]
+        lagging = lag is not None and lag > self.settings["max_lag"]
+        if slow or lagging:
+            self.delay = min(max(self.delay, 0.1) * 2, self.settings["max_sleep"])
+            reason = f"lag {lag}s" if lagging else f"chunk took {elapsed:.1f}s"
+            print(f"  backing off {self.delay:.1f}s ({reason})", file=sys.stderr)
+        else:
+            self.delay = max(self.delay / 2, self.settings["sleep"])
+        time.sleep(self.delay)
+
+
+def keyset_condition(columns, operator, values, alias="c"):
+    """
+    Builds a condition comparing the columns, in order, to a key tuple, written
+    out as ORs of equalities so the optimizer can use an index range scan.
+    operator is ">" (strictly after the key) or "<=" (up to and including it).
+    Returns the SQL and its parameters.
+    """
+    strict = "<" if operator == "<=" else operator
+    branches = []
+    params = []
+    for index, column in enumerate(columns):
+        parts = [f"{alias}.{quote(c)} = %s" for c in columns[:index]]
+        parts.append(f"{alias}.{quote(column)} {strict} %s")
+        branches.append(f"({' AND '.join(parts)})")
+        params.extend(values[: index + 1])
+    if operator == "<=":
+        parts = [f"{alias}.{quote(c)} = %s" for c in columns]
+        branches.append(f"({' AND '.join(parts)})")
+        params.extend(values)
+    return f"({' OR '.join(branches)})", params
+
+
+def next_boundary(connection, spec, columns, lower, size):
+    """
+    Returns the key of the size-th row after lower in chunk key order, which is
+    the (inclusive) upper end of the next chunk, or None if fewer rows remain.
+    """
+    conditions = [f"c.{quote(c)} IS NOT NULL" for c in columns]
+    params = []
+    if lower is not None:
+        condition, params = keyset_condition(columns, ">", lower)
+        conditions.append(condition)
+    order = ", ".join(f"c.{quote(c)}" for c in columns)
+    query = (
+        f"SELECT {order} FROM {quote(spec.child_table)} c "
+        f"WHERE {' AND '.join(conditions)} "
+        f"ORDER BY {order} LIMIT 1 OFFSET %s"
+    )
+    cursor = connection.cursor(buffered=True)
+    try:
+        cursor.execute(query, params + [size - 1])
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return tuple(row) if row else None
+
+
+def iter_chunk(connection, spec, conditions, params):
+    """
+    Yields the orphans of a check within the part of the child table matched
+    by the extra conditions.
+    """
+    query, query_params = build_check_query(spec, conditions, params)
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(query, query_params)
+        yield from compact_rows(cursor)
+    finally:
+        cursor.close()
+
+
+def chunk_columns(spec):
+    """
+    Returns the child columns a check's table is walked in order of.
+    """
+    return spec.chunk_key or tuple(child for child, _ in spec.keys)
+
+
+def has_chunk_index(connection, spec):
+    """
+    Returns whether the child table has an index starting with the chunk
+    columns, in order. Without one every chunk boundary is a filesort of the
+    rest of the table. False if the server won't list the indexes.
+    """
+    try:
+        indexes = table_indexes(connection, spec.child_table)
+    except Error:
+        return False
+    columns = [column.lower() for column in chunk_columns(spec)]
+    return any(
+        [column.lower() for column in index[: len(columns)]] == columns
+        for index in indexes.values()
+    )
+
+
+def iter_chunked_orphans(connection, spec, settings):
+    """
+    Yields a check's orphans one key range of the child table at a time,
+    pausing between chunks. Rows with a NULL chunk key column are checked in
+    a final chunk of their own, since no key range contains them.
+    """
+    from nsanity import get_db_config
+    from replicas import ReplicaLags, get_replica_settings
+
+    columns = chunk_columns(spec)
+    not_null = [f"c.{quote(c)} IS NOT NULL" for c in columns]
+    lags = ReplicaLags(get_db_config(), get_replica_settings()["hosts"])
+    throttle = Throttle(settings, lags)
+    try:
+        lower = None
+        while True:
+            started = time.monotonic()
+            upper = next_boundary(connection, spec, columns, lower, settings["size"])
+            # A row with a NULL in a later column can still fall within a range
+            # by its leading columns; it belongs to the NULL chunk only.
+            conditions = list(not_null)
+            params = []
+            if lower is not None:
+                condition, condition_params = keyset_condition(columns, ">", lower)
+                conditions.append(condition)
+                params.extend(condition_params)
+            if upper is not None:
+                condition, condition_params = keyset_condition(columns, "<=", upper)
+                conditions.append(condition)
+                params.extend(condition_params)
+
+            yield from iter_chunk(connection, spec, conditions, params)
+            if upper is None:
+                break
+            lower = upper
+            throttle.wait(connection, time.monotonic() - started)
+
+        nulls = " OR ".join(f"c.{quote(c)} IS NULL" for c in columns)
+        yield from iter_chunk(connection, spec, [f"({nulls})"], [])
+    finally:
+        lags.close()
+
+
+def run_chunked(connection, spec, run_cleanup=True, stats=None):
+    """
+    Runs a check in chunks of the child table (see iter_chunked_orphans) so no
+    single query holds the server for long. The orphans of all chunks are
+    printed as one report, the same as run_check. A check whose child table
+    has no index on its chunk columns runs as one join instead.
+    """
+    if not has_chunk_index(connection, spec):
+        columns = ", ".join(chunk_columns(spec))
+        print(f"No index on {spec.child_table}({columns}), running it as one join.")
+        return run_check(connection, spec, run_cleanup, stats)
+    settings = get_chunk_settings()
+    keep = wants_cleanup(spec)
+    stats = stats or QueryStats(spec.name)
+    stats.start(connection)
+    try:
+        missing_entries = print_orphans(
+            spec,
+            stats.count_rows(iter_chunked_orphans(connection, spec, settings)),
+            keep=keep,
+        )
+    except Error as e:
+        report_query_error(spec, e, stats)
+        return None
+    stats.stop(connection)
+    return finish_check(spec, missing_entries, run_cleanup, stats)
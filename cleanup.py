@@ -1,7 +1,13 @@
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+import argparse
+import json
 import os
 import re
+import sys
+import threading
+import time
+from api import ApiClient, ApiError
 
 load_dotenv()
 APIKEY = os.getenv("APIKEY")
@@ -10,6 +16,50 @@ RESELLER = os.getenv("RESELLER")
 
 base_url = f"https://{NSHOST}/ns-api/v2/"
 
+# Values we are willing to put into an API URL.
+ALLOWED_VALUE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# The check whose orphans this module cleans up.
+HUNTGROUP_AGENT_CHECK = "check_huntgroup_agents_have_huntgroup"
+
+# Every API call goes through this client (see api.py), built by get_client
+# the first time cleanup needs it.
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_cleanup_workers():
+    """
+    Returns the number of domains cleaned up at the same time, read from the
+    CLEANUP_WORKERS environment variable. Defaults to 4.
+    """
+    load_dotenv()
+    try:
+        return max(1, int(os.getenv("CLEANUP_WORKERS") or 4))
+    except ValueError:
+        print("CLEANUP_WORKERS must be a number, cleaning up 4 domains at a time.")
+        return 4
+
+
+def get_client():
+    """
+    Returns the API client, building it on first use so runs that never
+    clean anything up don't need the API settings.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            load_dotenv()
+            _client = ApiClient(os.getenv("APIKEY"), get_cleanup_workers())
+        return _client
+
+
+def get_api_stats():
+    """
+    Returns the stats of the API calls made so far, or None if there were none.
+    """
+    return _client.stats if _client is not None else None
+
 
 def ask_yes_no(prompt):
     """
@@ -38,7 +88,6 @@ def unique_by_keys(dict_list, keys):
     Also excludes dictionaries that contain any value with characters other than underscore, hyphen, period, letters, or numbers.
     The first occurrence is kept.
     """
-    allowed_pattern = re.compile(r"^[A-Za-z0-9_.-]+$")
     seen = set()
     unique_list = []
 
@@ -46,7 +95,7 @@ def unique_by_keys(dict_list, keys):
         valid = True
         for k in keys:
             value = d.get(k)
-            if isinstance(value, str) and not allowed_pattern.match(value):
+            if isinstance(value, str) and not ALLOWED_VALUE.match(value):
                 valid = False
                 break
         if not valid:
@@ -59,27 +108,54 @@ def unique_by_keys(dict_list, keys):
     return unique_list
 
 
+def group_agents_by_queue(orphaned_agents):
+    """
+    Groups orphaned agents by queue in a single pass over the list.
+    Returns {(huntgroup_name, huntgroup_domain): [device_aor, ...]} in order of
+    first appearance. Like unique_by_keys, queues whose name or domain has
+    characters other than underscore, hyphen, period, letters or numbers are
+    left out.
+    """
+    queues = {}
+    rejected = set()
+    for agent in orphaned_agents:
+        key = (agent.get("huntgroup_name"), agent.get("huntgroup_domain"))
+        agent_ids = queues.get(key)
+        if agent_ids is None:
+            if key in rejected:
+                continue
+            if any(isinstance(v, str) and not ALLOWED_VALUE.match(v) for v in key):
+                rejected.add(key)
+                continue
+            agent_ids = queues[key] = []
+        agent_ids.append(agent["device_aor"])
+    return queues
+
+
+def count_total(response):
+    """
+    Returns whether a /count call found anything. A reply without a total is
+    an error, not a "no".
+    """
+    try:
+        data = response.json()
+        return bool(data["total"])
+    except (ValueError, KeyError, TypeError):
+        raise ApiError("GET", response.url, f"unexpected reply {response.text[:200]}")
+
+
 def check_if_domain_exists(domain):
     func_url = f"{base_url}domains/{domain}/count"
 
-    headers = {"accept": "application/json", "authorization": f"Bearer {APIKEY}"}
-
-    response = requests.get(func_url, headers=headers)
-    data = response.json()
-    answer = bool(data["total"])
-    return answer
+    response = get_client().get(func_url)
+    return count_total(response)
 
 
 def check_if_user_exists(user, domain):
     func_url = f"{base_url}domains/{domain}/users/{user}/count"
 
-    headers = {"accept": "application/json", "authorization": f"Bearer {APIKEY}"}
-
-    response = requests.get(func_url, headers=headers)
-    data = response.json()
-    print(data)
-    answer = bool(data["total"])
-    return answer
+    response = get_client().get(func_url)
+    return count_total(response)
 
 
 def build_domain(domain):
@@ -96,25 +172,14 @@ def build_domain(domain):
         "caller-id-number": 1234567890,
         "caller-id-number-emergency": 1234567890,
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.post(func_url, json=payload, headers=headers)
+    get_client().post(func_url, json=payload)
     return
 
 
 def delete_domain(domain):
     func_url = f"{base_url}domains/{domain}"
 
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.delete(func_url, headers=headers)
+    get_client().delete(func_url)
     return
 
 
@@ -129,25 +194,14 @@ def build_user(user, domain):
         "user-scope": "No Portal",
     }
 
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.post(func_url, json=payload, headers=headers)
+    get_client().post(func_url, json=payload)
     return
 
 
 def delete_user(user, domain):
     func_url = f"{base_url}domains/{domain}/users/{user}"
 
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.delete(func_url, headers=headers)
+    get_client().delete(func_url)
     return
 
 
@@ -160,96 +214,402 @@ def build_callqueue(queue, domain):
         "callqueue-dispatch-type": "Ring All",
     }
 
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.post(func_url, json=payload, headers=headers)
+    get_client().post(func_url, json=payload)
     return
 
 
 def delete_callqueue(queue, domain):
     func_url = f"{base_url}domains/{domain}/callqueues/{queue}"
 
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.delete(func_url, headers=headers)
+    get_client().delete(func_url)
     return
 
 
 def delete_queue_agents(agent_id, queue, domain):
     func_url = f"{base_url}domains/{domain}/callqueues/{queue}/agents/{agent_id}"
 
-    headers = {
-        "accept": "application/json",
-        "authorization": f"Bearer {APIKEY}",
-    }
-
-    requests.delete(func_url, headers=headers)
+    get_client().delete(func_url)
     return
 
 
+# API calls a cleanup plan is made of, by step name.
+STEP_ACTIONS = {
+    "build_domain": build_domain,
+    "build_user": build_user,
+    "build_callqueue": build_callqueue,
+    "delete_queue_agents": delete_queue_agents,
+    "delete_callqueue": delete_callqueue,
+    "delete_user": delete_user,
+    "delete_domain": delete_domain,
+}
+
+# Step that deletes what a build step made, by build step name.
+TEARDOWN_STEPS = {
+    "build_domain": "delete_domain",
+    "build_user": "delete_user",
+    "build_callqueue": "delete_callqueue",
+}
+BUILT_BY = {delete: build for build, delete in TEARDOWN_STEPS.items()}
+
+BUILT_OBJECTS = {
+    "build_domain": "domain {0}",
+    "build_user": "user {0}@{1}",
+    "build_callqueue": "queue {0}@{1}",
+}
+
+STEP_MESSAGES = {
+    "build_domain": "Building domain: {0}",
+    "build_user": "Building User: {0}@{1}",
+    "build_callqueue": "Building queue: {0}@{1}",
+    "delete_queue_agents": "Deleting agent: {0} from queue {1}@{2}",
+    "delete_callqueue": "deleting queue: {0}@{1}",
+    "delete_user": "Deleting user: {0}@{1}",
+    "delete_domain": "Deleting domain: {0}",
+}
+
+
+def inspect_domain(queue_domain, queues):
+    """
+    Looks up what exists for the chosen queues of one domain: the domain is
+    looked up once, and each queue's user once if the domain exists.
+    queues is a list of (queue name, [agent ids]).
+    Returns the domain's plan entry:
+    {"domain": ..., "domain_existed": bool,
+     "queues": [{"queue": ..., "user_existed": bool, "agents": [...]}, ...]}
+    """
+    domain_existed = check_if_domain_exists(queue_domain)
+    entry = {"domain": queue_domain, "domain_existed": domain_existed, "queues": []}
+    for queue_name, orphaned_agent_ids in queues:
+        if domain_existed:
+            user_existed = check_if_user_exists(queue_name, queue_domain)
+        else:
+            user_existed = False
+        entry["queues"].append(
+            {
+                "queue": queue_name,
+                "user_existed": user_existed,
+                "agents": list(dict.fromkeys(orphaned_agent_ids)),
+            }
+        )
+    return entry
+
+
+def domain_steps(entry):
+    """
+    Works out the API calls that remove the orphaned agents of every queue in a
+    domain's plan entry. The NetSapiens API only lets us delete agents of a
+    queue that exists, so the queue (and its user, and the domain) have to be
+    built first if missing and deleted again after.
+    A missing domain is built and deleted once for all its queues. Per queue the
+    order is always build domain -> user -> queue -> delete agents -> teardown.
+    Returns the list of steps as (step name, args) tuples.
+    """
+    queue_domain = entry["domain"]
+    steps = []
+    if not entry["domain_existed"]:
+        steps.append(("build_domain", (queue_domain,)))
+
+    for queue in entry["queues"]:
+        queue_name = queue["queue"]
+        if not queue["user_existed"]:
+            steps.append(("build_user", (queue_name, queue_domain)))
+        steps.append(("build_callqueue", (queue_name, queue_domain)))
+        for agent_id in queue["agents"]:
+            steps.append(("delete_queue_agents", (agent_id, queue_name, queue_domain)))
+
+        # cleanup things that had to be built
+        steps.append(("delete_callqueue", (queue_name, queue_domain)))
+        if not queue["user_existed"]:
+            steps.append(("delete_user", (queue_name, queue_domain)))
+
+    if not entry["domain_existed"]:
+        steps.append(("delete_domain", (queue_domain,)))
+    return steps
+
+
+def plan_cleanup(chosen, workers=None):
+    """
+    Plans the cleanup of the chosen queues, grouped by domain as
+    {domain: [(queue name, [agent ids]), ...]}. The existence lookups for
+    different domains run at the same time.
+    Returns the plan: a list of domain entries (see inspect_domain) by domain.
+    """
+    plan = []
+    workers = workers or get_cleanup_workers()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(inspect_domain, queue_domain, queues): queue_domain
+            for queue_domain, queues in chosen.items()
+        }
+        for future in as_completed(futures):
+            try:
+                plan.append(future.result())
+            except Exception as e:
+                print(f"Could not plan cleanup of domain {futures[future]}: {e}")
+    return sorted(plan, key=lambda entry: entry["domain"])
+
+
+def save_plan(path, plan):
+    """
+    Writes a cleanup plan to a JSON file an operator can review and prune:
+    removing a domain, a queue or an agent id from it removes the matching
+    API calls.
+    """
+    with open(path, "w") as f:
+        json.dump(
+            {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "plan": plan}, f, indent=2
+        )
+    steps = sum(len(domain_steps(entry)) for entry in plan)
+    print(
+        f"Cleanup plan with {steps} API calls across {len(plan)} domains written to {path}"
+    )
+
+
+def load_plan(path):
+    with open(path) as f:
+        return json.load(f)["plan"]
+
+
+class Journal:
+    """
+    Append-only record of the plan steps that have completed, one per line, so
+    an interrupted apply can resume without repeating them. A line starting
+    with "-" takes a step back out, for builds that were torn down again.
+    Every line is flushed to disk before the next step starts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.startswith("-"):
+                        self.completed.discard(line[1:])
+                    elif line:
+                        self.completed.add(line)
+        self.file = open(path, "a")
+
+    @staticmethod
+    def step_id(name, args):
+        return json.dumps([name, list(args)])
+
+    def done(self, name, args):
+        return self.step_id(name, args) in self.completed
+
+    def write(self, line):
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record(self, name, args):
+        line = self.step_id(name, args)
+        self.write(line)
+        self.completed.add(line)
+
+    def undo(self, name, args):
+        line = self.step_id(name, args)
+        self.write("-" + line)
+        self.completed.discard(line)
+
+    def close(self):
+        self.file.close()
+
+
+def teardown(built, journal=None):
+    """
+    Deletes what the steps of a failed domain built and didn't delete yet,
+    newest first. Anything that can't be deleted is reported, since it is left
+    behind on the cluster. Builds that were deleted are taken out of the
+    journal, so a later apply builds them again.
+    """
+    for name, args in reversed(built):
+        step = TEARDOWN_STEPS[name]
+        print(STEP_MESSAGES[step].format(*args))
+        try:
+            STEP_ACTIONS[step](*args)
+        except Exception as e:
+            what = BUILT_OBJECTS[name].format(*args)
+            print(f"Could not delete {what}, it has to be removed by hand: {e}")
+            continue
+        if journal:
+            journal.undo(name, args)
+
+
+def run_steps(steps, journal=None):
+    """
+    Makes the API calls of one domain's plan, in order, skipping any the
+    journal says are already done. If a call fails, the temporary domain,
+    user and queue the plan built are torn down before the error is raised.
+    """
+    built = []
+    try:
+        for name, args in steps:
+            # A build counts as built before it is sent: one whose reply never
+            # came may still have been made, and deleting something that
+            # isn't there counts as done.
+            if name in TEARDOWN_STEPS:
+                built.append((name, args))
+            if not (journal and journal.done(name, args)):
+                print(STEP_MESSAGES[name].format(*args))
+                STEP_ACTIONS[name](*args)
+                if journal:
+                    journal.record(name, args)
+            if name in BUILT_BY and (BUILT_BY[name], args) in built:
+                built.remove((BUILT_BY[name], args))
+    except Exception:
+        teardown(built, journal)
+        raise
+
+
+def run_plan(plan, workers=None, journal=None):
+    """
+    Runs a cleanup plan. Domains are worked on at the same time, up to workers
+    of them; the steps within a domain run one after another, since a queue
+    can't be touched before its domain and user are built.
+    Returns the number of domains that failed.
+    """
+    failed = 0
+    workers = workers or get_cleanup_workers()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_steps, domain_steps(entry), journal): entry["domain"]
+            for entry in plan
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Cleanup of domain {futures[future]} failed: {e}")
+    return failed
+
+
+def apply_plan(path, workers=None):
+    """
+    Runs a reviewed plan file without asking anything. Completed steps are
+    appended to <plan>.journal; running apply again on the same plan picks up
+    where the last run stopped.
+    """
+    workers = workers or get_cleanup_workers()
+    get_client().resize(workers)
+    plan = load_plan(path)
+    journal = Journal(f"{path}.journal")
+    total = sum(len(domain_steps(entry)) for entry in plan)
+    if journal.completed:
+        print(f"Resuming: {len(journal.completed)} of {total} API calls already done.")
+    try:
+        failed = run_plan(plan, workers, journal)
+    finally:
+        journal.close()
+        get_client().stats.report()
+    if failed:
+        print(f"{failed} domains failed; run apply again to retry them.")
+    else:
+        print("Cleanup plan applied.")
+    return failed
+
+
+def choose_queues(orphaned_agents, interactive=True):
+    """
+    Groups orphaned agents by domain and queue, asking about each queue first
+    when interactive. Returns {domain: [(queue name, [agent ids]), ...]}.
+    """
+    missing_queues = group_agents_by_queue(orphaned_agents)
+    print(f"There are {len(missing_queues)} queues with orphaned agents.")
+    chosen = {}
+    for (queue_name, queue_domain), orphaned_agent_ids in missing_queues.items():
+        if interactive:
+            verdict = ask_yes_no(
+                f"Cleanup {queue_name}@{queue_domain} for {len(orphaned_agent_ids)} agents"
+            )
+
+            if not verdict:
+                print("you chose NOT to clean")
+                continue
+            else:
+                print("you chose to cleanup")
+        chosen.setdefault(queue_domain, []).append((queue_name, orphaned_agent_ids))
+    return chosen
+
+
 def cleanup_callqueue_agents(orphaned_agents):
     """
     takes in a list of dictionaries in the form of:
     {'device_aor': '<agent ID>', 'huntgroup_name': '<callqueue>', 'huntgroup_domain': '<domain>'}
+    Asks about every queue first, plans the cleanup of the chosen ones domain by
+    domain (see domain_steps), then runs the plan.
     """
-    missing_queues = unique_by_keys(
-        orphaned_agents, ["huntgroup_name", "huntgroup_domain"]
-    )
-    print(f"There are {len(missing_queues)} queues with orphaned agents.")
-    for queue in missing_queues:
-        queue_name = queue.get("huntgroup_name")
-        queue_domain = queue.get("huntgroup_domain")
-        orphaned_agent_ids = [
-            d["device_aor"]
-            for d in orphaned_agents
-            if d["huntgroup_name"] == queue["huntgroup_name"]
-            and d["huntgroup_domain"] == queue["huntgroup_domain"]
-        ]
-        verdict = ask_yes_no(
-            f"Cleanup {queue_name}@{queue_domain} for {len(orphaned_agent_ids)} agents"
-        )
+    plan = plan_cleanup(choose_queues(orphaned_agents))
+    step_count = sum(len(domain_steps(entry)) for entry in plan)
+    print(f"Cleanup plan: {step_count} API calls across {len(plan)} domains.")
+    run_plan(plan)
+    get_client().stats.report()
 
-        if not verdict:
-            print("you chose NOT to clean")
-            continue
-        else:
-            print("you chose to cleanup")
 
-        domain_existed = check_if_domain_exists(queue_domain)
+def write_cleanup_plan(path, orphaned_agents):
+    """
+    Dry run of cleanup_callqueue_agents: plans the cleanup of every queue with
+    orphaned agents and writes the plan to path instead of running it.
+    """
+    save_plan(path, plan_cleanup(choose_queues(orphaned_agents, interactive=False)))
 
-        if not domain_existed:
-            print(f"Building domain: {queue_domain}")
-            build_domain(queue_domain)
-            user_existed = False
-        else:
-            user_existed = check_if_user_exists(queue_name, queue_domain)
 
-        if not user_existed:
-            print(f"Building User: {queue_name}@{queue_domain}")
-            build_user(queue_name, queue_domain)
+def read_orphaned_agents(path):
+    """
+    Reads orphaned agents from a JSONL file written by nsanity.py --format jsonl,
+    either the check's own file or a combined one.
+    """
+    agents = []
+    with open(path) as f:
+        for line in f:
+            row = json.loads(line)
+            if row.get("check", HUNTGROUP_AGENT_CHECK) == HUNTGROUP_AGENT_CHECK:
+                agents.append(row)
+    return agents
 
-        print(f"Building queue: {queue_name}@{queue_domain}")
-        build_callqueue(queue_name, queue_domain)
-        for user in orphaned_agent_ids:
-            print(f"Deleting agent: {user} from queue {queue_name}@{queue_domain}")
-            delete_queue_agents(user, queue_name, queue_domain)
 
-        # cleanup things that had to be built
-        print(f"deleting queue: {queue_name}@{queue_domain}")
-        delete_callqueue(queue_name, queue_domain)
-        if not domain_existed:
-            print(f"Deleting user: {queue_name}")
-            delete_user(queue_name, queue_domain)
-
-            print(f"Deleting domain: {queue_domain}")
-            delete_domain(queue_domain)
-        elif not user_existed:
-            print(f"Deleting user: {queue_name}")
-            delete_user(queue_name, queue_domain)
+def main():
+    """
+    Two-phase cleanup of orphaned call queue agents:
+      plan  PLAN --from ORPHANS.jsonl   write a cleanup plan to review (dry run)
+      apply PLAN                        run the plan, resuming if interrupted
+    """
+    parser = argparse.ArgumentParser(
+        description="Plan and apply the cleanup of orphaned call queue agents."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    plan_parser = commands.add_parser("plan", help="write a cleanup plan (dry run)")
+    plan_parser.add_argument("plan", help="plan file to write")
+    plan_parser.add_argument(
+        "--from",
+        dest="orphans",
+        required=True,
+        help=f"JSONL output of {HUNTGROUP_AGENT_CHECK}",
+    )
+    apply_parser = commands.add_parser("apply", help="run a cleanup plan")
+    apply_parser.add_argument("plan", help="plan file to run")
+    for command in (plan_parser, apply_parser):
+        command.add_argument(
+            "--workers",
+            type=int,
+            help="domains to work on at the same time"
+            " (default: CLEANUP_WORKERS from .env, or 4)",
+        )
+    args = parser.parse_args()
+
+    workers = args.workers or get_cleanup_workers()
+    if args.command == "plan":
+        get_client().resize(workers)
+        chosen = choose_queues(read_orphaned_agents(args.orphans), interactive=False)
+        save_plan(args.plan, plan_cleanup(chosen, workers))
+        get_client().stats.report()
+    else:
+        sys.exit(1 if apply_plan(args.plan, workers) else 0)
+
+
+if __name__ == "__main__":
+    main()
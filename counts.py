@@ -0,0 +1,107 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import dataclasses
+import os
+from instrument import QueryStats
+from checks import build_check_query, finish_check, iter_rows, quote, report_query_error
+import output
+
+
+def get_count_top():
+    """
+    Returns how many domains a count lists per check, read from COUNT_TOP
+    (default 10).
+    """
+    load_dotenv()
+    try:
+        return max(1, int(os.getenv("COUNT_TOP") or 10))
+    except ValueError:
+        print("COUNT_TOP must be a number, listing the top 10 domains.")
+        return 10
+
+
+def domain_column(spec):
+    """
+    Returns the child column that holds a check's domain: its domain_key, or a
+    reported "domain" column. None for checks with no domain.
+    """
+    if spec.domain_key:
+        return spec.domain_key[0]
+    if "domain" in spec.columns:
+        return "domain"
+    return None
+
+
+def build_count_query(spec, top):
+    """
+    Builds the query that counts a check's orphans on the server: the top
+    domains by orphan count, each row also carrying the total and the number
+    of domains, so no orphan row is sent. Checks with no domain get a single
+    row with the total.
+    Returns the SQL and its parameters.
+    """
+    column = domain_column(spec)
+    if column is None:
+        query, params = build_check_query(
+            dataclasses.replace(spec, columns=(spec.keys[0][0],))
+        )
+        return f"SELECT NULL, COUNT(*), COUNT(*), 1 FROM ({query}) o", params
+    query, params = build_check_query(dataclasses.replace(spec, columns=(column,)))
+    return (
+        f"SELECT o.{quote(column)}, COUNT(*) AS n,"
+        f" SUM(COUNT(*)) OVER (), COUNT(*) OVER ()"
+        f" FROM ({query}) o GROUP BY o.{quote(column)} ORDER BY n DESC LIMIT %s",
+        params + [top],
+    )
+
+
+def print_counts(spec, total, domains, top_domains):
+    if not total:
+        print(spec.clean_message)
+        return
+    if domain_column(spec) is None:
+        print(f"{spec.found_message} {total}")
+        return
+    print(f"{spec.found_message} {total} in {domains} domains")
+    for domain, count in top_domains:
+        print(f"  {domain}: {count}")
+    if domains > len(top_domains):
+        print(f"  ... and {domains - len(top_domains)} more domains.")
+
+
+def run_count(connection, spec, run_cleanup=True, stats=None):
+    """
+    Counts a check's orphans on the server instead of fetching them: only the
+    COUNT_TOP domains with the most orphans come back, with the total. The
+    total goes to the stats and summary as usual, the domains to
+    <check>-domains.<ext> when writing files. There are no orphans to clean
+    up, so run_cleanup is ignored.
+    """
+    stats = stats or QueryStats(spec.name)
+    query, params = build_count_query(spec, get_count_top())
+    stats.start(connection)
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+        rows = list(iter_rows(cursor))
+    except Error as e:
+        report_query_error(spec, e, stats)
+        return None
+    finally:
+        cursor.close()
+    stats.stop(connection)
+
+    total = int(rows[0][2]) if rows else 0
+    domains = int(rows[0][3]) if rows else 0
+    top_domains = [(domain, count) for domain, count, _, _ in rows]
+    print_counts(spec, total, domains, top_domains)
+    if total and domain_column(spec):
+        output.write_report(
+            f"{spec.name}-domains",
+            [{"domain": domain, "orphans": count} for domain, count in top_domains],
+        )
+    stats.rows = total
+    # The orphans themselves weren't read; keeps history from comparing the
+    # next full run against this one.
+    stats.status = "counted"
+    return finish_check(spec, None, False, stats)
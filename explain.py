@@ -0,0 +1,100 @@
+from mysql.connector import Error
+from checks import build_check_query, quote
+
+
+def explain(connection, query, params):
+    """
+    Returns the EXPLAIN rows of a query as dicts.
+    """
+    cursor = connection.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(f"EXPLAIN {query}", params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def table_indexes(connection, table):
+    """
+    Returns {index name: [columns in order]} for a table.
+    """
+    cursor = connection.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(f"SHOW INDEX FROM {quote(table)}")
+        indexes = {}
+        for row in sorted(cursor.fetchall(), key=lambda r: r["Seq_in_index"]):
+            indexes.setdefault(row["Key_name"], []).append(row["Column_name"])
+        return indexes
+    finally:
+        cursor.close()
+
+
+def covering_index(indexes, columns):
+    """
+    Returns the name of an index whose leading columns are exactly the given
+    columns (in any order), or None.
+    """
+    for name, index_columns in indexes.items():
+        if set(index_columns[: len(columns)]) == set(columns):
+            return name
+    return None
+
+
+def index_advice(connection, table, columns, accessed_by):
+    """
+    Describes the index that would let the given columns be looked up.
+    """
+    existing = covering_index(table_indexes(connection, table), columns)
+    if existing:
+        return (
+            f"index {existing} on {table}({', '.join(columns)}) exists but is not "
+            f"used for {accessed_by}; check for a type or collation mismatch"
+        )
+    name = f"idx_{table}_{'_'.join(columns)}"
+    return (
+        f"no index on {table}({', '.join(columns)}) for {accessed_by}; "
+        f"CREATE INDEX {name} ON {quote(table)} "
+        f"({', '.join(quote(c) for c in columns)})"
+    )
+
+
+def explain_check(connection, spec):
+    """
+    Runs EXPLAIN on a check's query and returns a list of problems: a parent
+    lookup that can't use an index on the join columns, or a child table that
+    has no index on its key columns (needed for chunked and per-domain runs).
+    """
+    query, params = build_check_query(spec)
+    problems = []
+    for row in explain(connection, query, params):
+        if row.get("table") == "p" and (row.get("type") == "ALL" or not row.get("key")):
+            columns = [parent for _, parent in spec.keys]
+            problems.append(
+                index_advice(connection, spec.parent_table, columns, "the join")
+            )
+        elif row.get("table") == "c" and row.get("type") == "ALL":
+            columns = list(spec.chunk_key or [child for child, _ in spec.keys])
+            if not covering_index(table_indexes(connection, spec.child_table), columns):
+                problems.append(
+                    index_advice(
+                        connection, spec.child_table, columns, "key range reads"
+                    )
+                )
+    return problems
+
+
+def explain_checks(connection, specs):
+    """
+    Prints the query plan problems of the given checks.
+    """
+    print("\nQuery plan diagnostics:")
+    for spec in specs:
+        try:
+            problems = explain_check(connection, spec)
+        except Error as e:
+            print(f" {spec.name}: could not EXPLAIN: {e}")
+            continue
+        if not problems:
+            print(f" {spec.name}: ok")
+        for problem in problems:
+            print(f" {spec.name}: {problem}")
@@ -0,0 +1,350 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+import mysql.connector
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import checks
+from checks import CHECKS, CHECKS_BY_NAME
+from nsanity import ThreadOutput, get_check_mode, get_check_runner, get_db_config
+from output import OUTPUT_FORMATS, make_output, set_output
+from scheduler import Scheduler, get_schedule_settings
+from snapshot import run_snapshot
+
+# Modes a fleet run can use. Incremental keeps a single state file, which
+# clusters would overwrite for each other.
+FLEET_MODES = ("join", "snapshot", "chunked", "count")
+
+# Seconds to wait for a cluster's database before giving up on it.
+CONNECT_TIMEOUT = 10
+
+
+def load_inventory(path):
+    """
+    Reads the inventory of clusters to check, a JSON list like:
+    [{"name": "east", "host": "db1.east.example", "user": "nsanity",
+      "password": "..."}, ...]
+    "name" defaults to the host. Instead of "password", "password_env" can name
+    an environment variable holding it. Missing credentials are taken from
+    DBUSER/DBPASS in the .env file.
+    """
+    defaults = get_db_config()
+    with open(path) as f:
+        entries = json.load(f)
+
+    clusters = []
+    seen = set()
+    for entry in entries:
+        if not entry.get("host"):
+            raise ValueError(f"inventory entry without a host: {entry}")
+        name = entry.get("name") or entry["host"]
+        if name in seen:
+            raise ValueError(f"cluster {name} is in the inventory twice")
+        seen.add(name)
+        password = entry.get("password")
+        if password is None and entry.get("password_env"):
+            password = os.getenv(entry["password_env"])
+        clusters.append(
+            {
+                "name": name,
+                "config": {
+                    **defaults,
+                    "host": entry["host"],
+                    "port": entry.get("port", 3306),
+                    "user": entry.get("user") or defaults["user"],
+                    "password": (
+                        defaults["password"] if password is None else password
+                    ),
+                },
+            }
+        )
+    return clusters
+
+
+class FleetOutput:
+    """
+    Routes each worker thread's orphans to the writer of the cluster it is
+    checking, and keeps the orphan count and duration of every check. The
+    cluster's writer is also its writer attribute, so reports written past
+    the wrappers (output.write_report) go to the cluster's directory too.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def use(self, writer, results):
+        self.local.writer = writer
+        self.local.results = results
+
+    @property
+    def writer(self):
+        return self.local.writer
+
+    def write_orphans(self, spec, rows):
+        return self.writer.write_orphans(spec, rows)
+
+    def write_summary(self, spec, stats):
+        self.local.results[spec.name] = {
+            "orphans": stats.rows,
+            "duration_seconds": round(stats.elapsed, 3),
+            "status": stats.status,
+        }
+        self.writer.write_summary(spec, stats)
+
+    def write_api_summary(self, api_record):
+        pass
+
+    def close(self):
+        pass
+
+
+def run_cluster(cluster, specs, mode, fleet_output, stdout, writer, schedule=None):
+    """
+    Runs the checks against one cluster on its own connection, under the time
+    limits in schedule (see scheduler.py), the run deadline counting for the
+    cluster alone, so a hung cluster can't hold up the fleet. Everything
+    printed is captured so the cluster's report comes out as one block, or in
+    pieces prefixed with its name if it is long (see ThreadOutput).
+    Returns the printed text and the cluster's result.
+    """
+    stdout.start_capture(cluster["name"])
+    started = time.monotonic()
+    result = {"cluster": cluster["name"], "status": "ok", "checks": {}}
+    fleet_output.use(writer, result["checks"])
+    print(f"\n===== {cluster['name']} ({cluster['config']['host']}) =====")
+    try:
+        connection = mysql.connector.connect(
+            connection_timeout=CONNECT_TIMEOUT, **cluster["config"]
+        )
+        scheduler = Scheduler([cluster["config"]], schedule)
+        try:
+            if mode == "snapshot":
+                with scheduler.session(connection, "snapshot"):
+                    run_snapshot(
+                        connection, specs, run_cleanup=False, record=scheduler.record
+                    )
+            else:
+                runner = scheduler.wrap(get_check_runner(mode))
+                for spec in specs:
+                    print(f"\nRunning {spec.name}...")
+                    runner(connection, spec, run_cleanup=False)
+            scheduler.report()
+        finally:
+            connection.close()
+    except Exception as e:
+        print(f"Error checking {cluster['name']}: {e}")
+        result["status"] = f"failed: {e}"
+    finally:
+        writer.close()
+    result["duration_seconds"] = round(time.monotonic() - started, 3)
+    if result["status"] == "ok" and len(result["checks"]) < len(specs):
+        result["status"] = "check errors"
+    return stdout.stop_capture(), result
+
+
+def run_fleet(
+    clusters, specs, mode, workers, output_format, directory, schedule=None
+):
+    """
+    Checks the clusters concurrently, up to workers at a time. Each cluster is
+    isolated on its own connection and thread, so one that is unreachable or
+    slow only holds up its own worker, for at most the time limits in
+    schedule. File output goes to a directory per
+    cluster. Returns the results of every cluster, in inventory order.
+    """
+    fleet_output = FleetOutput()
+    set_output(fleet_output)
+    stdout = ThreadOutput(sys.stdout)
+    results = {}
+    sys.stdout = stdout
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for cluster in clusters:
+                writer = make_output(
+                    output_format, os.path.join(directory, cluster["name"])
+                )
+                future = executor.submit(
+                    run_cluster,
+                    cluster,
+                    specs,
+                    mode,
+                    fleet_output,
+                    stdout,
+                    writer,
+                    schedule,
+                )
+                futures[future] = cluster["name"]
+            for future in as_completed(futures):
+                text, result = future.result()
+                print(text, end="", flush=True)
+                results[futures[future]] = result
+    finally:
+        sys.stdout = stdout.stream
+    return [results[cluster["name"]] for cluster in clusters]
+
+
+def fleet_records(results, specs):
+    """
+    Flattens fleet results into one record per cluster and check.
+    """
+    records = []
+    for result in results:
+        for spec in specs:
+            check = result["checks"].get(spec.name)
+            records.append(
+                {
+                    "cluster": result["cluster"],
+                    "check": spec.name,
+                    "orphans": check["orphans"] if check else None,
+                    "duration_seconds": check["duration_seconds"] if check else None,
+                    "status": result["status"] if check is None else check["status"],
+                }
+            )
+    return records
+
+
+def print_fleet_report(results, specs):
+    """
+    Prints the orphan count of every check on every cluster, with totals per
+    check and the time each cluster took. Checks that didn't finish show "-".
+    """
+    width = max(len(spec.name) for spec in specs)
+    names = [result["cluster"] for result in results]
+    columns = [max(len(name), 8) for name in names]
+    print("\nFleet report (orphans per check and cluster):")
+    header = f"{'check':<{width}}"
+    header += "".join(f" {n:>{c}}" for n, c in zip(names, columns))
+    print(header + f" {'total':>8}")
+    for spec in specs:
+        line = f"{spec.name:<{width}}"
+        total = 0
+        for result, column in zip(results, columns):
+            check = result["checks"].get(spec.name)
+            line += f" {check['orphans'] if check else '-':>{column}}"
+            total += check["orphans"] if check else 0
+        print(line + f" {total:>8}")
+    line = f"{'time (s)':<{width}}"
+    for result, column in zip(results, columns):
+        line += f" {result['duration_seconds']:>{column}.1f}"
+    print(line)
+    for result in results:
+        if result["status"] != "ok":
+            print(f"{result['cluster']}: {result['status']}")
+
+
+def get_fleet_workers():
+    """
+    Returns the number of clusters to check at once, read from the
+    FLEET_WORKERS environment variable. Defaults to 4.
+    """
+    load_dotenv()
+    try:
+        return max(1, int(os.getenv("FLEET_WORKERS") or 4))
+    except ValueError:
+        print("FLEET_WORKERS must be a number, checking 4 clusters at a time.")
+        return 4
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Runs the sanity checks against every cluster in an inventory."
+    )
+    parser.add_argument("inventory", help="JSON file listing the clusters to check")
+    parser.add_argument(
+        "--check",
+        action="append",
+        dest="checks",
+        choices=[spec.name for spec in CHECKS],
+        metavar="NAME",
+        help="run only this check (can be given more than once)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=FLEET_MODES,
+        help="how to run the checks (default: MODE from .env, or join)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="clusters to check at once (default: FLEET_WORKERS from .env, or 4)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="text",
+        help="print orphans to the terminal (text) or write them to files",
+    )
+    parser.add_argument(
+        "--output",
+        default="nsanity-output",
+        metavar="DIR",
+        help="directory for the files, one subdirectory per cluster",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="stop a check running longer than this"
+        " (default: CHECK_TIMEOUT from .env, or 900; 0 for none)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="SECONDS",
+        help="stop checking a cluster this long after its checks began"
+        " (default: RUN_DEADLINE from .env, or none)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    """
+    Checks a fleet of clusters and prints one report for all of them. Cleanups
+    are never run: the API cleanup only knows about the NSHOST cluster.
+    """
+    args = parse_args()
+    try:
+        clusters = load_inventory(args.inventory)
+    except (OSError, ValueError) as e:
+        print(f"Can't read inventory {args.inventory}: {e}")
+        sys.exit(1)
+    if not clusters:
+        print(f"No clusters in inventory {args.inventory}.")
+        sys.exit(1)
+
+    specs = CHECKS
+    if args.checks:
+        specs = [CHECKS_BY_NAME[name] for name in dict.fromkeys(args.checks)]
+    mode = args.mode or get_check_mode()
+    if mode not in FLEET_MODES:
+        print(f"{mode} mode can't be used for a fleet, using join.")
+        mode = "join"
+    workers = max(1, min(args.workers or get_fleet_workers(), len(clusters)))
+    checks.cleanup_enabled = False
+    schedule = get_schedule_settings()
+    if args.timeout is not None:
+        schedule["timeout"] = args.timeout
+    if args.deadline is not None:
+        schedule["deadline"] = args.deadline
+
+    print(f"Checking {len(clusters)} clusters, {workers} at a time.")
+    results = run_fleet(
+        clusters, specs, mode, workers, args.format, args.output, schedule
+    )
+    print_fleet_report(results, specs)
+
+    if args.format != "text":
+        writer = make_output(args.format, args.output)
+        path = writer.path("fleet")
+        writer.write_file(path, fleet_records(results, specs))
+        print(f"\nFleet report written to {path}")
+    if any(result["status"] != "ok" for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,553 @@
+from dotenv import load_dotenv
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    finished REAL,
+    host TEXT,
+    mode TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+
+CREATE TABLE IF NOT EXISTS checks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    columns TEXT
+);
+
+CREATE TABLE IF NOT EXISTS domains (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS check_runs (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    check_id INTEGER NOT NULL REFERENCES checks (id),
+    orphans INTEGER NOT NULL,
+    new_orphans INTEGER,
+    duration_seconds REAL,
+    rows_examined INTEGER,
+    bytes_transferred INTEGER,
+    status TEXT,
+    recorded INTEGER NOT NULL DEFAULT 1,
+    columns TEXT,
+    PRIMARY KEY (check_id, run_id)
+);
+
+CREATE TABLE IF NOT EXISTS orphans (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    check_id INTEGER NOT NULL REFERENCES checks (id),
+    domain_id INTEGER REFERENCES domains (id),
+    new INTEGER NOT NULL,
+    row TEXT NOT NULL,
+    hash INTEGER
+);
+CREATE INDEX IF NOT EXISTS orphans_run_new_domain ON orphans (run_id, new, domain_id);
+CREATE INDEX IF NOT EXISTS orphans_domain_run ON orphans (domain_id, run_id);
+"""
+
+DAY = 24 * 60 * 60
+
+# Orphans written to the history database per INSERT, and looked up in the
+# previous run per query.
+HISTORY_BATCH_SIZE = 500
+
+
+def get_history_file():
+    """
+    Returns the path of the SQLite file runs are recorded in, read from the
+    HISTORY_DB environment variable.
+    """
+    load_dotenv()
+    return os.getenv("HISTORY_DB") or ".nsanity-history.db"
+
+
+def get_history_keep():
+    """
+    Returns how many of each check's runs keep their orphans in the history,
+    read from HISTORY_KEEP_RUNS (default 30, 0 for all of them). Counts and
+    timings of older runs are kept.
+    """
+    load_dotenv()
+    try:
+        return max(0, int(os.getenv("HISTORY_KEEP_RUNS") or 30))
+    except ValueError:
+        print("HISTORY_KEEP_RUNS must be a number, keeping the orphans of 30 runs.")
+        return 30
+
+
+def row_hash(row):
+    """
+    Returns a 64-bit hash of an encoded orphan, indexed to find it in an
+    earlier run.
+    """
+    digest = hashlib.blake2b(row.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def open_history(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.executescript(SCHEMA)
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(check_runs)")]
+    if "status" not in columns:
+        # Histories from before checks could time out.
+        connection.execute("ALTER TABLE check_runs ADD COLUMN status TEXT")
+    if "recorded" not in columns:
+        # Histories from before watch cycles could skip their orphans.
+        connection.execute(
+            "ALTER TABLE check_runs ADD COLUMN recorded INTEGER NOT NULL DEFAULT 1"
+        )
+    if "columns" not in columns:
+        # Histories from before runs were only compared on the same columns.
+        connection.execute("ALTER TABLE check_runs ADD COLUMN columns TEXT")
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(orphans)")]
+    if "hash" not in columns:
+        # Histories from before orphans were looked up by hash.
+        connection.create_function("row_hash", 1, row_hash, deterministic=True)
+        connection.execute("ALTER TABLE orphans ADD COLUMN hash INTEGER")
+        connection.execute("UPDATE orphans SET hash = row_hash(row)")
+        connection.execute("DROP INDEX IF EXISTS orphans_check_run")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS orphans_check_run_hash"
+        " ON orphans (check_id, run_id, hash)"
+    )
+    connection.commit()
+    return connection
+
+
+def row_domain(spec, row):
+    """
+    Returns the domain an orphan belongs to: the check's domain column, or a
+    "domain" column if it has one. None for checks with no domain.
+    """
+    if spec.domain_key:
+        return row.get(spec.domain_key[0])
+    return row.get("domain")
+
+
+def encode_row(row):
+    """
+    Stores an orphan as a compact JSON list of its values; the column names
+    are kept once per check. Rows read as checks.Row hand over their tuple,
+    plain dicts (offline mode) their values.
+    """
+    values = row.as_tuple() if hasattr(row, "as_tuple") else tuple(row.values())
+    return json.dumps(values, separators=(",", ":"), default=str)
+
+
+class HistoryOutput:
+    """
+    Wraps another writer and records every run in the history database: the
+    run itself, each check's counts and timings, and the orphans with their
+    check and domain stored as ids. Orphans are flagged as new when the
+    previous recorded run of the same check on the same host, reporting the
+    same columns, didn't have them, so "new orphans" queries are plain index
+    lookups. Orphans are written as they stream past,
+    HISTORY_BATCH_SIZE at a time, each batch looked up in the previous run by
+    hash, so memory stays flat. Only each check's last keep_runs runs keep
+    their orphans. With rows_every_run False (watch mode) only the first run
+    records orphans, later ones just their counts.
+    """
+
+    def __init__(
+        self, writer, path, host=None, mode=None, keep_runs=None, rows_every_run=True
+    ):
+        self.writer = writer
+        self.db = open_history(path)
+        self.lock = threading.Lock()
+        self.host = host
+        self.mode = mode
+        self.keep_runs = get_history_keep() if keep_runs is None else keep_runs
+        self.rows_every_run = rows_every_run
+        self.record_rows = True
+        self.new_counts = {}
+        self.run_columns = {}
+        self.domains = {}
+        self.start_run()
+
+    def start_run(self):
+        with self.lock:
+            self.run_id = self.db.execute(
+                "INSERT INTO runs (started, host, mode) VALUES (?, ?, ?)",
+                (time.time(), self.host, self.mode),
+            ).lastrowid
+            self.db.commit()
+
+    def finish_run(self):
+        with self.lock:
+            self.db.execute(
+                "UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run_id)
+            )
+            self.prune()
+            self.db.commit()
+            self.new_counts = {}
+            self.run_columns = {}
+            self.record_rows = self.rows_every_run
+
+    def prune(self):
+        """
+        Deletes the orphans of each check of this run but those of its last
+        keep_runs runs and of the run the next one will be compared against.
+        """
+        if not self.keep_runs:
+            return
+        check_runs = self.db.execute(
+            "SELECT check_id, columns FROM check_runs WHERE run_id = ?", (self.run_id,)
+        ).fetchall()
+        for check_id, columns in check_runs:
+            oldest = self.db.execute(
+                "SELECT MIN(run_id) FROM (SELECT run_id FROM check_runs"
+                " WHERE check_id = ? ORDER BY run_id DESC LIMIT ?)",
+                (check_id, self.keep_runs),
+            ).fetchone()[0]
+            previous = self.previous_run(check_id, self.run_id + 1, columns)
+            if previous is not None:
+                oldest = min(oldest, previous)
+            self.db.execute(
+                "DELETE FROM orphans WHERE check_id = ? AND run_id < ?",
+                (check_id, oldest),
+            )
+
+    def check_id(self, spec, columns=None):
+        self.db.execute("INSERT OR IGNORE INTO checks (name) VALUES (?)", (spec.name,))
+        if columns:
+            self.db.execute(
+                "UPDATE checks SET columns = ? WHERE name = ?",
+                (json.dumps(columns), spec.name),
+            )
+        return self.db.execute(
+            "SELECT id FROM checks WHERE name = ?", (spec.name,)
+        ).fetchone()[0]
+
+    def domain_ids(self, names):
+        names = {name for name in names if name is not None} - self.domains.keys()
+        self.db.executemany(
+            "INSERT OR IGNORE INTO domains (name) VALUES (?)", [(n,) for n in names]
+        )
+        for name in names:
+            self.domains[name] = self.db.execute(
+                "SELECT id FROM domains WHERE name = ?", (name,)
+            ).fetchone()[0]
+        return self.domains
+
+    def previous_run(self, check_id, before, columns=None):
+        """
+        Returns the id of the last run of a check before the given run that
+        ran to the end on this run's host and recorded its orphans, or None.
+        With columns (JSON, as stored), runs whose orphans had other columns,
+        like offline runs next to database ones, are passed over.
+        """
+        query = (
+            "SELECT MAX(c.run_id) FROM check_runs c JOIN runs r ON r.id = c.run_id"
+            " WHERE c.check_id = ? AND c.run_id < ? AND r.host IS ?"
+            " AND (c.status IS NULL OR c.status = 'ok') AND c.recorded = 1"
+        )
+        params = [check_id, before, self.host]
+        if columns is not None:
+            # Runs without orphans didn't say which columns they had.
+            query += " AND (c.columns IS NULL OR c.columns = ?)"
+            params.append(columns)
+        return self.db.execute(query, params).fetchone()[0]
+
+    def seen_before(self, check_id, previous, rows):
+        """
+        Returns which of the encoded rows the previous run also had.
+        """
+        hashes = {row_hash(row) for row in rows}
+        placeholders = ", ".join("?" * len(hashes))
+        return {
+            row
+            for (row,) in self.db.execute(
+                "SELECT row FROM orphans WHERE check_id = ? AND run_id = ?"
+                f" AND hash IN ({placeholders})",
+                (check_id, previous, *hashes),
+            )
+        }
+
+    def record_batch(self, spec, batch, state):
+        """
+        Writes one batch of orphans, flagging the ones the previous run
+        didn't have as new.
+        """
+        with self.lock:
+            if "check_id" not in state:
+                columns = list(batch[0])
+                state["check_id"] = self.check_id(spec, columns)
+                state["columns"] = json.dumps(columns)
+                state["previous"] = self.previous_run(
+                    state["check_id"], self.run_id, state["columns"]
+                )
+            check_id = state["check_id"]
+            encoded = [(row_domain(spec, row), encode_row(row)) for row in batch]
+            seen = None
+            if state["previous"] is not None:
+                seen = self.seen_before(
+                    check_id, state["previous"], [row for _, row in encoded]
+                )
+            domains = self.domain_ids(domain for domain, _ in encoded)
+            values = []
+            for domain, row in encoded:
+                is_new = seen is not None and row not in seen
+                state["new"] += is_new
+                values.append(
+                    (
+                        self.run_id,
+                        check_id,
+                        domains.get(domain),
+                        int(is_new),
+                        row,
+                        row_hash(row),
+                    )
+                )
+            self.db.executemany(
+                "INSERT INTO orphans (run_id, check_id, domain_id, new, row, hash)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                values,
+            )
+
+    def write_orphans(self, spec, rows):
+        if not self.record_rows:
+            with self.lock:
+                self.new_counts[spec.name] = None
+            return self.writer.write_orphans(spec, rows)
+
+        state = {"new": 0}
+        batch = []
+
+        def record(rows):
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= HISTORY_BATCH_SIZE:
+                    self.record_batch(spec, batch, state)
+                    batch.clear()
+                yield row
+
+        count = self.writer.write_orphans(spec, record(rows))
+        if batch:
+            self.record_batch(spec, batch, state)
+        with self.lock:
+            if "check_id" not in state:
+                state["previous"] = self.previous_run(self.check_id(spec), self.run_id)
+            previous = state["previous"]
+            self.new_counts[spec.name] = None if previous is None else state["new"]
+            self.run_columns[spec.name] = state.get("columns")
+            self.db.commit()
+        return count
+
+    def write_summary(self, spec, stats):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO check_runs (run_id, check_id, orphans,"
+                " new_orphans, duration_seconds, rows_examined, bytes_transferred,"
+                " status, recorded, columns) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.run_id,
+                    self.check_id(spec),
+                    stats.rows,
+                    self.new_counts.get(spec.name),
+                    round(stats.elapsed, 3),
+                    stats.rows_examined,
+                    stats.bytes_sent,
+                    stats.status,
+                    int(self.record_rows),
+                    self.run_columns.get(spec.name),
+                ),
+            )
+            self.db.commit()
+        self.writer.write_summary(spec, stats)
+
+    def write_api_summary(self, api_record):
+        self.writer.write_api_summary(api_record)
+
+    def close(self):
+        self.finish_run()
+        self.db.close()
+        self.writer.close()
+
+
+def check_costs(path, names, runs=5):
+    """
+    Returns {check name: seconds} with the average duration of each check's
+    last runs, for the checks that have any. Timed out runs count with the
+    time they got, a lower bound of what they cost.
+    """
+    if not os.path.exists(path):
+        return {}
+    db = open_history(path)
+    try:
+        costs = {}
+        for name in names:
+            durations = [
+                duration
+                for (duration,) in db.execute(
+                    "SELECT c.duration_seconds FROM check_runs c"
+                    " JOIN checks k ON k.id = c.check_id WHERE k.name = ?"
+                    " AND c.duration_seconds IS NOT NULL"
+                    " ORDER BY c.run_id DESC LIMIT ?",
+                    (name, runs),
+                )
+            ]
+            if durations:
+                costs[name] = sum(durations) / len(durations)
+        return costs
+    finally:
+        db.close()
+
+
+def since(days):
+    return time.time() - days * DAY
+
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp))
+
+
+def show_runs(db, limit):
+    """
+    Lists the most recent runs with the orphans and new orphans they found.
+    """
+    rows = db.execute(
+        "SELECT r.id, r.started, r.finished, r.host, r.mode, COUNT(c.check_id),"
+        " SUM(c.orphans), SUM(c.new_orphans)"
+        " FROM runs r LEFT JOIN check_runs c ON c.run_id = r.id"
+        " GROUP BY r.id ORDER BY r.id DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+    print(
+        f"{'run':>6} {'started':<16} {'secs':>7} {'checks':>6} {'orphans':>8} {'new':>6}"
+    )
+    for run_id, started, finished, host, mode, checks, orphans, new in rows:
+        took = f"{finished - started:.1f}" if finished else "-"
+        print(
+            f"{run_id:>6} {format_time(started):<16} {took:>7} {checks:>6}"
+            f" {orphans or 0:>8} {'-' if new is None else new:>6}  {host or ''} {mode or ''}"
+        )
+
+
+def show_trend(db, check, days, host=None):
+    """
+    Prints a check's orphan count, new orphans and duration for every run in
+    the last days, with the host and mode of each run, optionally on one host
+    only.
+    """
+    query = (
+        "SELECT r.started, c.orphans, c.new_orphans, c.duration_seconds, c.status,"
+        " r.host, r.mode FROM check_runs c JOIN checks k ON k.id = c.check_id"
+        " JOIN runs r ON r.id = c.run_id WHERE k.name = ? AND r.started >= ?"
+    )
+    params = [check, since(days)]
+    if host:
+        query += " AND r.host = ?"
+        params.append(host)
+    rows = db.execute(query + " ORDER BY c.run_id", params).fetchall()
+    if not rows:
+        print(f"No runs of {check} in the last {days} days.")
+        return
+    print(f"{check}, last {days} days:")
+    print(f"{'started':<16} {'orphans':>8} {'new':>6} {'secs':>8}")
+    for started, orphans, new, duration, status, run_host, mode in rows:
+        status = None if status == "ok" else status
+        notes = " ".join(note for note in (run_host, mode, status) if note)
+        print(
+            f"{format_time(started):<16} {orphans:>8} {'-' if new is None else new:>6}"
+            f" {duration:>8.2f}  {notes}"
+        )
+
+
+def show_new_domains(db, days, top, check=None):
+    """
+    Prints the domains with the most new orphans in the last days, optionally
+    for one check only.
+    """
+    query = (
+        "SELECT d.name, COUNT(*) FROM orphans o JOIN domains d ON d.id = o.domain_id"
+        " WHERE o.run_id IN (SELECT id FROM runs WHERE started >= ?) AND o.new = 1"
+    )
+    params = [since(days)]
+    if check:
+        query += " AND o.check_id = (SELECT id FROM checks WHERE name = ?)"
+        params.append(check)
+    query += " GROUP BY o.domain_id ORDER BY COUNT(*) DESC, d.name LIMIT ?"
+    params.append(top)
+    rows = db.execute(query, params).fetchall()
+    if not rows:
+        print(f"No new orphans in the last {days} days.")
+        return
+    print(f"Domains with the most new orphans, last {days} days:")
+    for domain, count in rows:
+        print(f"{count:>8}  {domain}")
+
+
+def show_domain(db, domain, days):
+    """
+    Prints the orphans of one domain per check for every run in the last days.
+    """
+    rows = db.execute(
+        "SELECT r.started, k.name, COUNT(*), SUM(o.new) FROM orphans o"
+        " JOIN runs r ON r.id = o.run_id JOIN checks k ON k.id = o.check_id"
+        " WHERE o.domain_id = (SELECT id FROM domains WHERE name = ?)"
+        " AND o.run_id IN (SELECT id FROM runs WHERE started >= ?)"
+        " GROUP BY o.run_id, o.check_id ORDER BY o.run_id, k.name",
+        (domain, since(days)),
+    ).fetchall()
+    if not rows:
+        print(f"No orphans in {domain} in the last {days} days.")
+        return
+    print(f"{domain}, last {days} days:")
+    for started, check, count, new in rows:
+        print(f"{format_time(started):<16} {check:<40} {count:>8} {new:>6} new")
+
+
+def main():
+    """
+    Answers questions about past runs from the history database alone, without
+    touching the production database.
+    """
+    parser = argparse.ArgumentParser(description="Queries the nsanity run history.")
+    parser.add_argument(
+        "--db", default=get_history_file(), help="history file (default: HISTORY_DB)"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    runs = commands.add_parser("runs", help="list recent runs")
+    runs.add_argument("--limit", type=int, default=20)
+    trend = commands.add_parser("trend", help="orphan count of a check over time")
+    trend.add_argument("check")
+    trend.add_argument("--days", type=int, default=30)
+    trend.add_argument("--host", help="only runs against this host")
+    top = commands.add_parser("top-domains", help="domains with the most new orphans")
+    top.add_argument("--days", type=int, default=7)
+    top.add_argument("--top", type=int, default=20)
+    top.add_argument("--check", help="only count this check's orphans")
+    domain = commands.add_parser("domain", help="orphans of one domain over time")
+    domain.add_argument("domain")
+    domain.add_argument("--days", type=int, default=30)
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        print(f"No history in {args.db} yet.")
+        sys.exit(1)
+    db = open_history(args.db)
+    try:
+        if args.command == "runs":
+            show_runs(db, args.limit)
+        elif args.command == "trend":
+            show_trend(db, args.check, args.days, args.host)
+        elif args.command == "top-domains":
+            show_new_domains(db, args.days, args.top, args.check)
+        else:
+            show_domain(db, args.domain, args.days)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
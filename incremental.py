@@ -0,0 +1,274 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import json
+import os
+from instrument import QueryStats
+from checks import (
+    build_check_query,
+    finish_check,
+    iter_rows,
+    print_orphans,
+    quote,
+    report_query_error,
+    wants_cleanup,
+)
+
+# Fingerprint key used for checks that can't be split by domain.
+WHOLE_TABLE = "*"
+
+# Number of domains re-checked per query.
+DOMAIN_BATCH_SIZE = 500
+
+# Above this share of changed domains, one full query beats many small ones.
+FULL_RUN_RATIO = 0.5
+
+
+def get_state_file():
+    """
+    Returns the path of the file incremental runs keep their state in, read
+    from the STATE_FILE environment variable.
+    """
+    load_dotenv()
+    return os.getenv("STATE_FILE") or ".nsanity-state.json"
+
+
+def load_state(path):
+    """
+    Loads the fingerprints and results saved by the last incremental run.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        print(f"Ignoring unreadable state file {path}: {e}")
+        return {}
+
+
+def save_state(path, state):
+    """
+    Writes the state file, replacing the old one only once the new one is
+    complete so an interrupted run can't leave a half-written file behind.
+    """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(state, f, default=str)
+    os.replace(temp_path, path)
+
+
+def domain_of(value):
+    """
+    Returns the fingerprint key for a domain value. Domains compare
+    case-insensitively in the database, so they are lowercased here too.
+    """
+    return value.lower() if isinstance(value, str) else str(value)
+
+
+def fetch_fingerprints(connection, table, group_column, columns, cache):
+    """
+    Returns {domain: [row count, checksum]} for a table, where the checksum is
+    the sum of CRC32 over the given columns of every row in that domain. With no
+    group_column the whole table gets a single fingerprint. Rows with a NULL
+    domain are left out; they are re-checked on every run.
+    Results are cached per run since several checks share tables.
+    """
+    cache_key = (table, group_column, columns)
+    if cache_key in cache:
+        return cache[cache_key]
+
+    checksum = f"SUM(CRC32(CONCAT_WS('|', {', '.join(quote(c) for c in columns)})))"
+    if group_column:
+        query = (
+            f"SELECT {quote(group_column)}, COUNT(*), {checksum} "
+            f"FROM {quote(table)} WHERE {quote(group_column)} IS NOT NULL "
+            f"GROUP BY {quote(group_column)}"
+        )
+    else:
+        query = f"SELECT '{WHOLE_TABLE}', COUNT(*), {checksum} FROM {quote(table)}"
+
+    fingerprints = {}
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(query)
+        for domain, count, total in iter_rows(cursor):
+            fingerprints[domain_of(domain)] = [count, str(total)]
+    finally:
+        cursor.close()
+
+    cache[cache_key] = fingerprints
+    return fingerprints
+
+
+def check_fingerprints(connection, spec, cache):
+    """
+    Fingerprints the child and parent tables of a check, split by domain when
+    the check joins on one.
+    """
+    child_domain, parent_domain = spec.domain_key or (None, None)
+    child_columns = [child for child, _ in spec.keys]
+    child_columns += [column for column, _, _ in spec.exclusions]
+    if spec.columns != ("*",):
+        child_columns += spec.columns
+    child_columns = tuple(dict.fromkeys(child_columns))
+    parent_columns = tuple(parent for _, parent in spec.keys)
+    return {
+        "child": fetch_fingerprints(
+            connection, spec.child_table, child_domain, child_columns, cache
+        ),
+        "parent": fetch_fingerprints(
+            connection, spec.parent_table, parent_domain, parent_columns, cache
+        ),
+    }
+
+
+def changed_domains(old, new):
+    """
+    Returns the domains whose child or parent fingerprint differs between two
+    runs, including domains that appeared or disappeared.
+    """
+    changed = set()
+    for side in ("child", "parent"):
+        before = old.get(side, {})
+        after = new[side]
+        for domain in set(before) | set(after):
+            if before.get(domain) != after.get(domain):
+                changed.add(domain)
+    return changed
+
+
+def query_orphans(connection, spec, conditions=(), params=()):
+    """
+    Runs a check's anti-join, optionally restricted by extra conditions, and
+    returns the orphan rows.
+    """
+    query, query_params = build_check_query(spec, conditions, params)
+    cursor = connection.cursor(dictionary=True, buffered=False)
+    try:
+        cursor.execute(query, query_params)
+        return list(iter_rows(cursor))
+    finally:
+        cursor.close()
+
+
+def group_by_domain(spec, rows):
+    """
+    Groups orphan rows by the fingerprint key of their domain.
+    """
+    grouped = {}
+    child_domain = spec.domain_key[0] if spec.domain_key else None
+    for row in rows:
+        if child_domain:
+            domain = row.get(child_domain)
+            domain = None if domain is None else domain_of(domain)
+        else:
+            domain = WHOLE_TABLE
+        grouped.setdefault(domain, []).append(row)
+    return grouped
+
+
+def recheck_domains(connection, spec, domains):
+    """
+    Re-runs a check's anti-join for the given domains only, plus the rows that
+    have no domain at all. Returns the orphan rows grouped by domain.
+    """
+    column = f"c.{quote(spec.domain_key[0])}"
+    rows = query_orphans(connection, spec, [f"{column} IS NULL"])
+    domains = sorted(domains)
+    for start in range(0, len(domains), DOMAIN_BATCH_SIZE):
+        batch = domains[start : start + DOMAIN_BATCH_SIZE]
+        placeholders = ", ".join(["%s"] * len(batch))
+        rows += query_orphans(
+            connection, spec, [f"{column} IN ({placeholders})"], batch
+        )
+    grouped = group_by_domain(spec, rows)
+    return grouped, grouped.pop(None, [])
+
+
+def run_incremental_check(connection, spec, previous, cache):
+    """
+    Works out a check's orphans, re-running the anti-join only for domains whose
+    fingerprints changed since the last run and carrying forward the saved
+    results for the rest. Returns the new saved state and the orphan rows.
+    """
+    fingerprints = check_fingerprints(connection, spec, cache)
+    orphans = {}
+    unplaced = []
+
+    if not previous:
+        print("No earlier results, checking everything.")
+        changed = None
+    else:
+        changed = changed_domains(previous["fingerprints"], fingerprints)
+        orphans = {
+            domain: rows
+            for domain, rows in previous["orphans"].items()
+            if domain not in changed
+        }
+        total = len(set(fingerprints["child"]) | set(fingerprints["parent"]))
+        if not spec.domain_key:
+            if changed:
+                print("Tables changed since the last run, checking everything.")
+                changed = None
+            else:
+                print("No changes since the last run.")
+        else:
+            print(f"Re-checking {len(changed)} of {total} domains.")
+            if len(changed) > total * FULL_RUN_RATIO:
+                changed = None
+
+    if changed is None:
+        grouped = group_by_domain(spec, query_orphans(connection, spec))
+        unplaced = grouped.pop(None, [])
+        orphans = grouped
+    elif spec.domain_key:
+        grouped, unplaced = recheck_domains(connection, spec, changed)
+        orphans.update(grouped)
+
+    state = {"fingerprints": fingerprints, "orphans": orphans}
+    rows = [row for domain in sorted(orphans) for row in orphans[domain]]
+    return state, rows + unplaced
+
+
+def run_incremental(connection, specs, run_cleanup=True, skip=None, record=None):
+    """
+    Runs the given checks incrementally. Each table involved is fingerprinted
+    per domain (row count plus a checksum of its key columns); only domains
+    whose fingerprints changed since the last run are re-checked and everything
+    else is carried forward from the state file.
+    skip, if given, is called with each check's name first and skips the
+    check if it returns True (see Scheduler.skip); record, if given, is
+    called with the name and status of each check that timed out (see
+    Scheduler.record).
+    Returns a list of (spec, orphans) for checks whose orphans were kept for
+    cleanup.
+    """
+    path = get_state_file()
+    state = load_state(path)
+    cache = {}
+    kept = []
+    for spec in specs:
+        if skip and skip(spec.name):
+            continue
+        print(f"\nRunning {spec.name}...")
+        stats = QueryStats(spec.name)
+        stats.start(connection)
+        try:
+            state[spec.name], rows = run_incremental_check(
+                connection, spec, state.get(spec.name), cache
+            )
+        except Error as e:
+            report_query_error(spec, e, stats)
+            if record and stats.status == "timed out":
+                record(spec.name, stats.status)
+            state.pop(spec.name, None)
+            continue
+        keep = wants_cleanup(spec)
+        missing_entries = print_orphans(spec, stats.count_rows(rows), keep=keep)
+        stats.stop(connection)
+        missing_entries = finish_check(spec, missing_entries, run_cleanup, stats)
+        if missing_entries:
+            kept.append((spec, missing_entries))
+
+    save_state(path, state)
+    return kept
@@ -0,0 +1,106 @@
+from mysql.connector import Error
+import time
+
+# Errors of a query stopped for running too long: killed with KILL QUERY,
+# or past MariaDB's max_statement_time or MySQL's max_execution_time.
+QUERY_TIMEOUT_ERRORS = (1317, 1969, 3024)
+
+# Session status counters sampled before and after each check.
+STATUS_QUERY = (
+    "SHOW SESSION STATUS WHERE Variable_name LIKE 'Handler_read%' "
+    "OR Variable_name IN ('Rows_read', 'Rows_sent', 'Bytes_sent')"
+)
+
+
+def session_status(connection):
+    """
+    Returns the session's row and handler counters, or an empty dict if the
+    server won't tell us.
+    """
+    cursor = connection.cursor(buffered=True)
+    try:
+        cursor.execute(STATUS_QUERY)
+        return {name: int(value) for name, value in cursor.fetchall()}
+    except (Error, ValueError):
+        return {}
+    finally:
+        cursor.close()
+
+
+def human_bytes(count):
+    """
+    Formats a byte count for the stats line.
+    """
+    for unit in ("B", "KB", "MB", "GB"):
+        if count < 1024 or unit == "GB":
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+
+
+class QueryStats:
+    """
+    Measures one check: wall time, orphan rows returned, and how the server's
+    session counters (bytes sent, rows read, Handler_read_*) moved while it ran.
+    Counters are per connection, so checks running in parallel on other
+    connections do not show up in each other's deltas.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.elapsed = 0.0
+        self.deltas = {}
+        self.before = {}
+        self.started = None
+        # "ok", "timed out" if the check ran past its time budget, or
+        # "counted"/"sampled" if it didn't read every orphan on purpose.
+        self.status = "ok"
+
+    def start(self, connection):
+        self.before = session_status(connection)
+        self.started = time.monotonic()
+
+    def count_rows(self, rows):
+        """
+        Passes rows through, counting them on the way.
+        """
+        for row in rows:
+            self.rows += 1
+            yield row
+
+    def stop(self, connection):
+        self.elapsed = time.monotonic() - self.started
+        after = session_status(connection)
+        self.deltas = {
+            name: after[name] - self.before.get(name, 0)
+            for name in after
+            if after[name] != self.before.get(name, 0)
+        }
+
+    @property
+    def bytes_sent(self):
+        return self.deltas.get("Bytes_sent", 0)
+
+    @property
+    def rows_examined(self):
+        if "Rows_read" in self.deltas:
+            return self.deltas["Rows_read"]
+        return sum(v for k, v in self.deltas.items() if k.startswith("Handler_read"))
+
+    def report(self):
+        line = f"[{self.name}] {self.elapsed:.2f}s, {self.rows} rows"
+        if self.status != "ok":
+            line += f", {self.status}"
+        if self.deltas:
+            line += (
+                f", {human_bytes(self.bytes_sent)} transferred,"
+                f" {self.rows_examined} rows examined"
+            )
+            handlers = [
+                f"{name}={value}"
+                for name, value in sorted(self.deltas.items())
+                if name.startswith("Handler_read")
+            ]
+            if handlers:
+                line += f" ({', '.join(handlers)})"
+        print(line)
@@ -0,0 +1,229 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import os
+from replicas import replica_config
+from instrument import QueryStats, session_status
+from checks import (
+    Row,
+    build_exclusions,
+    finish_check,
+    iter_rows,
+    print_orphans,
+    quote,
+    report_query_error,
+    wants_cleanup,
+)
+
+# Prefix of the sort key columns added to the child rows; removed again
+# before the orphans are reported.
+KEY_ALIAS = "_merge_key"
+
+
+def get_table_hosts():
+    """
+    Returns {table: host} for tables that live on another server than NSHOST,
+    read from the TABLE_HOSTS environment variable as comma-separated
+    table=host pairs, e.g. "registrar_config=db2.example.com".
+    """
+    load_dotenv()
+    hosts = {}
+    for pair in (os.getenv("TABLE_HOSTS") or "").split(","):
+        table, _, host = pair.partition("=")
+        if table.strip() and host.strip():
+            hosts[table.strip()] = host.strip()
+    return hosts
+
+
+def open_side(table, connection):
+    """
+    Opens a connection for one side of a check: to its table's TABLE_HOSTS
+    entry if it has one, otherwise to the server the check itself runs on,
+    which is a replica when REPLICAS are configured (see replicas.py).
+    """
+    from nsanity import get_db_config, get_db_connection
+
+    config = get_db_config()
+    host = get_table_hosts().get(table)
+    if host:
+        return get_db_connection(replica_config(config, host))
+    if getattr(connection, "server_host", None):
+        config = {**config, "host": connection.server_host}
+        if getattr(connection, "server_port", None):
+            config["port"] = connection.server_port
+    return get_db_connection(config)
+
+
+def sort_keys(columns, alias):
+    """
+    Returns the select list of a side's sort keys. Every key column is
+    normalized like the default collation compares it (lowercased, trailing
+    spaces stripped) and sent as hex, so the server sorts it by its bytes and
+    the client can compare it as a plain string in exactly the same order,
+    whatever the collation. Both sides must use the same character set.
+    """
+    return [
+        f"HEX(RTRIM(LOWER({alias}.{quote(column)}))) AS {KEY_ALIAS}{index}"
+        for index, column in enumerate(columns)
+    ]
+
+
+def build_merge_queries(spec):
+    """
+    Returns the child query (reported columns and sort keys, exclusions
+    applied, with its parameters) and the parent query (non-NULL sort keys),
+    both ordered by the keys.
+    """
+    if spec.columns == ("*",):
+        select = ["c.*"]
+    else:
+        select = [f"c.{quote(column)}" for column in spec.columns]
+    child_keys = sort_keys([child for child, _ in spec.keys], "c")
+    parent_keys = sort_keys([parent for _, parent in spec.keys], "p")
+    order = ", ".join(f"{KEY_ALIAS}{index}" for index in range(len(spec.keys)))
+
+    conditions, params = build_exclusions(spec)
+    where = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    child_query = (
+        f"SELECT {', '.join(select + child_keys)} "
+        f"FROM {quote(spec.child_table)} c {where}ORDER BY {order}"
+    )
+    not_null = " AND ".join(f"p.{quote(parent)} IS NOT NULL" for _, parent in spec.keys)
+    parent_query = (
+        f"SELECT {', '.join(parent_keys)} "
+        f"FROM {quote(spec.parent_table)} p WHERE {not_null} ORDER BY {order}"
+    )
+    return (child_query, params), parent_query
+
+
+def in_order(rows, key):
+    """
+    Passes sorted rows through, raising ValueError if one comes out of order,
+    which would make the merge report wrong orphans.
+    """
+    previous = None
+    for row in rows:
+        current = key(row)
+        if previous is not None and current < previous:
+            raise ValueError(f"keys out of order: {current} after {previous}")
+        previous = current
+        yield row
+
+
+def merge_anti_join(child_rows, parent_keys, width):
+    """
+    Yields the child rows whose key (their last width values) has no match
+    among the parent keys. Both must be sorted by key; each is read once,
+    front to back, so only the current row of each side is held. Rows with a
+    NULL key never match.
+    """
+    parents = in_order(parent_keys, tuple)
+    parent = next(parents, None)
+    for row in in_order(child_rows, lambda row: tuple(v or "" for v in row[-width:])):
+        key = tuple(row[-width:])
+        if None in key:
+            yield row
+            continue
+        while parent is not None and tuple(parent) < key:
+            parent = next(parents, None)
+        if parent is None or tuple(parent) != key:
+            yield row
+
+
+def close_side(cursor, connection):
+    """
+    Closes one side's cursor. The merge stops reading a side once the other
+    runs out, usually the parent when no orphans sort last, and an unbuffered
+    cursor can't be closed with rows still on the way ("Unread result
+    found"), so those are read and dropped first. That also leaves a pooled
+    connection fit for the next check.
+    """
+    try:
+        if getattr(connection, "unread_result", False):
+            connection.consume_results()
+    finally:
+        cursor.close()
+
+
+def merge_sides(spec, stats, keep, child_connection, parent_connection):
+    """
+    Streams both sides of a check and sends its orphans to the output. The
+    parent connection's session counters are added to the stats.
+    Returns the orphan rows if keep is True.
+    """
+    stats.start(child_connection)
+    parent_before = session_status(parent_connection)
+    child = child_connection.cursor(buffered=False)
+    parent = parent_connection.cursor(buffered=False)
+    (child_query, params), parent_query = build_merge_queries(spec)
+    width = len(spec.keys)
+    try:
+        child.execute(child_query, params)
+        parent.execute(parent_query)
+        names = child.column_names[:-width]
+        positions = {name: index for index, name in enumerate(names)}
+        orphans = merge_anti_join(iter_rows(child), iter_rows(parent), width)
+        missing_entries = print_orphans(
+            spec,
+            stats.count_rows(Row(positions, tuple(row[:-width])) for row in orphans),
+            keep=keep,
+        )
+    finally:
+        try:
+            close_side(child, child_connection)
+        finally:
+            close_side(parent, parent_connection)
+    stats.stop(child_connection)
+    for name, value in session_status(parent_connection).items():
+        delta = value - parent_before.get(name, 0)
+        if delta:
+            stats.deltas[name] = stats.deltas.get(name, 0) + delta
+    return missing_entries
+
+
+def run_merge(
+    connection, spec, run_cleanup=True, stats=None, connect=open_side, limit=None
+):
+    """
+    Runs a check as a merge anti-join over two connections, one per table,
+    so it works when the tables live on different servers (see TABLE_HOSTS).
+    The child side runs on the given connection unless its table is mapped
+    elsewhere, and the parent side on the same server unless its table is.
+    Both sides stream their keys in order through unbuffered cursors, so
+    client memory stays flat however big the tables are. limit, if given,
+    puts the connections opened here under the check's time budget (see
+    Scheduler.limiter).
+    """
+    keep = wants_cleanup(spec)
+    stats = stats or QueryStats(spec.name)
+    child_connection = connection
+    if spec.child_table in get_table_hosts():
+        child_connection = connect(spec.child_table, connection)
+    parent_connection = connect(spec.parent_table, connection)
+    budgets = []
+    try:
+        if not (child_connection and parent_connection):
+            print(f"Can't connect to both sides of {spec.name}.")
+            return None
+        if limit:
+            for side in (child_connection, parent_connection):
+                if side is not connection:
+                    budgets.append(limit(side))
+        missing_entries = merge_sides(
+            spec, stats, keep, child_connection, parent_connection
+        )
+    except Error as e:
+        report_query_error(spec, e, stats)
+        return None
+    except ValueError as e:
+        print(f"Error executing query: {e}")
+        return None
+    finally:
+        for budget in budgets:
+            budget.stop()
+        try:
+            if parent_connection:
+                parent_connection.close()
+        finally:
+            if child_connection and child_connection is not connection:
+                child_connection.close()
+    return finish_check(spec, missing_entries, run_cleanup, stats)
@@ -1,527 +1,763 @@
 import mysql.connector
 from mysql.connector import Error
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
+import argparse
+import dataclasses
+import functools
+import io
 import os
-from cleanup import cleanup_callqueue_agents
+import sys
+import threading
+import time
+import checks
+from checks import CHECKS, CHECKS_BY_NAME, run_check
+from cleanup import get_api_stats, write_cleanup_plan
+from chunked import run_chunked
+from counts import run_count
+from explain import explain_checks
+from incremental import run_incremental
+from merge import run_merge
+from history import HistoryOutput, get_history_file
+from cascade import run_cascade
+from purge import PURGEABLE_CHECKS, Purger
+from offline import export_snapshot, get_snapshot_dir, run_offline
+from output import (
+    OUTPUT_FORMATS,
+    DeltaOutput,
+    get_base_output,
+    make_output,
+    set_output,
+)
+from sharded import run_sharded
+from scheduler import Scheduler, get_schedule_settings
+from replicas import get_replica_settings, route_checks
+from sampled import run_sampled
+from snapshot import run_snapshot
+
+CHECK_MODES = (
+    "join",
+    "snapshot",
+    "chunked",
+    "incremental",
+    "offline",
+    "sharded",
+    "cascade",
+    "merge",
+    "count",
+    "sample",
+)
+
+# mysql.connector refuses pools larger than this.
+MAX_POOL_SIZE = 32
+
+# Characters a parallel check may print before what it printed is passed on
+# instead of held until it finishes.
+CAPTURE_LIMIT = 64 * 1024
+
+
+def get_db_config():
+    """
+    Loads database credentials from the .env file and returns them as
+    keyword arguments for mysql.connector.
+    """
+    load_dotenv()  # Load environment variables from .env
+    return {
+        "host": os.getenv("NSHOST"),
+        "user": os.getenv("DBUSER"),
+        "password": os.getenv("DBPASS"),
+        "database": "SiPbxDomain",
+    }
 
 
-def get_db_connection():
+def get_db_connection(config=None):
     """
     Loads database credentials from the .env file and establishes a connection
-    to the SiPbxDomain database.
+    to the SiPbxDomain database, or to the server in config if given.
     """
-    load_dotenv()  # Load environment variables from .env
-    host = os.getenv("NSHOST")
-    user = os.getenv("DBUSER")
-    password = os.getenv("DBPASS")
-    database = "SiPbxDomain"
-
+    config = config or get_db_config()
     try:
-        connection = mysql.connector.connect(
-            host=host, user=user, password=password, database=database
-        )
+        connection = mysql.connector.connect(**config)
         if connection.is_connected():
-            print("Connected to MariaDB database")
+            print(f"Connected to MariaDB database on {config['host']}")
             return connection
     except Error as e:
         print(f"Error while connecting to database: {e}")
     return None
 
 
-def check_dial_rules_have_dialplan(connection):
+def get_db_pool(pool_size, config=None):
     """
-    Checks that every entry in the dialplan_config table has a corresponding
-    entry in the dialplans table based on the 'dialplan' field.
-    Prints out orphan entries where the parent dialplan is missing.
-    """
-    cursor = connection.cursor(dictionary=True)
-
-    # Using a LEFT JOIN to find orphan entries in dialplan_config.
-    query = """
-        SELECT 
-            c.dialplan,
-            c.matchrule, 
-            c.responder, 
-            c.domain, 
-            c.plan_description 
-        FROM dialplan_config c
-        LEFT JOIN dialplans d ON c.dialplan = d.dialplan
-        WHERE d.dialplan IS NULL;
+    Creates a pool of connections to the SiPbxDomain database (or the server in
+    config) so that several checks can run at the same time, each on its own
+    connection.
     """
+    config = config or get_db_config()
+    pool_size = max(1, min(pool_size, MAX_POOL_SIZE))
     try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print(
-                "Orphan entries found in dialplan_config (no matching dialplan in dialplans):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-
-        else:
-            print(
-                "All entries in dialplan_config have corresponding dialplan entries in dialplans."
-            )
+        pool = pooling.MySQLConnectionPool(
+            pool_name=f"nsanity-{config['host']}", pool_size=pool_size, **config
+        )
+        print(
+            f"Created MariaDB connection pool with {pool_size} connections"
+            f" to {config['host']}"
+        )
+        return pool
     except Error as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
-
-
-def check_dialplans_have_domain(connection):
-    """
-    Checks that every entry in the dialplans table has a corresponding entry
-    in the domains_config table based on the 'domain' field.
-    Orphan entries are those where the parent domain is missing.
-    The check ignores entries where the dialplan is in a predefined ignore list.
-    All columns from the dialplans table are selected.
-    Also prints the number of orphan entries found at the bottom.
-    """
-    cursor = connection.cursor(dictionary=True)
-
-    # Define the list of dialplan entries to ignore
-    ignore_list = [
-        "To Connection",
-        "Default",
-        "Inbound DID",
-        "DID Table",
-        "AA-Basic",
-        "Restricted",
-        "Starcodes",
-        "From Load Balanced Peer",
-        "Asserted_Defaults",
-        "Lower_Case_Defaults",
-        "To Connection - Forward",
-        "fwd-check",
-        "Default STIR SHAKEN",
-        "Cloud PBX Features",
-        "Forward Blocking",
-        "Default_New",
-    ]
-
-    # Create a string with comma-separated quoted ignore values
-    ignore_values = ", ".join(f"'{item}'" for item in ignore_list)
-
-    query = f"""
-        SELECT
-            d.*
-        FROM dialplans d
-        LEFT JOIN domains_config dc ON d.domain = dc.domain
-        WHERE dc.domain IS NULL
-          AND d.dialplan NOT IN ({ignore_values});
-    """
-
-    try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print("Orphan entries in dialplans (no matching domain in domains_config):")
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in dialplans have corresponding domain entries in domains_config."
-            )
-    except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
+        print(f"Error while creating connection pool: {e}")
+    return None
 
 
-def check_domains_have_reseller(connection):
+def get_check_configs():
     """
-    Checks that every entry in domains_config has a corresponding territory in the territories table.
-    Specifically, it verifies that the 'territory' value in domains_config exists in the territories table.
-    Only the columns 'domain', 'territory', and 'description' are selected.
-    Orphan entries (with no matching territory) are printed followed by the total count.
+    Returns the connection settings of the servers to run checks on: the
+    healthy REPLICAS, least lagged first, if any are configured (see
+    replicas.py), otherwise NSHOST. Empty if no server is usable.
     """
-    cursor = connection.cursor(dictionary=True)
-
-    query = """
-        SELECT 
-            dc.domain, 
-            dc.territory, 
-            dc.description
-        FROM domains_config dc
-        LEFT JOIN territories t ON dc.territory = t.territory
-        WHERE t.territory IS NULL;
-    """
-
-    try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
+    settings = get_replica_settings()
+    if not settings["hosts"]:
+        return [get_db_config()]
+    return route_checks(get_db_config(), settings)
 
-        if missing_entries:
-            print(
-                "Orphan entries in domains_config (no matching territory in territories):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in domains_config have a corresponding territory in territories."
-            )
-    except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
 
-
-def check_huntgroup_agents_have_huntgroup(connection):
-    """
-    Checks that every entry in the huntgroup_entry_config table has a corresponding entry
-    in the huntgroup_config table by comparing the 'huntgroup_name' and 'huntgroup_domain' columns.
-    Only the columns 'device_aor', 'huntgroup_name', and 'huntgroup_domain' are selected from huntgroup_entry_config.
-    Orphan entries (where no matching huntgroup exists in huntgroup_config) are printed followed by the total count.
+def get_worker_count():
     """
-    cursor = connection.cursor(dictionary=True)
-
-    query = """
-        SELECT 
-            hec.device_aor, 
-            hec.huntgroup_name, 
-            hec.huntgroup_domain
-        FROM huntgroup_entry_config hec
-        LEFT JOIN huntgroup_config hc 
-            ON hec.huntgroup_name = hc.huntgroup_name 
-           AND hec.huntgroup_domain = hc.huntgroup_domain
-        WHERE hc.huntgroup_name IS NULL;
+    Returns the number of checks to run at once, read from the WORKERS
+    environment variable. Defaults to 1 (run checks one after another), and
+    is capped at MAX_POOL_SIZE, the most connections a pool can hold.
     """
-
+    load_dotenv()
     try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print(
-                "Orphan entries in huntgroup_entry_config (no matching huntgroup in huntgroup_config):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-            # only run cleanup if the APIKEY env is set
-            if os.getenv("APIKEY"):
-                cleanup_callqueue_agents(missing_entries)
-        else:
-            print(
-                "All entries in huntgroup_entry_config have a corresponding huntgroup in huntgroup_config."
-            )
+        workers = max(1, int(os.getenv("WORKERS") or 1))
+    except ValueError:
+        print("WORKERS must be a number, running checks one at a time.")
+        return 1
+    if workers > MAX_POOL_SIZE:
+        print(f"WORKERS can be at most {MAX_POOL_SIZE}, using {MAX_POOL_SIZE}.")
+        return MAX_POOL_SIZE
+    return workers
+
+
+def get_check_mode():
+    """
+    Returns how checks are run, read from the MODE environment variable:
+    "join" (default) runs one LEFT JOIN query per check on the server,
+    "snapshot" reads each table once and checks the keys client-side,
+    "chunked" runs each check's join over small key ranges with pauses between,
+    "incremental" only re-checks domains that changed since the last run,
+    "offline" checks a snapshot exported with --export, without a database,
+    "sharded" splits each check by domain over WORKERS connections,
+    "cascade" reads each table once and groups the orphans by root cause,
+    "merge" streams both sides of each check in key order over their own
+    connections, for tables on different servers (see TABLE_HOSTS),
+    "count" only counts each check's orphans per domain on the server,
+    "sample" fetches at most SAMPLE_ROWS orphans per check.
+    """
+    load_dotenv()
+    mode = (os.getenv("MODE") or "join").lower()
+    if mode not in CHECK_MODES:
+        print(f"Unknown MODE {mode!r}, using join.")
+        return "join"
+    return mode
+
+
+class ThreadOutput:
+    """
+    Stand-in for sys.stdout that lets each worker thread collect what it prints
+    into its own buffer, so a check's output comes out as one block. Once a
+    check has printed more than limit characters, such as a long orphan
+    listing, its whole lines are passed on each time the buffer fills, so
+    memory stays flat; they can land between other checks' blocks, so each is
+    prefixed with the name given to start_capture. Threads that are not
+    capturing write straight through to the real stream, under the same lock.
+    """
+
+    def __init__(self, stream, limit=CAPTURE_LIMIT):
+        self.stream = stream
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start_capture(self, name=None):
+        self.local.buffer = io.StringIO()
+        self.local.name = name
+        self.local.passed_on = False
+
+    def stop_capture(self):
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return self.prefix(text) if self.local.passed_on else text
+
+    def prefix(self, text):
+        if not self.local.name:
+            return text
+        return "".join(f"[{self.local.name}] {line}" for line in text.splitlines(True))
+
+    def pass_on(self):
+        """
+        Writes the whole lines in the thread's buffer to the stream, keeping
+        the unfinished last line.
+        """
+        buffer = self.local.buffer
+        text = buffer.getvalue()
+        end = text.rfind("\n") + 1
+        if not end:
+            return
+        buffer.seek(0)
+        buffer.truncate()
+        buffer.write(text[end:])
+        self.local.passed_on = True
+        with self.lock:
+            self.stream.write(self.prefix(text[:end]))
+            self.stream.flush()
+
+    def write(self, text):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            with self.lock:
+                return self.stream.write(text)
+        count = buffer.write(text)
+        if buffer.tell() > self.limit:
+            self.pass_on()
+        return count
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+
+def get_check_runner(mode):
+    """
+    Returns the function that runs a single check in the given mode.
+    """
+    if mode == "chunked":
+        return run_chunked
+    if mode == "merge":
+        return run_merge
+    if mode == "count":
+        return run_count
+    if mode == "sample":
+        return run_sampled
+    return run_check
+
+
+def get_pooled_connection(pools):
+    """
+    Returns a connection from the first of pools with one free, so checks
+    go to whichever server has room when they start. Pools are given least
+    lagged server first.
+    """
+    for pool in pools:
+        try:
+            return pool.get_connection()
+        except PoolError:
+            continue
+    raise PoolError("every connection pool is exhausted")
+
+
+def run_check_in_worker(pools, output, spec, runner=run_check):
+    """
+    Runs a single check on its own connection from one of the pools. Returns
+    what it printed that wasn't passed on yet (see ThreadOutput) as one block
+    of text, plus any orphans kept for cleanup.
+    """
+    output.start_capture(spec.name)
+    missing_entries = None
+    try:
+        print(f"\nRunning {spec.name}...")
+        connection = get_pooled_connection(pools)
+        try:
+            missing_entries = runner(connection, spec, run_cleanup=False)
+        finally:
+            connection.close()  # returns the connection to the pool
     except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
-
-
-def check_huntgroups_have_callqueues(connection):
-    """
-    Checks that every entry in huntgroup_config has a corresponding call queue entry
-    in callqueue_config by comparing 'huntgroup_name' and 'huntgroup_domain' from huntgroup_config
-    with 'queue_name' and 'domain' in callqueue_config.
-    Only the columns 'huntgroup_name' and 'huntgroup_domain' are selected from huntgroup_config.
-    Orphan entries (with no matching callqueue) are printed followed by the total count.
-    """
-    cursor = connection.cursor(dictionary=True)
-
-    query = """
-        SELECT 
-            hc.huntgroup_name,
-            hc.huntgroup_domain
-        FROM huntgroup_config hc
-        LEFT JOIN callqueue_config cc 
-            ON hc.huntgroup_name = cc.queue_name 
-           AND hc.huntgroup_domain = cc.domain
-        WHERE cc.queue_name IS NULL;
-    """
+        print(f"Error running {spec.name}: {e}")
+    return output.stop_capture(), missing_entries
+
+
+def get_check_pools(configs, workers):
+    """
+    Creates the connection pools for running checks in parallel: one per
+    server in configs (up to workers of them), sharing the workers between
+    them. Returns None if a pool can't be created.
+    """
+    configs = (configs or [get_db_config()])[:workers]
+    pools = []
+    for config in configs:
+        pool = get_db_pool(-(-workers // len(configs)), config)
+        if not pool:
+            print("Failed to create the connection pool. Exiting.")
+            return None
+        pools.append(pool)
+    return pools
+
+
+def run_checks_parallel(
+    sanity_checks, workers, runner=run_check, configs=None, pools=None
+):
+    """
+    Runs the given checks concurrently, each on its own connection from a pool
+    of `workers` connections. With several servers in configs there is one
+    pool per server, and each check takes a connection from the first with
+    one free when it starts. Pass pools to reuse ones made by
+    get_check_pools. Each check's output is printed as one block as soon as
+    that check finishes, or in prefixed pieces while it runs if it is long.
+    Interactive cleanups are held back until every check is done so their
+    prompts don't interleave with other checks.
+    """
+    workers = min(workers, len(sanity_checks))
+    pools = pools or get_check_pools(configs, workers)
+    if not pools:
+        return
 
+    output = ThreadOutput(sys.stdout)
+    cleanups = []
+    sys.stdout = output
     try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print(
-                "Orphan entries in huntgroup_config (no matching callqueue in callqueue_config):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in huntgroup_config have corresponding callqueue entries in callqueue_config."
-            )
-    except Exception as e:
-        print(f"Error executing query: {e}")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(run_check_in_worker, pools, output, spec, runner): spec
+                for spec in sanity_checks
+            }
+            for future in as_completed(futures):
+                text, missing_entries = future.result()
+                print(text, end="", flush=True)
+                if missing_entries:
+                    cleanups.append((futures[future], missing_entries))
     finally:
-        cursor.close()
-
-
-def check_callqueues_have_users(connection):
-    """
-    Checks that every entry in callqueue_config has a corresponding entry in subscriber_config
-    by comparing 'queue_name' and 'domain' in callqueue_config with 'aor_user' and 'aor_host' in subscriber_config.
-    Only the columns 'queue_name' and 'domain' are selected from callqueue_config.
-    Orphan entries (with no matching subscriber entry) are printed followed by the total count.
-    """
-    cursor = connection.cursor(dictionary=True)
-
-    query = """
-        SELECT
-            cc.queue_name,
-            cc.domain
-        FROM callqueue_config cc
-        LEFT JOIN subscriber_config sc
-            ON cc.queue_name = sc.aor_user
-           AND cc.domain = sc.aor_host
-        WHERE sc.aor_user IS NULL;
+        sys.stdout = output.stream
+
+    for spec, missing_entries in cleanups:
+        spec.cleanup(missing_entries)
+
+
+def parse_args():
+    """
+    Parses the command line options. Without --check or --all, the checks to
+    run are picked from the interactive menu.
+    """
+    parser = argparse.ArgumentParser(
+        description="Finds orphaned entries in the NetSapiens SiPbxDomain database."
+    )
+    parser.add_argument(
+        "--check",
+        action="append",
+        dest="checks",
+        choices=[spec.name for spec in CHECKS],
+        metavar="NAME",
+        help="run this check (can be given more than once, see --list)",
+    )
+    parser.add_argument("--all", action="store_true", help="run every check")
+    parser.add_argument(
+        "--list", action="store_true", help="list the available checks and exit"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=CHECK_MODES,
+        help="how to run the checks (default: MODE from .env, or join)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="checks to run at once (default: WORKERS from .env, or 1)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="text",
+        help="print orphans to the terminal (text) or write them to files",
+    )
+    parser.add_argument(
+        "--output",
+        default="nsanity-output",
+        metavar="DIR",
+        help="directory for jsonl/csv/parquet files (default: nsanity-output)",
+    )
+    parser.add_argument(
+        "--combined",
+        action="store_true",
+        help="write all checks to one file instead of one file per check",
+    )
+    parser.add_argument(
+        "--cleanup",
+        action="store_true",
+        help="offer the API cleanup when checks are given with --check/--all",
+    )
+    parser.add_argument(
+        "--cleanup-plan",
+        metavar="FILE",
+        help="write the API cleanup to a plan file instead of running it"
+        " (see cleanup.py apply)",
+    )
+    parser.add_argument(
+        "--purge",
+        action="store_true",
+        help="delete the orphans of the leaf-table checks straight from the"
+        " database, after backing them up (see purge.py restore)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="stop a check running longer than this and report it as timed out"
+        " (default: CHECK_TIMEOUT from .env, or 900; 0 for none)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="SECONDS",
+        help="skip the checks not started this long after the run began"
+        " (default: RUN_DEADLINE from .env, or none)",
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        metavar="SECONDS",
+        help="keep running the checks every SECONDS, reporting only what changed",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="export the key columns the checks need for --mode offline and exit",
+    )
+    parser.add_argument(
+        "--snapshot-dir",
+        metavar="DIR",
+        help="where --export writes and --mode offline reads"
+        " (default: SNAPSHOT_DIR from .env, or nsanity-snapshot)",
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="don't record this run in the history database (HISTORY_DB)",
+    )
+    parser.add_argument(
+        "--watch-history",
+        action="store_true",
+        help="with --watch, record the orphans of every cycle in the history,"
+        " not just the first cycle's",
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="EXPLAIN each selected check first and report missing indexes",
+    )
+    args = parser.parse_args()
+    if args.combined and args.format in ("text", "csv"):
+        parser.error("--combined works with --format jsonl or parquet")
+    if args.workers is not None and not 1 <= args.workers <= MAX_POOL_SIZE:
+        parser.error(f"--workers must be between 1 and {MAX_POOL_SIZE}")
+    if args.purge and (args.cleanup_plan or args.watch):
+        parser.error("--purge can't be combined with --cleanup-plan or --watch")
+    return args
+
+
+def choose_checks(sanity_checks):
+    """
+    Shows the menu of checks and returns the ones picked, or None if the
+    choice was invalid.
     """
+    print("Select a sanity check to run:")
+    print(" 0: Run all checks")
+    for index, spec in enumerate(sanity_checks, start=1):
+        print(f" {index}: {spec.name}")
 
     try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print(
-                "Orphan entries in callqueue_config (no matching subscriber in subscriber_config):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in callqueue_config have corresponding subscribers in subscriber_config."
-            )
-    except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
-
-
-def check_users_have_domain(connection):
-    """
-    Checks that every entry in subscriber_config has a corresponding entry in domains_config
-    by comparing 'aor_host' in subscriber_config with 'domain' in domains_config.
-    Only the columns 'subscriber_login', 'aor_user', and 'aor_host' are selected from subscriber_config.
-    Orphan entries (with no matching domain) are printed followed by the total count.
-    """
-    cursor = connection.cursor(dictionary=True)
+        choice = int(input("Enter your choice: "))
+    except ValueError:
+        print("Invalid input. Please enter a number.")
+        return None
 
-    query = """
-        SELECT
-            sc.subscriber_login,
-            sc.aor_user,
-            sc.aor_host
-        FROM subscriber_config sc
-        LEFT JOIN domains_config dc ON sc.aor_host = dc.domain
-        WHERE dc.domain IS NULL;
-    """
+    if choice == 0:
+        return sanity_checks
+    if 1 <= choice <= len(sanity_checks):
+        return [sanity_checks[choice - 1]]
+    print("Invalid choice.")
+    return None
 
-    try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
 
-        if missing_entries:
-            print(
-                "Orphan entries in subscriber_config (no matching domain in domains_config):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in subscriber_config have corresponding domains in domains_config."
+def run_checks(
+    connection,
+    selected,
+    mode,
+    workers,
+    configs=None,
+    pools=None,
+    snapshot_dir=None,
+    schedule=None,
+):
+    """
+    Runs the selected checks in the given mode. Parallel checks are spread over
+    the servers in configs, or run on the given pools. Every mode runs under
+    the time limits in schedule (see scheduler.py): checks run on their own
+    get a budget each, and run longest first when in parallel; modes that
+    read all the checks' tables over one connection have each statement
+    limited and are stopped at the run deadline. Offline checks have no
+    queries to limit, but still aren't started past the deadline.
+    """
+    scheduler = Scheduler(configs or [get_db_config()], schedule)
+    if mode == "snapshot":
+        # Read every table once and check the keys client-side.
+        with scheduler.session(connection, "snapshot"):
+            run_snapshot(connection, selected, record=scheduler.record)
+    elif mode == "cascade":
+        # Trace every orphan to the missing ancestor behind it.
+        with scheduler.session(connection, "cascade"):
+            run_cascade(connection, selected, record=scheduler.record)
+    elif mode == "incremental":
+        # Re-check only the domains that changed since the last run.
+        with scheduler.session(connection, "incremental"):
+            run_incremental(
+                connection, selected, skip=scheduler.skip, record=scheduler.record
             )
-    except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
+    elif mode == "offline":
+        # Check the exported key columns instead of the database.
+        run_offline(
+            snapshot_dir or get_snapshot_dir(), selected, skip=scheduler.skip
+        )
+    elif mode == "sharded":
+        # Run one check at a time, each split by domain over all the workers.
+        pools = pools or get_check_pools(configs, workers)
+        if not pools:
+            return
+        runner = scheduler.wrap(
+            functools.partial(run_sharded, pools=pools, workers=workers),
+            opens_connections=True,
+        )
+        for spec in selected:
+            print(f"\nRunning {spec.name}...")
+            runner(connection, spec)
+    elif len(selected) > 1 and workers > 1:
+        # Run the sanity checks, several at a time, the slowest first.
+        run_checks_parallel(
+            scheduler.order(selected),
+            workers,
+            scheduler.wrap(get_check_runner(mode), opens_connections=mode == "merge"),
+            configs,
+            pools,
+        )
+    else:
+        runner = scheduler.wrap(
+            get_check_runner(mode), opens_connections=mode == "merge"
+        )
+        for spec in selected:
+            print(f"\nRunning {spec.name}...")
+            runner(connection, spec)
+    scheduler.report()
+
+
+def watch(
+    connection,
+    selected,
+    mode,
+    workers,
+    configs,
+    interval,
+    history=None,
+    snapshot_dir=None,
+    schedule=None,
+):
+    """
+    Runs the checks every interval seconds until interrupted, on the same
+    connection (and pools) throughout. The output should be a DeltaOutput, so
+    after the first cycle only orphans that appeared or were resolved since the
+    cycle before are reported. Each cycle is recorded as its own run in history,
+    with its orphans only if history was made to record them every run.
+    """
+    pools = None
+    if mode == "sharded" or (
+        mode in ("join", "chunked", "merge", "count", "sample")
+        and len(selected) > 1
+        and workers > 1
+    ):
+        # Sharded runs hold a connection per worker whatever the number of
+        # checks, since every check is split over all of them.
+        size = workers if mode == "sharded" else min(workers, len(selected))
+        pools = get_check_pools(configs, size)
+        if not pools:
+            return
+    cycle = 0
+    try:
+        while True:
+            cycle += 1
+            started = time.monotonic()
+            if cycle > 1:
+                get_base_output().start_cycle()
+                if history:
+                    history.start_run()
+            print(f"\n=== Cycle {cycle} at {time.strftime('%Y-%m-%d %H:%M:%S')} ===")
+            try:
+                # Reconnects if the server dropped the connection since last time.
+                if connection:
+                    connection.ping(reconnect=True, attempts=3, delay=5)
+                run_checks(
+                    connection,
+                    selected,
+                    mode,
+                    workers,
+                    configs,
+                    pools,
+                    snapshot_dir,
+                    schedule,
+                )
+            except Error as e:
+                print(f"Cycle {cycle} failed: {e}")
+            get_base_output().finish_cycle()
+            if history:
+                history.finish_run()
+            elapsed = time.monotonic() - started
+            pause = max(0.0, interval - elapsed)
+            print(f"\nCycle {cycle} took {elapsed:.1f}s, next in {pause:.0f}s.")
+            time.sleep(pause)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
 
 
-def check_devices_have_users(connection):
-    """
-    Checks that every entry in registrar_config (representing devices) has a corresponding
-    user in subscriber_config by comparing 'aor_user' and 'aor_host' from registrar_config
-    with 'subscriber_name' and 'subscriber_domain' in subscriber_config.
-    Excludes entries where aor_host is "*" (as these are not applicable).
-    Only the columns 'aor_user' and 'aor_host' from registrar_config are selected.
-    Orphan entries (with no matching subscriber) are printed followed by the total count.
+def main():
     """
-    cursor = connection.cursor(dictionary=True)
-
-    query = """
-        SELECT
-            r.aor,
-            r.subscriber_name,
-            r.subscriber_domain
-        FROM registrar_config r
-        LEFT JOIN subscriber_config s
-            ON r.subscriber_name = s.aor_user
-           AND r.subscriber_domain = s.aor_host
-        WHERE r.subscriber_domain <> '*'
-          AND s.aor_user IS NULL;
+    Main function to establish database connection and run sanity checks.
     """
+    args = parse_args()
 
-    try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print(
-                "Orphan entries in registrar_config (no matching subscriber in subscriber_config):"
-            )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in registrar_config (with aor_host not '*') have corresponding subscribers in subscriber_config."
-            )
-    except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
+    # List of sanity checks, see checks.py.
+    sanity_checks = CHECKS
 
+    if args.list:
+        for spec in sanity_checks:
+            print(f"{spec.name}: {spec.description}")
+        return
 
-def check_timeframes_have_users(connection):
-    """
-    Checks that every entry in time_frame_selections has a corresponding entry
-    in subscriber_config by comparing 'user' and 'domain' in time_frame_selections
-    with 'aor_user' and 'aor_host' in subscriber_config.
-    Only the columns 'user' and 'domain' from time_frame_selections are selected.
-    Orphan entries (with no matching subscriber) are printed followed by the total count.
-    """
-    cursor = connection.cursor(dictionary=True)
+    try:
+        writer = make_output(args.format, args.output, args.combined)
+    except (OSError, RuntimeError) as e:
+        print(f"Can't write {args.format} output: {e}")
+        return
 
-    query = """
-        SELECT
-            tfs.user,
-            tfs.domain,
-            tfs.time_frame_name,
-            tfs.error_info
-        FROM time_frame_selections tfs
-        LEFT JOIN subscriber_config sc
-            ON tfs.user = sc.aor_user
-           AND tfs.domain = sc.aor_host
-        WHERE sc.aor_user IS NULL;
-    """
+    mode = args.mode or get_check_mode()
+    snapshot_dir = args.snapshot_dir or get_snapshot_dir()
+    if mode == "offline" and not args.export:
+        # Offline checks only read the exported snapshot.
+        configs = [{"host": snapshot_dir}]
+        connection = None
+    else:
+        # Checks go to the replicas if there are any; cleanups always use the
+        # API on NSHOST.
+        configs = get_check_configs()
+        if not configs:
+            print("No database to run the checks on. Exiting.")
+            return
+        connection = get_db_connection(configs[0])
+        if not connection:
+            print("Failed to connect to the database. Exiting.")
+            return
+
+    if args.all:
+        selected = sanity_checks
+    elif args.checks:
+        selected = [CHECKS_BY_NAME[name] for name in dict.fromkeys(args.checks)]
+    else:
+        selected = choose_checks(sanity_checks)
+    if not selected:
+        if connection:
+            connection.close()
+        return
 
-    try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
+    if args.export:
+        try:
+            export_snapshot(connection, selected, snapshot_dir)
+        except RuntimeError as e:
+            print(e)
+        finally:
+            connection.close()
+        return
 
-        if missing_entries:
-            print(
-                "Orphan entries in time_frame_selections (no matching subscriber in subscriber_config):"
+    # Unattended runs never stop to ask about cleanups unless told to, and
+    # watch mode never does.
+    if ((args.all or args.checks) and not args.cleanup) or args.watch:
+        checks.cleanup_enabled = False
+
+    # A dry run plans the cleanup without asking anything, to apply later.
+    if args.cleanup_plan:
+        checks.cleanup_enabled = True
+        selected = [
+            (
+                dataclasses.replace(
+                    spec,
+                    cleanup=functools.partial(write_cleanup_plan, args.cleanup_plan),
+                )
+                if spec.cleanup
+                else spec
             )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
-        else:
-            print(
-                "All entries in time_frame_selections have corresponding subscribers in subscriber_config."
+            for spec in selected
+        ]
+
+    # Purging replaces the cleanup of the checks it can handle, and runs
+    # without asking: --purge is the opt-in.
+    if args.purge:
+        checks.cleanup_enabled = True
+        selected = [
+            (
+                dataclasses.replace(spec, cleanup=Purger(spec))
+                if spec.name in PURGEABLE_CHECKS
+                else dataclasses.replace(spec, cleanup=None)
             )
-    except Exception as e:
-        print(f"Error executing query: {e}")
-    finally:
-        cursor.close()
-
-
-def check_answeringrules_have_users(connection):
-    """
-    Checks that every entry in feature_config has a corresponding subscriber in subscriber_config
-    by comparing 'callee_match' in feature_config with 'aor_user' in subscriber_config.
-    Only the columns 'name', 'callee_match', and 'parameters' are selected from feature_config.
-    Orphan entries (with no matching subscriber) are printed followed by the total count.
-    """
-    cursor = connection.cursor(dictionary=True)
-
-    query = """
-        SELECT 
-            fc.name,
-            fc.callee_match,
-            fc.parameters
-        FROM feature_config fc
-        LEFT JOIN subscriber_config sc 
-            ON fc.callee_match = sc.subscriber_login
-        WHERE sc.subscriber_login IS NULL;
-    """
-
+            for spec in selected
+        ]
+
+    workers = args.workers or get_worker_count()
+    schedule = get_schedule_settings()
+    if args.timeout is not None:
+        schedule["timeout"] = args.timeout
+    if args.deadline is not None:
+        schedule["deadline"] = args.deadline
+
+    if args.explain and connection:
+        explain_checks(connection, selected)
+
+    if args.watch:
+        writer = DeltaOutput(writer)
+    history = None
+    if not args.no_history:
+        history = writer = HistoryOutput(
+            writer,
+            get_history_file(),
+            configs[0]["host"],
+            mode,
+            rows_every_run=not args.watch or args.watch_history,
+        )
+    set_output(writer)
     try:
-        cursor.execute(query)
-        missing_entries = cursor.fetchall()
-
-        if missing_entries:
-            print(
-                "Orphan entries in feature_config (no matching subscriber in subscriber_config):"
+        if args.watch:
+            watch(
+                connection,
+                selected,
+                mode,
+                workers,
+                configs,
+                args.watch,
+                history,
+                snapshot_dir,
+                schedule,
             )
-            for entry in missing_entries:
-                print(entry)
-            print(f"\nTotal number of orphan entries found: {len(missing_entries)}")
         else:
-            print(
-                "All entries in feature_config have corresponding subscribers in subscriber_config."
+            run_checks(
+                connection,
+                selected,
+                mode,
+                workers,
+                configs,
+                snapshot_dir=snapshot_dir,
+                schedule=schedule,
             )
-    except Exception as e:
-        print(f"Error executing query: {e}")
     finally:
-        cursor.close()
-
-
-def main():
-    """
-    Main function to establish database connection and run sanity checks.
-    """
-    connection = get_db_connection()
-    if not connection:
-        print("Failed to connect to the database. Exiting.")
-        return
-
-    # List of sanity checks as (check_name, function) tuples.
-    sanity_checks = [
-        ("check_dial_rules_have_dialplan", check_dial_rules_have_dialplan),
-        ("check_dialplans_have_domain", check_dialplans_have_domain),
-        ("check_domains_have_reseller", check_domains_have_reseller),
-        (
-            "check_huntgroup_agents_have_huntgroup",
-            check_huntgroup_agents_have_huntgroup,
-        ),
-        ("check_huntgroups_have_callqueues", check_huntgroups_have_callqueues),
-        ("check_callqueues_have_users", check_callqueues_have_users),
-        ("check_users_have_domain", check_users_have_domain),
-        ("check_devices_have_users", check_devices_have_users),
-        ("check_timeframes_have_users", check_timeframes_have_users),
-        ("check_answeringrules_have_users", check_answeringrules_have_users),
-    ]
-
-    # Print the menu.
-    print("Select a sanity check to run:")
-    print(" 0: Run all checks")
-    for index, (name, _) in enumerate(sanity_checks, start=1):
-        print(f" {index}: {name}")
-
-    try:
-        choice = int(input("Enter your choice: "))
-    except ValueError:
-        print("Invalid input. Please enter a number.")
-        connection.close()
-        return
-
-    if choice == 0:
-        # Run all sanity checks.
-        for name, check_func in sanity_checks:
-            print(f"\nRunning {name}...")
-            check_func(connection)
-    elif 1 <= choice <= len(sanity_checks):
-        check_name, check_func = sanity_checks[choice - 1]
-        print(f"\nRunning {check_name}...")
-        check_func(connection)
-    else:
-        print("Invalid choice.")
-
-    connection.close()
+        api_stats = get_api_stats()
+        if api_stats and api_stats.requests:
+            writer.write_api_summary(api_stats.record())
+        writer.close()
+        if connection:
+            connection.close()
 
 
 if __name__ == "__main__":
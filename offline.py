@@ -0,0 +1,242 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import json
+import os
+import time
+from instrument import QueryStats
+from checks import finish_check, print_orphans, quote, wants_cleanup
+
+# Rows per record batch when exporting and when checking.
+EXPORT_BATCH_SIZE = 100000
+
+# Joins the columns of a multi-column key into one string. Can't appear in a
+# key value.
+KEY_SEPARATOR = "\x1f"
+
+
+def get_snapshot_dir():
+    """
+    Returns the directory snapshots are exported to and offline checks read
+    from, set by the SNAPSHOT_DIR environment variable.
+    """
+    load_dotenv()
+    return os.getenv("SNAPSHOT_DIR") or "nsanity-snapshot"
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Offline checks need pyarrow: pip install pyarrow")
+    return pyarrow, pyarrow.compute, pyarrow.parquet
+
+
+def report_columns(spec):
+    """
+    Returns the child columns an offline check reads and reports: its key and
+    exclusion columns, since only those are exported, so wide columns such as
+    feature_config.parameters never leave the database. Checks with a cleanup
+    also get the columns it works from.
+    """
+    columns = [child for child, _ in spec.keys]
+    columns += [column for column, _, _ in spec.exclusions]
+    if spec.cleanup and spec.columns != ("*",):
+        columns = list(spec.columns) + columns
+    return list(dict.fromkeys(columns))
+
+
+def export_columns(specs):
+    """
+    Returns {table: [columns]} of everything the checks read: the parent key
+    columns and the child columns of report_columns.
+    """
+    tables = {}
+    for spec in specs:
+        tables.setdefault(spec.parent_table, []).extend(p for _, p in spec.keys)
+        tables.setdefault(spec.child_table, []).extend(report_columns(spec))
+    return {table: list(dict.fromkeys(columns)) for table, columns in tables.items()}
+
+
+def export_table(connection, table, columns, path):
+    """
+    Streams the columns of a table into a Parquet file, dictionary-encoded so
+    repeated values such as domains are stored once. Values are kept as
+    strings. Returns the number of rows written.
+    """
+    pa, _, pq = import_pyarrow()
+    schema = pa.schema(
+        [pa.field(c, pa.dictionary(pa.int32(), pa.string())) for c in columns]
+    )
+    query = f"SELECT {', '.join(quote(c) for c in columns)} FROM {quote(table)}"
+    cursor = connection.cursor(buffered=False)
+    count = 0
+    writer = pq.ParquetWriter(f"{path}.tmp", schema)
+    try:
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            arrays = [
+                pa.array(
+                    [None if row[i] is None else str(row[i]) for row in rows],
+                    pa.string(),
+                ).dictionary_encode()
+                for i in range(len(columns))
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            count += len(rows)
+    finally:
+        writer.close()
+        cursor.close()
+    os.replace(f"{path}.tmp", path)
+    return count
+
+
+def export_snapshot(connection, specs, directory):
+    """
+    Exports the columns the checks need, one Parquet file per table, plus a
+    manifest.json saying when and with which columns.
+    """
+    os.makedirs(directory, exist_ok=True)
+    manifest = {"exported": time.strftime("%Y-%m-%dT%H:%M:%S"), "tables": {}}
+    for table, columns in export_columns(specs).items():
+        started = time.monotonic()
+        path = os.path.join(directory, f"{table}.parquet")
+        try:
+            count = export_table(connection, table, columns, path)
+        except Error as e:
+            print(f"Error exporting {table}: {e}")
+            continue
+        print(f"Exported {count} rows of {table} in {time.monotonic() - started:.2f}s")
+        manifest["tables"][table] = {"columns": columns, "rows": count}
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Snapshot written to {directory}")
+
+
+def normalized(column):
+    """
+    Lowercases and strips trailing spaces from a column, the way MariaDB's
+    default collations compare values (see snapshot.normalize). For dictionary
+    columns only the distinct values are normalized.
+    """
+    pa, pc, _ = import_pyarrow()
+    if isinstance(column, pa.ChunkedArray):
+        chunks = [normalized(chunk) for chunk in column.chunks]
+        return pa.chunked_array(chunks, pa.string())
+    if pa.types.is_dictionary(column.type):
+        values = normalized(column.dictionary)
+        return values.take(column.indices)
+    if not pa.types.is_string(column.type):
+        column = column.cast(pa.string())
+    return pc.utf8_rtrim(pc.utf8_lower(column), characters=" ")
+
+
+def key_column(batch, columns):
+    """
+    Returns one normalized key value per row, the columns joined with
+    KEY_SEPARATOR. NULL if any key column is NULL.
+    """
+    _, pc, _ = import_pyarrow()
+    keys = [normalized(batch.column(c)) for c in columns]
+    if len(keys) == 1:
+        return keys[0]
+    return pc.binary_join_element_wise(*keys, KEY_SEPARATOR)
+
+
+def parent_keys(directory, spec, cache):
+    """
+    Returns the distinct keys of a check's parent table, read once per run
+    for checks sharing them.
+    """
+    _, pc, pq = import_pyarrow()
+    columns = tuple(parent for _, parent in spec.keys)
+    cache_key = (spec.parent_table, columns)
+    if cache_key not in cache:
+        path = os.path.join(directory, f"{spec.parent_table}.parquet")
+        table = pq.read_table(path, columns=list(columns))
+        cache[cache_key] = pc.unique(key_column(table, columns).combine_chunks())
+    return cache[cache_key]
+
+
+def kept_rows(spec, batch):
+    """
+    Returns a mask of the child rows the check's exclusions keep. Like SQL, a
+    NULL in a filtered column drops the row.
+    """
+    pa, pc, _ = import_pyarrow()
+    mask = pa.array([True] * batch.num_rows)
+    for column, operator, value in spec.exclusions:
+        cells = normalized(batch.column(column))
+        if operator == "NOT IN":
+            values = pa.array([str(v).lower().rstrip(" ") for v in value])
+            keep = pc.invert(pc.is_in(cells, value_set=values))
+        else:
+            keep = pc.not_equal(cells, str(value).lower().rstrip(" "))
+        mask = pc.and_(mask, pc.fill_null(pc.and_(keep, pc.is_valid(cells)), False))
+    return mask
+
+
+def iter_offline_orphans(directory, spec, cache):
+    """
+    Yields a check's orphans from the exported files: child rows whose key
+    isn't among the parent keys (or is NULL, which never matches), read a
+    batch at a time so only the parent keys are held in memory.
+    """
+    _, pc, pq = import_pyarrow()
+    parents = parent_keys(directory, spec, cache)
+    columns = report_columns(spec)
+    child_columns = [child for child, _ in spec.keys]
+    path = os.path.join(directory, f"{spec.child_table}.parquet")
+    for batch in pq.ParquetFile(path).iter_batches(
+        batch_size=EXPORT_BATCH_SIZE, columns=columns
+    ):
+        keys = key_column(batch, child_columns)
+        missing = pc.invert(pc.is_in(keys, value_set=parents))
+        orphan = pc.and_(kept_rows(spec, batch), pc.or_(missing, pc.is_null(keys)))
+        orphans = batch.filter(orphan)
+        if orphans.num_rows:
+            yield from orphans.to_pylist()
+
+
+def run_offline(directory, specs, run_cleanup=True, skip=None):
+    """
+    Runs the checks over a snapshot written by export_snapshot, without a
+    database: the anti-joins become vectorized set-membership tests on the
+    key columns.
+    skip, if given, is called with each check's name first and skips the
+    check if it returns True (see Scheduler.skip).
+    Returns a list of (spec, orphans) for checks whose orphans were kept for
+    cleanup.
+    """
+    try:
+        import_pyarrow()
+    except RuntimeError as e:
+        print(e)
+        return []
+    cache = {}
+    kept = []
+    for spec in specs:
+        if skip and skip(spec.name):
+            continue
+        print(f"\nRunning {spec.name}...")
+        keep = wants_cleanup(spec)
+        stats = QueryStats(spec.name)
+        started = time.monotonic()
+        try:
+            missing_entries = print_orphans(
+                spec,
+                stats.count_rows(iter_offline_orphans(directory, spec, cache)),
+                keep=keep,
+            )
+        except (OSError, KeyError) as e:
+            print(f"Can't run {spec.name} from {directory}: {e}")
+            continue
+        stats.elapsed = time.monotonic() - started
+        missing_entries = finish_check(spec, missing_entries, run_cleanup, stats)
+        if missing_entries:
+            kept.append((spec, missing_entries))
+    return kept
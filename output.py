@@ -0,0 +1,449 @@
+from collections.abc import Mapping
+import csv
+import json
+import os
+import threading
+
+# Size of the write buffer for output files.
+FILE_BUFFER_SIZE = 1 << 20
+
+# Rows collected before each write to a Parquet file.
+PARQUET_BATCH_SIZE = 50000
+
+# Rows collected before taking the lock on a combined output file.
+COMBINED_BATCH_SIZE = 1000
+
+OUTPUT_FORMATS = ("text", "jsonl", "csv", "parquet")
+
+
+def summary_record(spec, stats):
+    """
+    Returns the summary written for a check once it has finished.
+    """
+    return {
+        "check": spec.name,
+        "orphans": stats.rows,
+        "duration_seconds": round(stats.elapsed, 3),
+        "rows_examined": stats.rows_examined,
+        "bytes_transferred": stats.bytes_sent,
+        "status": stats.status,
+    }
+
+
+def api_summary_record(api_record):
+    """
+    Returns the summary row for the API calls made by cleanups during the run.
+    """
+    return {"check": "cleanup_api", **api_record}
+
+
+def uniform_records(records):
+    """
+    Gives every record the same fields, in order of first appearance, so rows
+    of different kinds can share one summary file.
+    """
+    fields = list(dict.fromkeys(name for record in records for name in record))
+    return [{name: record.get(name) for name in fields} for record in records]
+
+
+def json_default(value):
+    """
+    Serializes what json can't by itself: dict-like rows (checks.Row) as
+    objects, anything else as a string.
+    """
+    if isinstance(value, Mapping):
+        return dict(value.items())
+    return str(value)
+
+
+def batches(rows, size):
+    """
+    Groups rows into lists of up to size rows.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class TextOutput:
+    """
+    Prints orphans to the terminal, one dict per line, followed by the total.
+    """
+
+    def write_orphans(self, spec, rows):
+        count = 0
+        for entry in rows:
+            if count == 0:
+                print(spec.found_message)
+            print(entry)
+            count += 1
+
+        if count:
+            print(f"\nTotal number of orphan entries found: {count}")
+        else:
+            print(spec.clean_message)
+        return count
+
+    def write_summary(self, spec, stats):
+        # The stats line printed after each check already is the summary.
+        pass
+
+    def write_api_summary(self, api_record):
+        # Cleanups print their own [api] line when they finish.
+        pass
+
+    def start_cycle(self):
+        pass
+
+    def finish_cycle(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FileOutput:
+    """
+    Base for the writers that stream orphans to files in a directory, either
+    one file per check (<check>.<ext>) or all checks in one combined file
+    (orphans.<ext>) with a "check" column. A summary record per check is
+    written to summary.<ext> when the output is closed, or at the end of
+    every watch cycle (see start_cycle and finish_cycle).
+    Subclasses implement write_file(path, rows) and, if they can be combined,
+    open_combined(path) and write_combined(batch).
+    """
+
+    extension = None
+
+    def __init__(self, directory, combined=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.combined = combined
+        self.lock = threading.Lock()
+        self.summaries = []
+        self.combined_open = False
+        if combined:
+            self.open_combined(self.path("orphans"))
+            self.combined_open = True
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.{self.extension}")
+
+    def write_orphans(self, spec, rows):
+        if self.combined:
+            path = self.path("orphans")
+            count = 0
+            for batch in batches(rows, COMBINED_BATCH_SIZE):
+                batch = [{"check": spec.name, **row} for row in batch]
+                with self.lock:
+                    self.write_combined(batch)
+                count += len(batch)
+        else:
+            path = self.path(spec.name)
+            count = self.write_file(path, rows)
+
+        if count:
+            print(f"{count} orphan entries written to {path}")
+        else:
+            print(spec.clean_message)
+        return count
+
+    def write_summary(self, spec, stats):
+        with self.lock:
+            self.summaries.append(summary_record(spec, stats))
+
+    def write_api_summary(self, api_record):
+        with self.lock:
+            self.summaries.append(api_summary_record(api_record))
+
+    def start_cycle(self):
+        """
+        Starts the files over for another watch cycle: the combined file is
+        truncated and the summary emptied. (Per-check files are rewritten
+        whenever their check runs.)
+        """
+        with self.lock:
+            self.summaries = []
+            if self.combined and not self.combined_open:
+                self.open_combined(self.path("orphans"))
+                self.combined_open = True
+
+    def finish_cycle(self):
+        """
+        Completes the files of a watch cycle, so the combined file and the
+        summary hold that cycle until the next one finishes.
+        """
+        with self.lock:
+            self.close_files()
+
+    def close_files(self):
+        if self.combined_open:
+            self.close_combined()
+            self.combined_open = False
+        if self.summaries:
+            self.write_file(self.path("summary"), uniform_records(self.summaries))
+            print(f"\nSummary written to {self.path('summary')}")
+
+    def close(self):
+        self.close_files()
+
+    def open_combined(self, path):
+        raise ValueError(f"{self.extension} output can't be combined into one file")
+
+    def write_combined(self, batch):
+        raise ValueError(f"{self.extension} output can't be combined into one file")
+
+    def close_combined(self):
+        raise ValueError(f"{self.extension} output can't be combined into one file")
+
+
+class JsonlOutput(FileOutput):
+    """
+    Writes one JSON object per orphan per line.
+    """
+
+    extension = "jsonl"
+
+    def write_file(self, path, rows):
+        count = 0
+        with open(path, "w", buffering=FILE_BUFFER_SIZE) as f:
+            for row in rows:
+                f.write(json.dumps(row, default=json_default))
+                f.write("\n")
+                count += 1
+        return count
+
+    def open_combined(self, path):
+        self.combined_file = open(path, "w", buffering=FILE_BUFFER_SIZE)
+
+    def write_combined(self, batch):
+        self.combined_file.write(
+            "".join(json.dumps(row, default=str) + "\n" for row in batch)
+        )
+
+    def close_combined(self):
+        self.combined_file.close()
+
+
+class CsvOutput(FileOutput):
+    """
+    Writes one CSV file per check, with a header row taken from the first
+    orphan. Checks report different columns, so CSV can't be combined.
+    """
+
+    extension = "csv"
+
+    def write_file(self, path, rows):
+        count = 0
+        with open(path, "w", buffering=FILE_BUFFER_SIZE, newline="") as f:
+            writer = None
+            for row in rows:
+                if writer is None:
+                    writer = csv.DictWriter(f, fieldnames=list(row))
+                    writer.writeheader()
+                writer.writerow(row)
+                count += 1
+        return count
+
+
+class ParquetOutput(FileOutput):
+    """
+    Writes Parquet files in row groups of PARQUET_BATCH_SIZE orphans. Numbers
+    are kept as numbers and everything else is stored as strings. The combined
+    file has a "check" column and the orphan as a JSON string in "row", since
+    checks report different columns. Needs pyarrow.
+    """
+
+    extension = "parquet"
+
+    def __init__(self, directory, combined=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        super().__init__(directory, combined)
+
+    def schema_for(self, batch):
+        fields = []
+        for name in batch[0]:
+            # Type each column by its first value that isn't NULL.
+            value = next((r[name] for r in batch if r.get(name) is not None), None)
+            if isinstance(value, bool):
+                kind = self.pa.bool_()
+            elif isinstance(value, int):
+                kind = self.pa.int64()
+            elif isinstance(value, float):
+                kind = self.pa.float64()
+            else:
+                kind = self.pa.string()
+            fields.append(self.pa.field(name, kind))
+        return self.pa.schema(fields)
+
+    def to_table(self, batch, schema):
+        columns = {}
+        for field in schema:
+            values = [row.get(field.name) for row in batch]
+            if field.type == self.pa.string():
+                values = [None if v is None else str(v) for v in values]
+            columns[field.name] = values
+        return self.pa.Table.from_pydict(columns, schema=schema)
+
+    def write_file(self, path, rows):
+        count = 0
+        writer = None
+        try:
+            for batch in batches(rows, PARQUET_BATCH_SIZE):
+                if writer is None:
+                    schema = self.schema_for(batch)
+                    writer = self.pq.ParquetWriter(path, schema)
+                writer.write_table(self.to_table(batch, schema))
+                count += len(batch)
+        finally:
+            if writer is not None:
+                writer.close()
+        return count
+
+    def open_combined(self, path):
+        self.combined_schema = self.pa.schema(
+            [self.pa.field("check", self.pa.string()), ("row", self.pa.string())]
+        )
+        self.combined_writer = self.pq.ParquetWriter(path, self.combined_schema)
+
+    def write_combined(self, batch):
+        batch = [
+            {"check": row.pop("check"), "row": json.dumps(row, default=str)}
+            for row in batch
+        ]
+        self.combined_writer.write_table(self.to_table(batch, self.combined_schema))
+
+    def close_combined(self):
+        self.combined_writer.close()
+
+
+class DeltaOutput:
+    """
+    Wraps another writer for watch mode, remembering every check's orphans
+    from the cycle before. The first cycle is reported in full; after that only
+    orphans that newly appeared or were resolved since the last cycle are
+    printed, once the check's summary says it read all of them. A check that
+    timed out or only read some of its orphans is compared again the next
+    time it finishes. File writers still get every row, and watch() starts
+    their files over every cycle, so they always hold the latest complete
+    cycle.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.previous = {}
+        # Orphans of the current cycle, until its summary says they're whole.
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def write_orphans(self, spec, rows):
+        current = {}
+
+        def remember(rows):
+            for row in rows:
+                key = row.as_tuple() if hasattr(row, "as_tuple") else row.values()
+                current[tuple(key)] = row
+                yield row
+
+        with self.lock:
+            previous = self.previous.get(spec.name)
+        if previous is None or not isinstance(self.writer, TextOutput):
+            count = self.writer.write_orphans(spec, remember(rows))
+        else:
+            count = sum(1 for _ in remember(rows))
+        with self.lock:
+            self.pending[spec.name] = current, count
+        return count
+
+    def write_summary(self, spec, stats):
+        with self.lock:
+            previous = self.previous.get(spec.name)
+            current, count = self.pending.pop(spec.name, (None, 0))
+            if current is not None and stats.status == "ok":
+                self.previous[spec.name] = current
+
+        if previous is not None and stats.status != "ok":
+            print(f"{spec.name}: {stats.status}, compared with the next full cycle")
+        elif previous is not None and current is not None:
+            appeared = [row for key, row in current.items() if key not in previous]
+            resolved = [row for key, row in previous.items() if key not in current]
+            print(
+                f"{spec.name}: {len(appeared)} new, {len(resolved)} resolved,"
+                f" {count} orphans in total"
+            )
+            for row in appeared:
+                print(f"+ {row}")
+            for row in resolved:
+                print(f"- {row}")
+        self.writer.write_summary(spec, stats)
+
+    def write_api_summary(self, api_record):
+        self.writer.write_api_summary(api_record)
+
+    def close(self):
+        self.writer.close()
+
+
+def make_output(output_format="text", directory="nsanity-output", combined=False):
+    """
+    Returns the writer for the given output format.
+    """
+    if output_format == "jsonl":
+        return JsonlOutput(directory, combined)
+    if output_format == "csv":
+        return CsvOutput(directory, combined)
+    if output_format == "parquet":
+        return ParquetOutput(directory, combined)
+    return TextOutput()
+
+
+# Where checks send their orphans. Set once by main() before checks run.
+current = TextOutput()
+
+
+def set_output(writer):
+    """
+    Sends the orphans of every check run after this to the given writer.
+    """
+    global current
+    current = writer
+
+
+def get_output():
+    return current
+
+
+def get_base_output():
+    """
+    Returns the writer the orphans end up in, past any history or delta
+    wrappers.
+    """
+    writer = current
+    while hasattr(writer, "writer"):
+        writer = writer.writer
+    return writer
+
+
+def write_report(name, rows):
+    """
+    Writes rows that aren't a check's orphans, such as a report of the whole
+    run, to <name>.<ext> next to the orphan files, past any history or delta
+    wrappers. Returns the path, or None when the output isn't to files.
+    """
+    writer = get_base_output()
+    if not hasattr(writer, "write_file"):
+        return None
+    path = writer.path(name)
+    writer.write_file(path, rows)
+    return path
@@ -0,0 +1,353 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import argparse
+import dataclasses
+import json
+import os
+import sys
+import time
+from checks import CHECKS_BY_NAME, build_check_query, quote
+from replicas import ReplicaLags, get_replica_settings
+
+# Checks whose orphans may be deleted straight from the database. Only leaf
+# tables: nothing else refers to their rows, so deleting them can't orphan
+# anything further.
+PURGEABLE_CHECKS = (
+    "check_huntgroup_agents_have_huntgroup",
+    "check_devices_have_users",
+    "check_timeframes_have_users",
+    "check_answeringrules_have_users",
+)
+
+# Rows per INSERT when restoring a backup.
+RESTORE_BATCH_SIZE = 500
+
+
+def get_purge_settings():
+    """
+    Reads the purge settings from the environment:
+    PURGE_BATCH_SIZE  orphan keys re-checked and deleted per transaction
+                      (default 100)
+    PURGE_SLEEP       seconds to pause between batches (default 0.5)
+    PURGE_MAX_LAG     replica lag in seconds that pauses the purge until the
+                      REPLICAS catch up (default 5)
+    PURGE_BACKUP_DIR  where the deleted rows are saved (default nsanity-purge)
+    """
+    load_dotenv()
+    return {
+        "batch_size": max(1, int(os.getenv("PURGE_BATCH_SIZE") or 100)),
+        "sleep": float(os.getenv("PURGE_SLEEP") or 0.5),
+        "max_lag": float(os.getenv("PURGE_MAX_LAG") or 5),
+        "backup_dir": os.getenv("PURGE_BACKUP_DIR") or "nsanity-purge",
+    }
+
+
+def match_condition(columns, values, alias=None):
+    """
+    Returns a WHERE condition matching rows whose columns equal one of the
+    value tuples, and its parameters.
+    """
+    prefix = f"{alias}." if alias else ""
+    if len(columns) == 1:
+        placeholders = ", ".join(["%s"] * len(values))
+        params = [value for (value,) in values]
+        return f"{prefix}{quote(columns[0])} IN ({placeholders})", params
+    match = " AND ".join(f"{prefix}{quote(column)} = %s" for column in columns)
+    params = [value for row in values for value in row]
+    return "(" + " OR ".join([f"({match})"] * len(values)) + ")", params
+
+
+def primary_key(connection, table):
+    """
+    Returns the primary key columns of a table, in order, or () if it has
+    none.
+    """
+    cursor = connection.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(f"SHOW KEYS FROM {quote(table)} WHERE Key_name = 'PRIMARY'")
+        keys = cursor.fetchall()
+    finally:
+        cursor.close()
+    keys.sort(key=lambda key: key["Seq_in_index"])
+    return tuple(key["Column_name"] for key in keys)
+
+
+def orphan_keys(spec, rows):
+    """
+    Returns the distinct child keys of a check's orphan rows. Rows with a
+    NULL key are left out: they can't be matched again to re-check them.
+    """
+    columns = [child for child, _ in spec.keys]
+    keys = {}
+    for row in rows:
+        key = tuple(row.get(column) for column in columns)
+        if None not in key:
+            keys[key] = True
+    return list(keys)
+
+
+def encode_value(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {"hex": bytes(value).hex()}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict) and "hex" in value:
+        return bytes.fromhex(value["hex"])
+    return value
+
+
+class Backup:
+    """
+    Append-only JSONL file of the rows a purge deletes, one {"table", "row"}
+    object per line, synced to disk before the rows are deleted so every
+    deleted row can be put back with restore.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.file = open(path, "a")
+
+    def write(self, table, rows):
+        for row in rows:
+            record = {
+                "table": table,
+                "row": {name: encode_value(v) for name, v in row.items()},
+            }
+            self.file.write(json.dumps(record, default=str) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ReplicaThrottle:
+    """
+    Pauses the purge while any of the REPLICAS is more than PURGE_MAX_LAG
+    seconds behind, so the deletes never pile up on replicas that checks and
+    reports read from. Keeps one connection per replica for the whole purge.
+    """
+
+    def __init__(self, config, settings):
+        self.max_lag = settings["max_lag"]
+        self.lags = ReplicaLags(config, get_replica_settings()["hosts"])
+
+    def wait(self):
+        while True:
+            lag = self.lags.max_lag()
+            if lag is None or lag <= self.max_lag:
+                return
+            print(f"Replicas are {lag}s behind, pausing the purge...")
+            time.sleep(max(1, lag - self.max_lag))
+
+    def close(self):
+        self.lags.close()
+
+
+def purge_batch(connection, spec, key_columns, keys, backup):
+    """
+    Deletes the rows of one batch of orphan keys in a single short
+    transaction: the rows are re-checked and locked, saved to the backup,
+    and deleted by primary key. Rows whose parent has come back since the
+    check ran are left alone.
+    Returns the number of rows deleted.
+    """
+    condition, params = match_condition(
+        [child for child, _ in spec.keys], keys, alias="c"
+    )
+    query, params = build_check_query(
+        dataclasses.replace(spec, columns=("*",)), [condition], params
+    )
+    cursor = connection.cursor(dictionary=True, buffered=True)
+    try:
+        cursor.execute(f"{query} FOR UPDATE", params)
+        rows = cursor.fetchall()
+        deleted = 0
+        if rows:
+            backup.write(spec.child_table, rows)
+            condition, params = match_condition(
+                key_columns, [tuple(row[c] for c in key_columns) for row in rows]
+            )
+            cursor.execute(
+                f"DELETE FROM {quote(spec.child_table)} WHERE {condition}", params
+            )
+            deleted = cursor.rowcount
+        connection.commit()
+        return deleted
+    except Error:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def purge_orphans(spec, orphans, connection=None, settings=None):
+    """
+    Deletes a check's orphans straight from the database, PURGE_BATCH_SIZE
+    orphan keys per transaction, pausing between batches and while replicas
+    lag. Every deleted row is saved to a backup file first.
+    Returns the number of rows deleted.
+    """
+    if spec.name not in PURGEABLE_CHECKS:
+        print(f"{spec.name} can't be purged; only {', '.join(PURGEABLE_CHECKS)} can.")
+        return 0
+    keys = orphan_keys(spec, orphans)
+    if not keys:
+        return 0
+
+    from nsanity import get_db_config, get_db_connection
+
+    settings = settings or get_purge_settings()
+    owned = connection is None
+    # Deletes go to the primary, whichever server the check read.
+    connection = connection or get_db_connection(get_db_config())
+    if not connection:
+        print("Can't purge without a connection to NSHOST.")
+        return 0
+    try:
+        key_columns = primary_key(connection, spec.child_table)
+    except Error as e:
+        print(f"Error reading the primary key of {spec.child_table}: {e}")
+        key_columns = ()
+    if not key_columns:
+        print(f"{spec.child_table} has no primary key, not purging it.")
+        if owned:
+            connection.close()
+        return 0
+
+    path = os.path.join(
+        settings["backup_dir"], f"{spec.name}-{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+    )
+    backup = Backup(path)
+    throttle = ReplicaThrottle(get_db_config(), settings)
+    deleted = 0
+    size = settings["batch_size"]
+    try:
+        for start in range(0, len(keys), size):
+            throttle.wait()
+            deleted += purge_batch(
+                connection, spec, key_columns, keys[start : start + size], backup
+            )
+            print(
+                f"Purged {deleted} rows of {spec.child_table}"
+                f" ({min(start + size, len(keys))}/{len(keys)} keys)"
+            )
+            time.sleep(settings["sleep"])
+    except Error as e:
+        print(f"Error purging {spec.child_table}: {e}")
+    finally:
+        backup.close()
+        throttle.close()
+        if owned:
+            connection.close()
+    print(f"Deleted rows saved to {path}; undo with: python3 purge.py restore {path}")
+    return deleted
+
+
+def read_orphans(path, check):
+    """
+    Reads a check's orphans from a JSONL file written by nsanity.py --format
+    jsonl, either the check's own file or a combined one.
+    """
+    orphans = []
+    with open(path) as f:
+        for line in f:
+            row = json.loads(line)
+            if row.pop("check", check) == check:
+                orphans.append(row)
+    return orphans
+
+
+class Purger:
+    """
+    A check cleanup that purges the orphans from the database instead of
+    going through the API, so it needs no APIKEY.
+    """
+
+    needs_apikey = False
+
+    def __init__(self, spec):
+        self.spec = spec
+
+    def __call__(self, orphans):
+        purge_orphans(self.spec, orphans)
+
+
+def restore_backup(connection, path):
+    """
+    Puts the rows of a purge backup back. Rows that are already there again
+    are skipped. Returns the number of rows restored.
+    """
+    tables = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                tables.setdefault(record["table"], []).append(record["row"])
+    restored = 0
+    cursor = connection.cursor()
+    try:
+        for table, rows in tables.items():
+            for start in range(0, len(rows), RESTORE_BATCH_SIZE):
+                batch = rows[start : start + RESTORE_BATCH_SIZE]
+                columns = list(batch[0])
+                cursor.executemany(
+                    f"INSERT IGNORE INTO {quote(table)}"
+                    f" ({', '.join(quote(c) for c in columns)})"
+                    f" VALUES ({', '.join(['%s'] * len(columns))})",
+                    [[decode_value(row.get(c)) for c in columns] for row in batch],
+                )
+                restored += cursor.rowcount
+                connection.commit()
+    finally:
+        cursor.close()
+    return restored
+
+
+def main():
+    """
+    Purges the orphans of a check from earlier jsonl output, or restores a
+    purge backup.
+    """
+    parser = argparse.ArgumentParser(
+        description="Deletes orphans straight from the database, or undoes that."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="purge the orphans found by a check")
+    run.add_argument("check", choices=PURGEABLE_CHECKS)
+    run.add_argument(
+        "--from",
+        dest="orphans",
+        required=True,
+        metavar="ORPHANS.jsonl",
+        help="the check's jsonl output",
+    )
+    restore = commands.add_parser("restore", help="put purged rows back")
+    restore.add_argument("backup")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        purge_orphans(
+            CHECKS_BY_NAME[args.check], read_orphans(args.orphans, args.check)
+        )
+        return
+
+    from nsanity import get_db_config, get_db_connection
+
+    connection = get_db_connection(get_db_config())
+    if not connection:
+        sys.exit(1)
+    try:
+        print(f"Restored {restore_backup(connection, args.backup)} rows.")
+    except (Error, OSError, ValueError) as e:
+        print(f"Error restoring {args.backup}: {e}")
+        sys.exit(1)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
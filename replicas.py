@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from mysql.connector import Error
+import mysql.connector
+import os
+import time
+from chunked import get_replication_lag
+
+REPLICA_POLICIES = ("primary", "wait")
+
+# Seconds to wait for a replica to answer when measuring its lag.
+PROBE_TIMEOUT = 5
+
+# Seconds between lag measurements while waiting for a replica to catch up.
+POLL_INTERVAL = 10
+
+
+def get_replica_settings():
+    """
+    Reads the read-replica settings from the environment:
+    REPLICAS          comma separated replica hosts (host or host:port) to run
+                      the checks on instead of NSHOST
+    REPLICA_MAX_LAG   seconds behind the primary a replica may be (default 30)
+    REPLICA_POLICY    what to do when every replica lags too much: "primary"
+                      runs the checks on NSHOST (default), "wait" waits for a
+                      replica to catch up
+    REPLICA_MAX_WAIT  seconds the wait policy waits before giving up (default 600)
+    """
+    load_dotenv()
+    hosts = [host.strip() for host in (os.getenv("REPLICAS") or "").split(",")]
+    policy = (os.getenv("REPLICA_POLICY") or "primary").lower()
+    if policy not in REPLICA_POLICIES:
+        print(f"Unknown REPLICA_POLICY {policy!r}, using primary.")
+        policy = "primary"
+    return {
+        "hosts": [host for host in hosts if host],
+        "max_lag": float(os.getenv("REPLICA_MAX_LAG") or 30),
+        "policy": policy,
+        "max_wait": float(os.getenv("REPLICA_MAX_WAIT") or 600),
+    }
+
+
+def replica_config(config, host):
+    """
+    Returns the connection settings for a replica: the primary's with the host
+    (and port, if given as host:port) replaced.
+    """
+    name, _, port = host.partition(":")
+    replica = {**config, "host": name}
+    if port:
+        replica["port"] = int(port)
+    return replica
+
+
+def replica_lag(config):
+    """
+    Returns how many seconds a replica is behind, or None if it can't be
+    reached or isn't replicating.
+    """
+    try:
+        connection = mysql.connector.connect(connection_timeout=PROBE_TIMEOUT, **config)
+    except Error as e:
+        print(f"Replica {config['host']} is unreachable: {e}")
+        return None
+    try:
+        lag = get_replication_lag(connection)
+    finally:
+        connection.close()
+    if lag is None:
+        print(f"Replica {config['host']} is not replicating.")
+    return lag
+
+
+class ReplicaLags:
+    """
+    Measures how far behind the replicas are, for work that checks the lag
+    between every batch (see ReplicaThrottle in purge.py and Throttle in
+    chunked.py). Keeps one connection per replica until close.
+    """
+
+    def __init__(self, config, hosts):
+        self.replicas = [replica_config(config, host) for host in hosts]
+        self.connections = {}
+
+    def lag(self, replica):
+        connection = self.connections.get(replica["host"])
+        try:
+            if connection is None:
+                connection = mysql.connector.connect(
+                    connection_timeout=PROBE_TIMEOUT, **replica
+                )
+                self.connections[replica["host"]] = connection
+            connection.ping(reconnect=True)
+        except Error as e:
+            print(f"Replica {replica['host']} is unreachable: {e}")
+            return None
+        return get_replication_lag(connection)
+
+    def max_lag(self):
+        """
+        Returns the lag of the replica furthest behind, or None if none of
+        them can say right now.
+        """
+        lags = [lag for lag in map(self.lag, self.replicas) if lag is not None]
+        return max(lags) if lags else None
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+
+def healthy_replicas(config, settings):
+    """
+    Measures the lag of every replica at once and returns the settings of the
+    ones within REPLICA_MAX_LAG, least lagged first.
+    """
+    replicas = [replica_config(config, host) for host in settings["hosts"]]
+    with ThreadPoolExecutor(max_workers=len(replicas)) as executor:
+        lags = list(executor.map(replica_lag, replicas))
+
+    healthy = []
+    for replica, lag in zip(replicas, lags):
+        if lag is None:
+            continue
+        if lag > settings["max_lag"]:
+            print(f"Replica {replica['host']} is {lag}s behind, skipping it.")
+            continue
+        healthy.append((lag, replica))
+    healthy.sort(key=lambda item: item[0])
+    return [replica for _, replica in healthy]
+
+
+def route_checks(config, settings):
+    """
+    Returns the connection settings to run the checks on: the healthy replicas,
+    least lagged first, or per REPLICA_POLICY the primary (config) or nothing
+    once the wait policy has given up.
+    """
+    waited = 0.0
+    while True:
+        replicas = healthy_replicas(config, settings)
+        if replicas:
+            hosts = ", ".join(replica["host"] for replica in replicas)
+            print(f"Running checks on replicas: {hosts}")
+            return replicas
+        if settings["policy"] == "primary":
+            print("No replica is usable, running checks on the primary.")
+            return [config]
+        if waited >= settings["max_wait"]:
+            print(f"No replica caught up within {settings['max_wait']:.0f}s.")
+            return []
+        print(f"No replica is usable, checking again in {POLL_INTERVAL}s.")
+        time.sleep(POLL_INTERVAL)
+        waited += POLL_INTERVAL
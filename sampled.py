@@ -0,0 +1,60 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import os
+from instrument import QueryStats
+from checks import (
+    Row,
+    build_check_query,
+    finish_check,
+    print_orphans,
+    report_query_error,
+)
+
+
+def get_sample_size():
+    """
+    Returns how many orphans a sample holds per check, read from SAMPLE_ROWS
+    (default 20).
+    """
+    load_dotenv()
+    try:
+        return max(1, int(os.getenv("SAMPLE_ROWS") or 20))
+    except ValueError:
+        print("SAMPLE_ROWS must be a number, sampling 20 orphans.")
+        return 20
+
+
+def run_sampled(connection, spec, run_cleanup=True, stats=None):
+    """
+    Runs a check with a LIMIT, so the server stops after SAMPLE_ROWS orphans
+    and only those are sent, to see what a check finds without paying for
+    all of it. One row past the sample is asked for, and a check that had it
+    is reported as sampled, since it has more orphans. Samples are never
+    cleaned up, so run_cleanup is ignored.
+    """
+    stats = stats or QueryStats(spec.name)
+    size = get_sample_size()
+    query, params = build_check_query(spec)
+    stats.start(connection)
+    cursor = connection.cursor(buffered=False)
+    rows = []
+    try:
+        # One row past the sample tells whether there are more orphans.
+        cursor.execute(f"{query} LIMIT %s", params + [size + 1])
+        rows = cursor.fetchall()
+        positions = {name: index for index, name in enumerate(cursor.column_names)}
+        print_orphans(
+            spec,
+            stats.count_rows(Row(positions, tuple(row)) for row in rows[:size]),
+        )
+    except Error as e:
+        report_query_error(spec, e, stats)
+        return None
+    finally:
+        cursor.close()
+    stats.stop(connection)
+
+    if len(rows) > size:
+        print(f"Showing the first {size} orphans; there are more.")
+        stats.status = "sampled"
+    return finish_check(spec, None, False, stats)
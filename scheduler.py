@@ -0,0 +1,266 @@
+from dotenv import load_dotenv
+from mysql.connector import Error
+import contextlib
+import mysql.connector
+import os
+import threading
+import time
+from instrument import QueryStats
+from history import check_costs, get_history_file
+from replicas import PROBE_TIMEOUT
+
+# Seconds past a check's budget before its query is killed from another
+# connection, in case the server didn't stop it itself.
+KILL_GRACE = 5
+
+
+def get_schedule_settings():
+    """
+    Reads the time limits of a run from the environment:
+    CHECK_TIMEOUT  seconds each check may take before its query is stopped
+                   and it is reported as timed out (default 900, 0 for none)
+    RUN_DEADLINE   seconds the whole run may take; checks that haven't
+                   started by then are skipped (default 0, none)
+    """
+    load_dotenv()
+    settings = {}
+    for key, name, default, fallback in (
+        ("timeout", "CHECK_TIMEOUT", 900, "checks get 900 seconds"),
+        ("deadline", "RUN_DEADLINE", 0, "the run has no deadline"),
+    ):
+        try:
+            settings[key] = max(0.0, float(os.getenv(name) or default))
+        except ValueError:
+            print(f"{name} must be a number of seconds, so {fallback}.")
+            settings[key] = float(default)
+    return settings
+
+
+def set_statement_time(connection, seconds):
+    """
+    Limits how long any statement of the session may run, in seconds (0 for
+    no limit): MariaDB's max_statement_time, or MySQL's max_execution_time.
+    Servers that have neither are left alone.
+    """
+    cursor = connection.cursor()
+    try:
+        for query, value in (
+            ("SET SESSION max_statement_time = %s", seconds),
+            ("SET SESSION max_execution_time = %s", int(seconds * 1000)),
+        ):
+            try:
+                cursor.execute(query, (value,))
+                return True
+            except Error:
+                continue
+        return False
+    finally:
+        cursor.close()
+
+
+class Budget:
+    """
+    The time one check may take on its connection. The server stops any
+    statement that runs past it, and a watchdog kills the check's query from
+    a connection of its own KILL_GRACE seconds later, which also covers
+    checks made of many shorter statements. kill_after sets the watchdog
+    apart from the statement limit (0 for no watchdog).
+    """
+
+    def __init__(self, connection, name, seconds, configs, kill_after=None):
+        self.connection = connection
+        self.name = name
+        self.seconds = seconds
+        self.configs = configs
+        self.kill_after = seconds if kill_after is None else kill_after
+        self.timer = None
+        # Set by stop(), under the lock, so a watchdog firing just as the
+        # check ends can't kill whatever the connection runs next.
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def kill_config(self):
+        host = getattr(self.connection, "server_host", None)
+        for config in self.configs:
+            if config.get("host") == host:
+                return config
+        return self.configs[0]
+
+    def kill(self):
+        with self.lock:
+            if not self.stopped:
+                self.kill_query()
+
+    def kill_query(self):
+        try:
+            connection = mysql.connector.connect(
+                connection_timeout=PROBE_TIMEOUT, **self.kill_config()
+            )
+        except Error as e:
+            print(f"Can't stop {self.name}: {e}")
+            return
+        try:
+            cursor = connection.cursor()
+            cursor.execute(f"KILL QUERY {int(self.connection.connection_id)}")
+            cursor.close()
+        except Error as e:
+            print(f"Can't stop {self.name}: {e}")
+        finally:
+            connection.close()
+
+    def start(self):
+        set_statement_time(self.connection, self.seconds)
+        if (
+            self.kill_after
+            and getattr(self.connection, "connection_id", None) is not None
+        ):
+            self.timer = threading.Timer(self.kill_after + KILL_GRACE, self.kill)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+        if self.timer:
+            self.timer.cancel()
+        try:
+            set_statement_time(self.connection, 0)
+        except Error:
+            pass
+
+
+class Scheduler:
+    """
+    Orders the checks of a run by what they cost in earlier runs (from the
+    history database), longest first, so running them in parallel finishes
+    sooner; and runs each under a Budget of CHECK_TIMEOUT seconds, cut short
+    by the run's RUN_DEADLINE. Checks left when the deadline passes are
+    skipped. Both are listed at the end of the run. Modes that read the
+    tables of all their checks over one connection run in a session instead
+    (see session).
+    """
+
+    def __init__(self, configs, settings=None):
+        self.configs = configs
+        self.settings = settings or get_schedule_settings()
+        self.deadline = None
+        if self.settings["deadline"]:
+            self.deadline = time.monotonic() + self.settings["deadline"]
+        self.lock = threading.Lock()
+        self.unfinished = []
+
+    def order(self, specs):
+        """
+        Returns the checks longest first. Checks never run before go first,
+        since they might be the longest of all.
+        """
+        costs = check_costs(get_history_file(), [spec.name for spec in specs])
+        return sorted(specs, key=lambda spec: -costs.get(spec.name, float("inf")))
+
+    def budget(self):
+        """
+        Returns the seconds the next check may take, or None for no limit.
+        """
+        limits = []
+        if self.settings["timeout"]:
+            limits.append(self.settings["timeout"])
+        if self.deadline is not None:
+            limits.append(self.deadline - time.monotonic())
+        return min(limits) if limits else None
+
+    def record(self, name, status):
+        with self.lock:
+            self.unfinished.append((name, status))
+
+    def skip(self, name):
+        """
+        Returns True, after reporting it, if the run deadline has passed so
+        the named check can't start.
+        """
+        seconds = self.budget()
+        if seconds is not None and seconds <= 0:
+            print(f"[{name}] skipped, the run deadline has passed")
+            self.record(name, "skipped")
+            return True
+        return False
+
+    def limiter(self, name, seconds):
+        """
+        Returns a function that puts a connection under what is left of a
+        check's seconds and returns its started Budget, for checks that run
+        on more connections than the one they were given. None if seconds
+        is None (no limit).
+        """
+        if seconds is None:
+            return None
+        ends = time.monotonic() + seconds
+
+        def limit(connection):
+            left = max(ends - time.monotonic(), 1)
+            budget = Budget(connection, name, left, self.configs)
+            budget.start()
+            return budget
+
+        return limit
+
+    @contextlib.contextmanager
+    def session(self, connection, name):
+        """
+        Runs the body under the run's limits on a connection that serves all
+        the checks at once (snapshot, cascade and incremental modes): the
+        server stops any statement running past CHECK_TIMEOUT, and whatever
+        runs when RUN_DEADLINE passes is killed.
+        """
+        seconds = self.budget()
+        budget = None
+        if seconds is not None:
+            kill_after = 0
+            if self.deadline is not None:
+                kill_after = self.deadline - time.monotonic()
+            budget = Budget(connection, name, seconds, self.configs, kill_after)
+            try:
+                budget.start()
+            except Error as e:
+                # The checks will fail on the same connection and say why.
+                print(f"Can't limit the {name} run: {e}")
+        try:
+            yield
+        finally:
+            if budget:
+                budget.stop()
+
+    def wrap(self, runner, opens_connections=False):
+        """
+        Returns runner, run under each check's budget. A runner that opens
+        connections of its own (opens_connections) is given a limit=
+        function (see limiter) to put them under the same budget.
+        """
+
+        def run(connection, spec, run_cleanup=True):
+            if self.skip(spec.name):
+                return None
+            stats = QueryStats(spec.name)
+            limit = self.limiter(spec.name, self.budget())
+            extra = {"limit": limit} if opens_connections else {}
+            budget = None
+            try:
+                if limit:
+                    budget = limit(connection)
+                return runner(connection, spec, run_cleanup, stats=stats, **extra)
+            except Error as e:
+                # The budget couldn't be set, e.g. on a dropped connection.
+                print(f"Error running {spec.name}: {e}")
+                return None
+            finally:
+                if budget:
+                    budget.stop()
+                if stats.status == "timed out":
+                    self.record(spec.name, stats.status)
+
+        return run
+
+    def report(self):
+        if self.unfinished:
+            print("\nChecks that didn't finish:")
+        for name, status in self.unfinished:
+            print(f"  {name}: {status}")
@@ -0,0 +1,204 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from mysql.connector import Error
+import itertools
+import os
+import threading
+from instrument import QueryStats, session_status
+from checks import (
+    build_check_query,
+    compact_rows,
+    finish_check,
+    iter_rows,
+    print_orphans,
+    quote,
+    report_query_error,
+    run_check,
+    wants_cleanup,
+)
+
+SHARD_METHODS = ("range", "hash")
+
+# Shards per worker. More shards than workers keeps every worker busy when
+# some shards turn out slower than others.
+SHARDS_PER_WORKER = 4
+
+
+def get_shard_method():
+    """
+    Returns how checks are split into shards, read from the SHARD_BY
+    environment variable: "range" (default) cuts the domains, in order, into
+    ranges holding about the same number of rows; "hash" assigns domains to
+    shards by CRC32, which needs no planning query but makes every shard
+    scan the whole table.
+    """
+    load_dotenv()
+    method = (os.getenv("SHARD_BY") or "range").lower()
+    if method not in SHARD_METHODS:
+        print(f"Unknown SHARD_BY {method!r}, using range.")
+        return "range"
+    return method
+
+
+def range_shards(connection, spec, count):
+    """
+    Splits the child table's domains, in collation order, into up to count
+    inclusive (first, last) ranges of about the same number of rows.
+    """
+    column = f"c.{quote(spec.domain_key[0])}"
+    query = (
+        f"SELECT {column}, COUNT(*) FROM {quote(spec.child_table)} c "
+        f"WHERE {column} IS NOT NULL GROUP BY {column} ORDER BY {column}"
+    )
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(query)
+        domains = list(iter_rows(cursor))
+    finally:
+        cursor.close()
+    if not domains:
+        return []
+
+    target = sum(rows for _, rows in domains) / count
+    shards = []
+    first = None
+    rows_in_shard = 0
+    for domain, rows in domains:
+        if first is None:
+            first = domain
+        rows_in_shard += rows
+        if rows_in_shard >= target:
+            shards.append((first, domain))
+            first = None
+            rows_in_shard = 0
+    if first is not None:
+        shards.append((first, domains[-1][0]))
+    return shards
+
+
+def plan_shards(connection, spec, count, method):
+    """
+    Returns the shards of a check as (SQL, params) queries: one per domain
+    range or hash bucket, all with the same SQL so one prepared statement
+    serves them all, plus a last one for rows without a domain.
+    """
+    column = f"c.{quote(spec.domain_key[0])}"
+    if method == "hash":
+        condition = f"MOD(CRC32({column}), %s) = %s"
+        shards = [(count, bucket) for bucket in range(count)]
+    else:
+        condition = f"{column} >= %s AND {column} <= %s"
+        shards = range_shards(connection, spec, count)
+    queries = [build_check_query(spec, [condition], list(shard)) for shard in shards]
+    queries.append(build_check_query(spec, [f"{column} IS NULL"]))
+    return queries
+
+
+class ShardWorkers:
+    """
+    Gives each worker thread its own pooled connection and prepared-statement
+    cursor for the length of one check. The cursor prepares a statement the
+    first time it sees its SQL and reuses it for every later shard. The
+    connections' session counters are summed for the check's stats. limit,
+    if given, puts each connection under the check's time budget (see
+    Scheduler.limiter).
+    """
+
+    def __init__(self, pools, limit=None):
+        self.pools = itertools.cycle(pools)
+        self.limit = limit
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.workers = []
+        self.budgets = []
+
+    def cursor(self):
+        if getattr(self.local, "cursor", None) is None:
+            with self.lock:
+                connection = next(self.pools).get_connection()
+            if self.limit:
+                budget = self.limit(connection)
+                with self.lock:
+                    self.budgets.append(budget)
+            before = session_status(connection)
+            self.local.cursor = connection.cursor(prepared=True)
+            with self.lock:
+                self.workers.append((connection, self.local.cursor, before))
+        return self.local.cursor
+
+    def run(self, query, params):
+        """
+        Runs one shard and returns its orphan rows.
+        """
+        cursor = self.cursor()
+        cursor.execute(query, params)
+        return list(compact_rows(cursor))
+
+    def close(self):
+        """
+        Closes the cursors, returns the connections to their pools and returns
+        the summed session counter deltas.
+        """
+        for budget in self.budgets:
+            budget.stop()
+        deltas = {}
+        for connection, cursor, before in self.workers:
+            cursor.close()
+            after = session_status(connection)
+            for name, value in after.items():
+                deltas[name] = deltas.get(name, 0) + value - before.get(name, 0)
+            connection.close()
+        return {name: value for name, value in deltas.items() if value}
+
+
+def iter_sharded_orphans(workers, executor, queries):
+    """
+    Runs the shards in parallel and yields their orphans in shard order, each
+    shard as soon as it and every shard before it are done.
+    """
+    futures = [executor.submit(workers.run, query, params) for query, params in queries]
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def run_sharded(
+    connection, spec, run_cleanup=True, stats=None, limit=None, pools=None, workers=1
+):
+    """
+    Runs one check split into shards by domain, the shards running in
+    parallel on up to workers connections from the pools. Checks without a
+    domain column run as a single query. limit, if given, puts the shard
+    connections under the check's time budget (see Scheduler.limiter).
+    """
+    if not spec.domain_key:
+        return run_check(connection, spec, run_cleanup, stats)
+
+    method = get_shard_method()
+    keep = wants_cleanup(spec)
+    stats = stats or QueryStats(spec.name)
+    stats.start(connection)
+    shard_workers = ShardWorkers(pools, limit)
+    try:
+        queries = plan_shards(connection, spec, workers * SHARDS_PER_WORKER, method)
+        print(f"Split into {len(queries)} shards by {method}.")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            missing_entries = print_orphans(
+                spec,
+                stats.count_rows(
+                    iter_sharded_orphans(shard_workers, executor, queries)
+                ),
+                keep=keep,
+            )
+    except Error as e:
+        report_query_error(spec, e, stats)
+        return None
+    finally:
+        shard_deltas = shard_workers.close()
+    stats.stop(connection)
+    for name, value in shard_deltas.items():
+        stats.deltas[name] = stats.deltas.get(name, 0) + value
+    return finish_check(spec, missing_entries, run_cleanup, stats)
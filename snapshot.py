@@ -0,0 +1,263 @@
+from mysql.connector import Error
+import sys
+from instrument import QueryStats
+from checks import (
+    Row,
+    finish_check,
+    iter_rows,
+    print_orphans,
+    quote,
+    report_query_error,
+    wants_cleanup,
+)
+
+
+def normalize(value):
+    """
+    Makes a key value compare the way MariaDB's default (case-insensitive,
+    trailing-space-insensitive) collations compare it in the JOIN queries.
+    Strings are interned so repeated values such as domains are stored once.
+    """
+    if isinstance(value, str):
+        return sys.intern(value.lower().rstrip(" "))
+    return value
+
+
+def make_key(row, indexes):
+    """
+    Builds the hashable key for a row from the given column positions.
+    Single-column keys are stored bare instead of as 1-tuples to save memory.
+    Returns None if any key column is NULL, since NULL never matches in a JOIN.
+    """
+    if len(indexes) == 1:
+        return normalize(row[indexes[0]])
+    key = tuple(normalize(row[index]) for index in indexes)
+    if None in key:
+        return None
+    return key
+
+
+def build_filters(spec, positions):
+    """
+    Turns a check's exclusions into (column position, operator, normalized
+    value) filters that can be applied to rows client-side.
+    """
+    filters = []
+    for column, operator, value in spec.exclusions:
+        if operator == "NOT IN":
+            value = {normalize(item) for item in value}
+        else:
+            value = normalize(value)
+        filters.append((positions[column], operator, value))
+    return filters
+
+
+def is_excluded(filters, row):
+    """
+    Applies exclusion filters to a row. Like SQL, a NULL value in a filtered
+    column excludes the row.
+    """
+    for index, operator, value in filters:
+        cell = normalize(row[index])
+        if cell is None:
+            return True
+        if operator == "NOT IN" and cell in value:
+            return True
+        if operator == "<>" and cell == value:
+            return True
+    return False
+
+
+def plan_scans(specs):
+    """
+    Works out which columns to read from each table, and orders the tables so
+    that every parent is read before any table that is checked against it.
+    Returns a list of (table, columns, parent_keys, child_specs) where
+    parent_keys are the column tuples to build key sets for.
+    """
+    tables = {}
+
+    def table_entry(table):
+        return tables.setdefault(
+            table, {"columns": [], "parent_keys": [], "child_specs": []}
+        )
+
+    def add_columns(entry, columns):
+        for column in columns:
+            if column not in entry["columns"]:
+                entry["columns"].append(column)
+
+    for spec in specs:
+        parent_columns = tuple(parent for _, parent in spec.keys)
+        parent = table_entry(spec.parent_table)
+        if parent_columns not in parent["parent_keys"]:
+            parent["parent_keys"].append(parent_columns)
+        add_columns(parent, parent_columns)
+
+        child = table_entry(spec.child_table)
+        child["child_specs"].append(spec)
+        add_columns(child, spec.columns)
+        add_columns(child, (column for column, _ in spec.keys))
+        add_columns(child, (column for column, _, _ in spec.exclusions))
+
+    ordered = []
+    visiting = set()
+
+    def visit(table):
+        if table in visiting or table in ordered:
+            return
+        visiting.add(table)
+        for spec in tables[table]["child_specs"]:
+            visit(spec.parent_table)
+        ordered.append(table)
+
+    for table in tables:
+        visit(table)
+
+    return [
+        (
+            table,
+            tables[table]["columns"],
+            tables[table]["parent_keys"],
+            tables[table]["child_specs"],
+        )
+        for table in ordered
+    ]
+
+
+def scan_table(
+    connection, table, columns, parent_keys, child_specs, key_sets, stats=None
+):
+    """
+    Reads a table once. Builds the key sets other checks need from it, and
+    collects the orphans of every check that has it as the child table.
+    Returns a dict of check name to orphan rows.
+    """
+    if "*" in columns:
+        select = "*"
+    else:
+        select = ", ".join(quote(column) for column in columns)
+
+    cursor = connection.cursor(buffered=False)
+    try:
+        cursor.execute(f"SELECT {select} FROM {quote(table)}")
+        positions = {name: index for index, name in enumerate(cursor.column_names)}
+
+        building = []
+        for key_columns in parent_keys:
+            key_set = set()
+            key_sets[(table, key_columns)] = key_set
+            building.append((key_set, [positions[column] for column in key_columns]))
+
+        checking = []
+        for spec in child_specs:
+            if spec.columns == ("*",):
+                reported = list(cursor.column_names)
+            else:
+                reported = list(spec.columns)
+            checking.append(
+                (
+                    key_sets[(spec.parent_table, tuple(p for _, p in spec.keys))],
+                    [positions[column] for column, _ in spec.keys],
+                    (
+                        {column: index for index, column in enumerate(reported)},
+                        [positions[column] for column in reported],
+                    ),
+                    build_filters(spec, positions),
+                    [],
+                )
+            )
+
+        rows = iter_rows(cursor)
+        if stats:
+            rows = stats.count_rows(rows)
+        for row in rows:
+            for key_set, indexes in building:
+                key = make_key(row, indexes)
+                if key is not None:
+                    key_set.add(key)
+            for key_set, indexes, reported, filters, orphans in checking:
+                if filters and is_excluded(filters, row):
+                    continue
+                key = make_key(row, indexes)
+                if key is None or key not in key_set:
+                    names, picks = reported
+                    orphans.append(Row(names, tuple(row[i] for i in picks)))
+    finally:
+        cursor.close()
+
+    return {
+        spec.name: orphans for spec, (_, _, _, _, orphans) in zip(child_specs, checking)
+    }
+
+
+def report_stopped(spec, error, started, record=None):
+    """
+    Reports a check whose tables weren't read to the end because reading one
+    failed or was stopped for running past its time limit (see
+    report_query_error), timing it from started. Checks that timed out are
+    passed to record (see Scheduler.record), if given.
+    """
+    stats = QueryStats(spec.name)
+    stats.started = started
+    report_query_error(spec, error, stats)
+    if record and stats.status == "timed out":
+        record(spec.name, stats.status)
+
+
+def run_snapshot(connection, specs, run_cleanup=True, record=None):
+    """
+    Runs the given checks client-side: every table involved is read once, the
+    parent key columns are kept in in-memory sets, and each child table's rows
+    are checked against those sets as they stream in. A full run costs one scan
+    per table instead of one join per check. If reading a table fails or is
+    stopped, the checks that were already complete are still reported and the
+    rest are reported with report_stopped.
+    Returns a list of (spec, orphans) for checks whose orphans were kept for
+    cleanup.
+    """
+    results = {}
+    key_sets = {}
+    table_stats = {}
+    stopped = None
+    for table, columns, parent_keys, child_specs in plan_scans(specs):
+        print(f"\nReading {table}...")
+        stats = QueryStats(table)
+        stats.start(connection)
+        try:
+            results.update(
+                scan_table(
+                    connection,
+                    table,
+                    columns,
+                    parent_keys,
+                    child_specs,
+                    key_sets,
+                    stats,
+                )
+            )
+        except Error as e:
+            stopped = (e, stats.started)
+            break
+        stats.stop(connection)
+        stats.report()
+        table_stats[table] = stats
+
+    kept = []
+    for spec in specs:
+        print(f"\nRunning {spec.name}...")
+        if spec.name not in results:
+            report_stopped(spec, *stopped, record)
+            continue
+        keep = wants_cleanup(spec)
+        # A check costs what reading its child table cost.
+        stats = QueryStats(spec.name)
+        stats.elapsed = table_stats[spec.child_table].elapsed
+        stats.deltas = table_stats[spec.child_table].deltas
+        missing_entries = print_orphans(
+            spec, stats.count_rows(results[spec.name]), keep=keep
+        )
+        missing_entries = finish_check(spec, missing_entries, run_cleanup, stats)
+        if missing_entries:
+            kept.append((spec, missing_entries))
+    return kept
@@ -0,0 +1,408 @@
+from mysql.connector import errors
+import argparse
+import bisect
+import itertools
+import os
+import random
+import sqlite3
+import zlib
+from checks import CHECKS, IGNORED_DIALPLANS, quote
+
+# Columns of the tables the checks touch, as generated here. Only the columns
+# the checks read are filled; the real tables have many more.
+TABLES = {
+    "territories": ("territory",),
+    "domains_config": ("domain", "territory", "description"),
+    "dialplans": ("dialplan", "domain", "plan_description"),
+    "dialplan_config": (
+        "dialplan",
+        "matchrule",
+        "responder",
+        "domain",
+        "plan_description",
+    ),
+    "subscriber_config": ("subscriber_login", "aor_user", "aor_host"),
+    "callqueue_config": ("queue_name", "domain"),
+    "huntgroup_config": ("huntgroup_name", "huntgroup_domain"),
+    "huntgroup_entry_config": ("device_aor", "huntgroup_name", "huntgroup_domain"),
+    "registrar_config": ("aor", "subscriber_name", "subscriber_domain"),
+    "time_frame_selections": ("user", "domain", "time_frame_name", "error_info"),
+    "feature_config": ("name", "callee_match", "parameters"),
+}
+
+# Rows per domain of each table, on average. The total decides how many
+# domains a given scale gets.
+ROWS_PER_DOMAIN = {
+    "dialplans": 2,
+    "dialplan_config": 20,
+    "subscriber_config": 20,
+    "callqueue_config": 1,
+    "huntgroup_config": 1,
+    "huntgroup_entry_config": 5,
+    "registrar_config": 40,
+    "time_frame_selections": 5,
+    "feature_config": 20,
+}
+
+# Domains per territory.
+DOMAINS_PER_TERRITORY = 50
+
+# Rows per INSERT batch.
+INSERT_BATCH_SIZE = 10000
+
+
+def parent_indexes():
+    """
+    Returns the index every check's join needs on its parent table, as
+    (table, columns) pairs, the way a production server should have them.
+    """
+    indexes = {}
+    for spec in CHECKS:
+        columns = tuple(parent for _, parent in spec.keys)
+        indexes[(spec.parent_table, columns)] = True
+    return list(indexes)
+
+
+class Dataset:
+    """
+    Describes a synthetic SiPbxDomain at a given scale (total rows over all
+    tables). orphan_rate is the share of child rows pointing at a parent that
+    doesn't exist, and skew the Zipf exponent of the domain sizes (0 gives
+    every domain the same size; around 1 gives a few huge domains and a long
+    tail of small ones, like a real reseller platform).
+    """
+
+    def __init__(self, scale, orphan_rate=0.01, skew=1.0, seed=1):
+        self.scale = scale
+        self.orphan_rate = orphan_rate
+        self.skew = skew
+        self.seed = seed
+        self.domains = max(10, scale // (sum(ROWS_PER_DOMAIN.values()) + 1))
+        self.territories = max(3, self.domains // DOMAINS_PER_TERRITORY)
+        weights = [1 / (rank**skew) for rank in range(1, self.domains + 1)]
+        self.cum_weights = list(itertools.accumulate(weights))
+        total = self.cum_weights[-1]
+        # Users per domain, following the skew, at least one each.
+        self.users = [
+            max(
+                1,
+                round(w / total * ROWS_PER_DOMAIN["subscriber_config"] * self.domains),
+            )
+            for w in weights
+        ]
+        self.rng = random.Random(seed)
+
+    def name(self):
+        return f"sipbx-{self.scale}-{self.orphan_rate}-{self.skew}-{self.seed}"
+
+    def domain(self, index):
+        return f"d{index}.example"
+
+    def pick_domain(self):
+        """
+        Returns a domain index, bigger domains more often.
+        """
+        point = self.rng.random() * self.cum_weights[-1]
+        return bisect.bisect_left(self.cum_weights, point)
+
+    def orphaned(self):
+        return self.rng.random() < self.orphan_rate
+
+    def missing(self, prefix):
+        """
+        Returns a key that no parent row has.
+        """
+        return f"gone-{prefix}{self.rng.randrange(1 << 30)}"
+
+    def pick_user(self):
+        """
+        Returns (user, domain) of a subscriber, or of a missing one at the
+        orphan rate.
+        """
+        index = self.pick_domain()
+        if self.orphaned():
+            if self.rng.random() < 0.5:
+                return self.missing("u"), self.domain(index)
+            return f"u{self.rng.randrange(self.users[index])}", self.missing("d")
+        return f"u{self.rng.randrange(self.users[index])}", self.domain(index)
+
+    def count(self, table):
+        return ROWS_PER_DOMAIN[table] * self.domains
+
+    def rows(self, table):
+        """
+        Yields the rows of a table.
+        """
+        rng = self.rng
+        if table == "territories":
+            for index in range(self.territories):
+                yield (f"t{index}",)
+        elif table == "domains_config":
+            for index in range(self.domains):
+                territory = (
+                    self.missing("t")
+                    if self.orphaned()
+                    else f"t{rng.randrange(self.territories)}"
+                )
+                yield (self.domain(index), territory, "")
+        elif table == "dialplans":
+            for name in IGNORED_DIALPLANS:
+                yield (name, "", "")
+            for index in range(self.count(table)):
+                domain = self.pick_domain()
+                owner = self.missing("d") if self.orphaned() else self.domain(domain)
+                yield (f"dp{index}", owner, "")
+        elif table == "dialplan_config":
+            dialplans = self.count("dialplans")
+            for index in range(self.count(table)):
+                if self.orphaned():
+                    dialplan = self.missing("dp")
+                else:
+                    dialplan = f"dp{rng.randrange(dialplans)}"
+                yield (dialplan, f"m{index}", "r", "", "")
+        elif table == "subscriber_config":
+            for index, users in enumerate(self.users):
+                domain = self.domain(index)
+                if self.orphaned():
+                    domain = self.missing("d")
+                for user in range(users):
+                    yield (f"u{user}@{domain}", f"u{user}", domain)
+        elif table in ("callqueue_config", "huntgroup_config"):
+            # Queues are named after a user of their domain, as on a real
+            # system; huntgroups mirror the same queues.
+            queues = random.Random(self.seed + 1)
+            for index in range(self.count(table)):
+                domain = self.domain(index % self.domains)
+                user = f"u{queues.randrange(self.users[index % self.domains])}"
+                if self.orphaned():
+                    user = self.missing("u")
+                yield (user, domain)
+        elif table == "huntgroup_entry_config":
+            queues = random.Random(self.seed + 1)
+            names = [
+                f"u{queues.randrange(self.users[index])}"
+                for index in range(self.domains)
+            ]
+            for index in range(self.count(table)):
+                domain = self.pick_domain()
+                if self.orphaned():
+                    yield (
+                        f"sip:a{index}@agent",
+                        self.missing("q"),
+                        self.domain(domain),
+                    )
+                else:
+                    yield (f"sip:a{index}@agent", names[domain], self.domain(domain))
+        elif table == "registrar_config":
+            for index in range(self.count(table)):
+                user, domain = self.pick_user()
+                yield (f"sip:{user}-{index}@{domain}", user, domain)
+            yield ("sip:wildcard", "system", "*")
+        elif table == "time_frame_selections":
+            for index in range(self.count(table)):
+                user, domain = self.pick_user()
+                yield (user, domain, f"tf{index}", "")
+        elif table == "feature_config":
+            for index in range(self.count(table)):
+                user, domain = self.pick_user()
+                yield ("fc", f"{user}@{domain}", "")
+
+
+def batches(rows, size=INSERT_BATCH_SIZE):
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class SqliteCursor:
+    """
+    The parts of a mysql.connector cursor the checks use, over SQLite.
+    """
+
+    def __init__(self, connection, dictionary=False):
+        self.cursor = connection.cursor()
+        self.dictionary = dictionary
+        self.column_names = ()
+
+    def execute(self, query, params=()):
+        try:
+            self.cursor.execute(query.replace("%s", "?"), tuple(params))
+        except sqlite3.Error as e:
+            raise errors.DatabaseError(msg=str(e))
+        self.column_names = tuple(d[0] for d in self.cursor.description or ())
+
+    def fetchmany(self, size=1):
+        rows = self.cursor.fetchmany(size)
+        if self.dictionary:
+            return [dict(zip(self.column_names, row)) for row in rows]
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        if self.dictionary:
+            return [dict(zip(self.column_names, row)) for row in rows]
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteConnection:
+    """
+    A SQLite file standing in for the SiPbxDomain database, close enough for
+    the checks to run on unchanged: %s placeholders, dictionary cursors,
+    case-insensitive text columns, and the CRC32/CONCAT_WS/MOD functions
+    incremental and sharded modes use.
+    Server-only statements (SHOW STATUS, EXPLAIN FORMAT=JSON, ...) raise
+    mysql.connector errors like a server that refuses them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.create_function("CRC32", 1, lambda v: zlib.crc32(str(v).encode()))
+        self.db.create_function("MOD", 2, lambda a, b: None if a is None else a % b)
+        self.db.create_function(
+            "CONCAT_WS",
+            -1,
+            lambda sep, *values: sep.join(str(v) for v in values if v is not None),
+        )
+
+    def cursor(self, dictionary=False, buffered=None, prepared=False):
+        return SqliteCursor(self.db, dictionary)
+
+    def is_connected(self):
+        return True
+
+    def ping(self, **kwargs):
+        pass
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+def create_tables(connection, text_type):
+    """
+    Creates the tables and the parent key indexes the checks rely on.
+    """
+    cursor = connection.cursor()
+    for table, columns in TABLES.items():
+        cursor.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+        definition = ", ".join(f"{quote(c)} {text_type}" for c in columns)
+        cursor.execute(f"CREATE TABLE {quote(table)} ({definition})")
+    for table, columns in parent_indexes():
+        name = f"idx_{table}_{'_'.join(columns)}"
+        cursor.execute(
+            f"CREATE INDEX {quote(name)} ON {quote(table)}"
+            f" ({', '.join(quote(c) for c in columns)})"
+        )
+    cursor.close()
+
+
+def load(connection, dataset, text_type):
+    """
+    Fills the tables with the dataset's rows. Returns rows written per table.
+    """
+    create_tables(connection, text_type)
+    counts = {}
+    cursor = connection.cursor()
+    for table, columns in TABLES.items():
+        query = (
+            f"INSERT INTO {quote(table)} ({', '.join(quote(c) for c in columns)})"
+            f" VALUES ({', '.join(['%s'] * len(columns))})"
+        )
+        counts[table] = 0
+        for batch in batches(dataset.rows(table)):
+            if isinstance(connection, SqliteConnection):
+                connection.db.executemany(query.replace("%s", "?"), batch)
+            else:
+                cursor.executemany(query, batch)
+            counts[table] += len(batch)
+        connection.commit()
+    cursor.close()
+    return counts
+
+
+def generate_sqlite(dataset, directory="bench-data"):
+    """
+    Returns the path of a SQLite file holding the dataset, generating it if
+    it isn't there yet.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{dataset.name()}.sqlite")
+    if os.path.exists(path):
+        return path
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    connection = SqliteConnection(temp_path)
+    connection.db.execute("PRAGMA journal_mode = OFF")
+    connection.db.execute("PRAGMA synchronous = OFF")
+    try:
+        counts = load(connection, dataset, "TEXT COLLATE NOCASE")
+    finally:
+        connection.close()
+    os.replace(temp_path, path)
+    print(f"Generated {sum(counts.values())} rows in {path}")
+    return path
+
+
+def generate_mariadb(dataset, config):
+    """
+    Loads the dataset into the MariaDB database in config, replacing the
+    tables there. Never point this at a real SiPbxDomain.
+    """
+    import mysql.connector
+
+    connection = mysql.connector.connect(**config)
+    try:
+        counts = load(connection, dataset, "VARCHAR(255)")
+    finally:
+        connection.close()
+    print(f"Generated {sum(counts.values())} rows in {config['database']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic SiPbxDomain database for benchmarks."
+    )
+    parser.add_argument("--scale", type=int, default=10000, help="total rows")
+    parser.add_argument("--orphan-rate", type=float, default=0.01)
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--mariadb",
+        metavar="DATABASE",
+        help="load into this scratch database on NSHOST instead of a SQLite file",
+    )
+    args = parser.parse_args()
+    dataset = Dataset(args.scale, args.orphan_rate, args.skew, args.seed)
+    if args.mariadb:
+        if args.mariadb.lower() == "sipbxdomain":
+            parser.error("refusing to replace the tables of SiPbxDomain")
+        from nsanity import get_db_config
+
+        generate_mariadb(dataset, {**get_db_config(), "database": args.mariadb})
+    else:
+        generate_sqlite(dataset)
+
+
+if __name__ == "__main__":
+    main()